@@ -0,0 +1,348 @@
+import numpy as np
+from CompanyAgent import CompanyAgent, k, DAYS_PER_YEAR
+from rolling_statistics import RollingWindow
+from random_streams import make_rng
+from abatement import AbatementCurves
+
+IDLE = 0
+BUY = 1
+SELL = 2
+STATES = np.array(["idle", "buy", "sell"])
+STATE_CODES = {state: code for code, state in enumerate(STATES.tolist())}
+# the state arrays with one entry per agent
+AGENT_ARRAYS = ("expected_emission", "allowance", "shortfall", "emission_rate", "emission_rate_noise", "total_emission",
+                "expected_emission_rate", "expected_deficit", "min_sell_price", "max_buy_price", "expected_market_price",
+                "sale_counter", "buy_counter", "count", "state_code", "trade_price", "abatement_index", "abatement_cost_per_ton",
+                "advanced_trading")
+
+
+class AgentPopulation:
+    """The Agent Population class holds the state of many company agents in NumPy arrays (structure of arrays)
+    and updates all of them at once. Every phase of CompanyAgent.update_agent() is run as one batched array operation.
+    Properties:
+        size (int): The number of agents.
+        day (int): The day of the year (shared by all agents).
+        year_length (int): The number of days of the compliance year.
+        expected_emission (np.ndarray): The expected emission over the course of the year.
+        allowance (np.ndarray): The allowance for the year.
+        emission_rate (np.ndarray): The emission rate (emission per day).
+        emission_rate_noise (np.ndarray): The noise in the emission rate (emission per day).
+        total_emission (np.ndarray): The total emission produced by the agents so far.
+        expected_emission_rate (np.ndarray): The expected emission rate based on past emissions.
+        expected_deficit (np.ndarray): The expected deficit of the agents (expected emissions - allowance).
+        expected_market_price (np.ndarray): The expected market price from the agents' perspective.
+        sale_counter (np.ndarray): The number of successful sales.
+        buy_counter (np.ndarray): The number of successful buys.
+        count (np.ndarray): The number of allowances to buy or sell.
+        state_code (np.ndarray): The state of the agents (IDLE, BUY or SELL).
+        trade_price (np.ndarray): The price at which the agents are willing to trade.
+        abatement_curves (AbatementCurves): The abatement cost curves of the agents, generated lazily.
+        abatement_index (np.ndarray): The number of abatements each agent already took (position in its cost curve).
+        abatement_cost_per_ton (np.ndarray): The abatement cost per ton.
+        min_sell_price (np.ndarray): The minimum price at which the agents can sell allowances.
+        max_buy_price (np.ndarray): The maximum price at which the agents can buy allowances.
+        advanced_trading (np.ndarray): Whether the agents use advanced trading strategies.
+        last_k_emissions (RollingWindow): The emissions of the last k days with running sums.
+        shortfall (np.ndarray): The allowances missing at the last surrender, carried into the next compliance year.
+        rng (np.random.Generator): The random number generator of the population.
+    """
+
+    def __init__(self, expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise=0.1, emission_rate_noise=0.01, activate_abatement=True, advanced_trading=False, rng=None, abatement_scale=30000):
+        """Initialize the population. All arguments except rng and abatement_scale can be scalars or arrays with one entry per agent,
+        their meaning is the same as in CompanyAgent.__init__(). abatement_scale is the scale of the gamma distributed
+        first abatement costs (see abatement.AbatementCurves).
+        """
+        self.rng = make_rng(rng)
+        expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise, emission_rate_noise, activate_abatement, advanced_trading = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(a)) for a in (expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise, emission_rate_noise, activate_abatement, advanced_trading)])
+        size = len(expected_emission)
+
+        self.day = 0
+        self.year_length = DAYS_PER_YEAR
+        self.expected_emission = expected_emission + self.rng.normal(scale=expected_emission_noise)
+        self.allowance = initial_allowance.astype(float)
+        self.shortfall = np.zeros(size)
+
+        self.emission_rate = self.expected_emission / self.year_length
+        self.emission_rate_noise = emission_rate_noise.astype(float)
+
+        self.total_emission = np.zeros(size)
+        self.expected_emission_rate = np.zeros(size)
+        self.expected_deficit = self.expected_emission - self.allowance
+
+        self.min_sell_price = min_sell_price.astype(float)
+        self.max_buy_price = max_buy_price.astype(float)
+        self.expected_market_price = (self.min_sell_price + self.max_buy_price) / 2
+
+        self.sale_counter = np.zeros(size)
+        self.buy_counter = np.zeros(size)
+        self.count = np.zeros(size)
+        self.state_code = np.full(size, IDLE, dtype=np.int8)
+        self.trade_price = self.expected_market_price.copy()
+
+        self.abatement_curves = AbatementCurves(size, rng=self.rng, active=activate_abatement.astype(bool), scale=abatement_scale)
+        self.abatement_index = np.zeros(size, dtype=np.int64)
+        self.abatement_cost_per_ton = np.full(size, np.inf)
+
+        self.advanced_trading = advanced_trading.astype(bool)
+
+        self.last_k_emissions = RollingWindow(k, recent=10, shape=(size,))
+
+    @classmethod
+    def from_agents(cls, agents, rng=None):
+        '''
+        Creates a population from a list of CompanyAgent objects, copying their current state.
+        Args:
+            agents (list): A list of CompanyAgent objects, all on the same day.
+            rng (np.random.Generator): The random number generator of the population.
+        Returns:
+            AgentPopulation: The population holding the state of the agents.
+        '''
+        population = cls.__new__(cls)
+        population.rng = make_rng(rng)
+        size = len(agents)
+        population.day = agents[0].day
+        population.year_length = agents[0].year_length
+        for name in ("expected_emission", "allowance", "shortfall", "emission_rate", "emission_rate_noise", "total_emission",
+                     "expected_deficit", "expected_market_price", "sale_counter", "buy_counter", "count",
+                     "trade_price", "abatement_cost_per_ton", "min_sell_price", "max_buy_price"):
+            setattr(population, name, np.array([getattr(agent, name) for agent in agents], dtype=float))
+        population.expected_emission_rate = np.array([getattr(agent, "expected_emission_rate", 0.0) for agent in agents], dtype=float)
+        population.state_code = np.array([np.flatnonzero(STATES == agent.state)[0] for agent in agents], dtype=np.int8)
+
+        population.abatement_index = np.array([agent.abatement_index for agent in agents], dtype=np.int64)
+        curve_length = max(len(agent.abatement_costs) for agent in agents)
+        abatement_costs = np.full((size, curve_length), np.inf)
+        for i, agent in enumerate(agents):
+            abatement_costs[i, :len(agent.abatement_costs)] = agent.abatement_costs
+        population.abatement_curves = AbatementCurves.from_array(abatement_costs)
+
+        population.advanced_trading = np.array([agent.update_market_position.__func__ is CompanyAgent.update_market_position_advanced_trading for agent in agents])
+
+        population.last_k_emissions = RollingWindow(k, recent=10, shape=(size,))
+        for emissions in zip(*[agent.last_k_emissions.values() for agent in agents]):
+            population.last_k_emissions.push(np.array(emissions))
+        return population
+
+    def subset(self, index):
+        '''
+        Returns a population of the agents selected by index (slice or array of agent positions) with a copy of their state,
+        e.g. one shard of a population (see sharding.ShardedPopulation). The subset has no random number generator,
+        so its random numbers and abatement steps have to be passed in.
+        '''
+        population = AgentPopulation.__new__(AgentPopulation)
+        population.rng = None
+        population.day = self.day
+        population.year_length = self.year_length
+        for name in AGENT_ARRAYS:
+            setattr(population, name, getattr(self, name)[index].copy())
+        population.abatement_curves = self.abatement_curves.subset(index)
+        population.last_k_emissions = self.last_k_emissions.subset(index)
+        return population
+
+    @property
+    def size(self):
+        return len(self.allowance)
+
+    @property
+    def state(self):
+        """The states of the agents as strings ("idle", "buy" or "sell")."""
+        return STATES[self.state_code]
+
+    def __len__(self):
+        return self.size
+
+    def update_expected_market_price(self, market_price):
+        """
+        Update the expected market prices based on the trades of the previous day.
+        Same rules as CompanyAgent.update_expected_market_price().
+        """
+        selling = self.state_code == SELL
+        buying = self.state_code == BUY
+
+        self.expected_market_price += selling & (self.sale_counter > 0)
+        self.expected_market_price -= selling & (self.sale_counter < 0) & (self.expected_market_price > self.min_sell_price)
+
+        self.expected_market_price -= buying & (self.buy_counter > 0)
+        self.expected_market_price += buying & (self.buy_counter < 0) & (self.expected_market_price < self.max_buy_price)
+
+        if self.day > 1:
+            idle = self.state_code == IDLE
+            above = idle & (self.expected_market_price > market_price)
+            below = idle & (self.expected_market_price < market_price)
+            self.expected_market_price -= above
+            self.expected_market_price += below
+
+        self.buy_counter[:] = 0
+        self.sale_counter[:] = 0
+
+    def update_emission_rate(self, emission_shocks=None):
+        """
+        Update the emission rates. Models the emission rates as Wiener processes.
+        Args:
+            emission_shocks (np.ndarray): Standard normal random numbers of today, one per agent. None draws them from rng.
+        """
+        if emission_shocks is None:
+            emission_shocks = self.rng.standard_normal(self.size)
+        self.emission_rate = np.maximum(0, self.emission_rate + self.emission_rate_noise * emission_shocks)
+
+    def update_abatements(self):
+        """
+        Update the abatement costs per ton. It is calculated over the remaining days of the year.
+        Agents that used up their abatement curve can not abate anymore.
+        """
+        self.abatement_cost_per_ton = self.abatement_curves.current(self.abatement_index) / (self.year_length + 1 - self.day)
+
+    def track_emission(self):
+        """
+        Track the emissions produced by the agents.
+        """
+        self.total_emission += self.emission_rate
+        self.last_k_emissions.push(self.emission_rate)
+
+    def update_expected_emission(self):
+        """
+        Update the expected emissions based on previous emissions.
+        Emission of last 10 days and today have higher weight.
+        """
+        total_average = self.last_k_emissions.mean()
+        average_last_10 = self.last_k_emissions.recent_mean()
+
+        # higher weight for the last 10 days and the current emission rate
+        self.expected_emission_rate = (total_average + average_last_10 + self.last_k_emissions.last()) / 3
+        self.expected_emission = self.total_emission + self.expected_emission_rate * (self.year_length - self.day)
+
+        # handle potential float issues
+        self.expected_emission = np.ceil(self.expected_emission - 1e-9)
+
+        self.expected_deficit = np.trunc(self.expected_emission - self.allowance)
+
+    def abate(self, mask):
+        """
+        Abate for all agents in mask: permanently reduce the emission rate by 1 and move on to the next abatement cost.
+        """
+        self.state_code[mask] = IDLE
+        self.count[mask] = 0
+        self.abatement_index += mask
+        self.emission_rate -= mask
+
+    def update_market_position(self, trade_draws=None):
+        """
+        Update the market position of all agents based on their expected deficit.
+        Agents with advanced_trading use the rules of CompanyAgent.update_market_position_advanced_trading(),
+        all others the rules of CompanyAgent.update_market_position_simple().
+        Args:
+            trade_draws (np.ndarray): Uniform random numbers in [0, 1) for advanced trading, one per agent. None draws them from rng.
+        """
+        deficit = self.expected_deficit
+        positive = deficit > 0
+        abating = positive & (self.expected_market_price > self.abatement_cost_per_ton)
+        buying = positive & ~abating
+
+        # advanced trading: keep percentage of expected emission as risk buffer, at the end of the year the buffer is reduced
+        risk_buffer = self.expected_emission * 0.01 if self.day < self.year_length - 64 else self.expected_emission * (self.year_length - self.day) / 6400
+        risk_buffer = np.where(self.advanced_trading, risk_buffer, 1)
+        selling = ~positive & (deficit <= -risk_buffer)
+
+        self.abate(abating)
+
+        buy_count = np.ceil(deficit)
+        sell_count = (-1) * np.ceil(deficit)
+        if self.advanced_trading.any():
+            # Dont buy/sell everything at once, closer to the end of the year => trade bigger fractions
+            if trade_draws is None:
+                trade_draws = self.rng.random(self.size)
+            low = min(self.day / (self.year_length - 64), 1)
+            fractions = low + (1 - low) * trade_draws
+            buy_count = np.where(self.advanced_trading, np.ceil(fractions * buy_count), buy_count)
+            sell_count = np.where(self.advanced_trading, np.floor(fractions * (sell_count - risk_buffer)), sell_count)
+
+        self.count[buying] = buy_count[buying]
+        self.state_code[buying] = BUY
+        self.trade_price[buying] = np.minimum(self.expected_market_price, self.max_buy_price)[buying]
+
+        self.count[selling] = sell_count[selling]
+        self.state_code[selling] = SELL
+        self.trade_price[selling] = np.maximum(self.expected_market_price, self.min_sell_price)[selling]
+
+        idle = ~positive & ~selling
+        self.state_code[idle] = IDLE
+        self.count[idle] = 0
+
+    def trade(self, buyer_ids, seller_ids, trade_amounts):
+        """
+        Applies trades: increases the allowances of the buyers and reduces the allowances of the sellers by the traded
+        amounts and updates their trade counts and counters. Agents can appear in several trades.
+        """
+        np.add.at(self.allowance, buyer_ids, trade_amounts)
+        np.add.at(self.count, buyer_ids, -trade_amounts)
+        np.add.at(self.buy_counter, buyer_ids, trade_amounts)
+
+        np.add.at(self.allowance, seller_ids, -trade_amounts)
+        np.add.at(self.count, seller_ids, -trade_amounts)
+        np.add.at(self.sale_counter, seller_ids, trade_amounts)
+
+    def failed_sell(self, agent_ids):
+        '''
+        tracks failed sales of the given agents
+        '''
+        self.sale_counter[agent_ids] -= self.count[agent_ids]
+
+    def failed_buy(self, agent_ids):
+        '''
+        tracks failed buys of the given agents
+        '''
+        self.buy_counter[agent_ids] -= self.count[agent_ids]
+
+    def update(self, market_price, emission_shocks=None, trade_draws=None):
+        """
+        Update all agents.
+
+        Update market price, emission rate, abatement costs per ton, past emissions, expected emission, and market position in that order.
+        Args:
+            market_price (float): The market price of the previous day.
+            emission_shocks (np.ndarray): Standard normal random numbers for the emission rates, None to draw them from rng.
+            trade_draws (np.ndarray): Uniform random numbers in [0, 1) for advanced trading, None to draw them from rng.
+        """
+        self.day += 1
+        self.update_expected_market_price(market_price)
+        self.update_emission_rate(emission_shocks)
+        self.update_abatements()
+        self.track_emission()
+        self.update_expected_emission()
+        self.update_market_position(trade_draws)
+
+    def set_year_length(self, year_length):
+        """
+        Sets the number of days of the current compliance year before its first day, see CompanyAgent.set_year_length().
+        """
+        if self.day != 0:
+            raise ValueError("the year length can only be set before the first day of the year")
+        self.year_length = year_length
+        self.emission_rate = self.expected_emission / self.year_length
+
+    def start_compliance_year(self, allocation, banking=True, year_length=DAYS_PER_YEAR):
+        """
+        Surrender the allowances for the emissions of the finished year and start the next compliance year.
+        Same rules as CompanyAgent.start_compliance_year(), the state of the population is kept in place.
+        Args:
+            allocation (float or np.ndarray): The free allocation of the new year, scalar or one value per agent.
+            banking (bool): Whether a surplus of allowances can be carried into the new year.
+            year_length (int): The number of days of the new year.
+        """
+        balance = self.allowance - self.total_emission
+        self.shortfall = np.maximum(0, -balance)
+        if not banking:
+            balance = np.minimum(balance, 0)
+        self.allowance = balance + allocation
+
+        self.year_length = year_length
+        self.day = 0
+        self.total_emission = np.zeros_like(self.total_emission)
+        self.expected_emission = self.emission_rate * self.year_length
+        self.expected_deficit = self.expected_emission - self.allowance
+        self.sale_counter[:] = 0
+        self.buy_counter[:] = 0
+        self.count[:] = 0
+        self.state_code[:] = IDLE
+
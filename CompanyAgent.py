@@ -1,7 +1,11 @@
 import numpy as np
 import math
+from rolling_statistics import RollingWindow
+from random_streams import make_rng
+from abatement import generate_abatement_curves
 
 k = 365
+DAYS_PER_YEAR = 365
 
 class CompanyAgent:
     """The Company Agent class represents a company agent in the Emission Trading System (ETS) market.
@@ -12,6 +16,7 @@ class CompanyAgent:
         emission_rate_noise (float): The noise in the emission rate (emission per day). Sampled from a normal distribution.
         total_emission (float): The total emission produced by the company so far.
         day (int): The day of the year.
+        year_length (int): The number of days of the compliance year.
         expected_deficit (float): The expected deficit of the company (expected emissions - allowance).
         expected_market_price (float): The expected market price from the company's perspective.
         sale_counter (int): The number of successful sales.
@@ -19,13 +24,17 @@ class CompanyAgent:
         count (int): The number of allowances to buy or sell.
         state (str): The state of the company (buy, sell, or idle).
         trade_price (float): The price at which the company is willing to trade.
-        abatement_costs (list): The abatement costs for the company (cost to permanently reduce emission rate by 1 ton per day).
+        abatement_costs (np.ndarray): The abatement costs for the company (cost to permanently reduce emission rate by 1 ton per day).
+        abatement_index (int): The number of abatements the company already took (position of the current cost in abatement_costs).
         abatement_cost_per_ton (float): The abatement cost per ton. If this cost is less than the expected CO2 price, the company will abate.
         min_sell_price (float): The minimum price at which the company can sell the allowances.
         max_buy_price (float): The maximum price at which the company can buy the allowances.
         expected_emission_noise (float): Initial uncertainty in the expected emission.
+        rng (np.random.Generator): The random number generator of the company.
+        shortfall (float): The allowances missing at the last surrender, carried into the next compliance year.
+        trade_draw (float): Uniform random number in [0, 1) for the traded fraction of today (advanced trading), None to draw it from rng.
     """
-    def __init__(self, expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise=0.1, emission_rate_noise=0.01, activate_abatement=True, advanced_trading=False):
+    def __init__(self, expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise=0.1, emission_rate_noise=0.01, activate_abatement=True, advanced_trading=False, rng=None, abatement_costs=None):
         """Initialize the Company Agent.
         Args:
             expected_emission (float): The expected emission over the course of the year.
@@ -36,16 +45,23 @@ class CompanyAgent:
             emission_rate_noise (float): The noise in the emission rate (emission per day).
             activate_abatement (bool): Whether to activate abatement or not.
             advanced_trading (bool): Whether to use advanced trading strategies or not.
+            rng (np.random.Generator): The random number generator of the company (see random_streams.make_rng()).
+            abatement_costs (np.ndarray): Precomputed abatement cost curve, e.g. a row of abatement.generate_abatement_curves().
+                If None, the curve is generated by init_abatement_costs().
         """
+        self.rng = make_rng(rng)
+        self.trade_draw = None
 
-        self.expected_emission = expected_emission + np.random.normal(scale=expected_emission_noise) 
+        self.expected_emission = expected_emission + self.rng.normal(scale=expected_emission_noise) 
         self.allowance = initial_allowance
 
-        self.emission_rate = (self.expected_emission) / 365.0   # Add some noise
+        self.year_length = DAYS_PER_YEAR
+        self.emission_rate = (self.expected_emission) / self.year_length   # Add some noise
         self.emission_rate_noise = emission_rate_noise
 
         self.total_emission = 0
         self.day = 0
+        self.shortfall = 0
         self.expected_deficit = self.expected_emission - self.allowance
 
         self.expected_market_price = (min_sell_price+max_buy_price)/2
@@ -56,10 +72,15 @@ class CompanyAgent:
         self.state = "idle"
         self.trade_price = self.expected_market_price
 
-        self.abatement_costs = self.init_abatement_costs()  # cost to permanently reduce rate by 1 ton 
+        # cost to permanently reduce rate by 1 ton
         if not activate_abatement:
-            self.abatement_costs = [np.inf]
+            self.abatement_costs = np.array([np.inf])
+        elif abatement_costs is not None:
+            self.abatement_costs = np.asarray(abatement_costs, dtype=float)
+        else:
+            self.abatement_costs = self.init_abatement_costs()
         self.abatement_cost_per_ton = float(np.inf)
+        self.abatement_index = 0
 
         self.min_sell_price = min_sell_price
         self.max_buy_price = max_buy_price
@@ -69,7 +90,7 @@ class CompanyAgent:
         else:
             self.update_market_position = self.update_market_position_simple
     
-        self.last_k_emissions = [] 
+        self.last_k_emissions = RollingWindow(k, recent=10)
 
     def init_abatement_costs(self):
         '''
@@ -77,20 +98,19 @@ class CompanyAgent:
         The initial abatement cost is generated using a gamma distribution. 
         The following abatement costs are generated by adding a random normal noise to the previous abatement cost (which is clamped to 0).
         Taking only positive values makes sure that the abatement costs increase over the number of reductions.
+        The whole curve is drawn with a few vectorized calls, see abatement.AbatementCurves.
         '''
-        abatement_costs = []
-        start_value = np.random.gamma(shape=2.5, scale=30000)
-        variance_factor = np.random.uniform(0.1, 100)
-        for variance in range(365):
-            start_value += max(np.random.normal(scale=variance*variance_factor) + np.random.uniform(0,1000), 0)
-            abatement_costs.append(start_value)
-        return abatement_costs
-
-    def update_emission_rate(self):
+        return generate_abatement_curves(1, rng=self.rng)[0]
+
+    def update_emission_rate(self, emission_shock=None):
         """
         Update the emission rate. Models the emission rate as a Wiener process.
+        Args:
+            emission_shock (float): Standard normal random number of today, None to draw it from the agent's generator.
         """
-        self.emission_rate = max(0, self.emission_rate + np.random.normal(scale=self.emission_rate_noise))
+        if emission_shock is None:
+            emission_shock = self.rng.standard_normal()
+        self.emission_rate = max(0, self.emission_rate + self.emission_rate_noise * emission_shock)
         # 3 percent chance that the emission rate is reduced by 1
         # if np.random.uniform(0,1) < 0.02:
         #     self.emission_rate += np.random.normal(scale = self.emission_rate_noise*8) #TODO maybe add bigger impacts
@@ -100,28 +120,29 @@ class CompanyAgent:
         Track the emissions produced by the company.
         """
         self.total_emission += self.emission_rate
-        self.last_k_emissions.append(self.emission_rate)
-        if len(self.last_k_emissions) > k:
-            self.last_k_emissions.pop(0)
+        self.last_k_emissions.push(self.emission_rate)
 
     def update_abatements(self):
         """
         Update the abatement costs per ton for the company. It is calculated over the remaining days of the year.
         """
-        # The first element is always the current abatement cost -> if its taken, its popped
-        self.abatement_cost_per_ton = self.abatement_costs[0] / (366 - self.day) 
+        # The abatement index points to the current abatement cost -> if its taken, the index advances
+        if self.abatement_index < len(self.abatement_costs):
+            self.abatement_cost_per_ton = self.abatement_costs[self.abatement_index] / (self.year_length + 1 - self.day)
+        else:
+            self.abatement_cost_per_ton = float(np.inf)
 
     def update_expected_emission(self):
         """
         Update the expected emission for the company based on previous emissions.
         Emission of last 10 days and today have higher weight.
         """
-        total_average = sum(self.last_k_emissions)/len(self.last_k_emissions)
-        average_last_10 = sum(self.last_k_emissions[-min(10, len(self.last_k_emissions)):])/min(10, len(self.last_k_emissions))
+        total_average = self.last_k_emissions.mean()
+        average_last_10 = self.last_k_emissions.recent_mean()
 
         # higher weight for the last 10 days and the current emission rate
-        self.expected_emission_rate = (total_average + average_last_10 + self.last_k_emissions[-1])/3 
-        self.expected_emission = self.total_emission + self.expected_emission_rate * (365 - self.day)
+        self.expected_emission_rate = (total_average + average_last_10 + self.last_k_emissions.last())/3 
+        self.expected_emission = self.total_emission + self.expected_emission_rate * (self.year_length - self.day)
 
         # handle potential float issues
         self.expected_emission = math.ceil((self.expected_emission - 1e-9))
@@ -142,7 +163,7 @@ class CompanyAgent:
             if self.expected_market_price > self.abatement_cost_per_ton:
                 self.state = "idle"
                 self.count = 0
-                self.abatement_costs.pop(0)
+                self.abatement_index += 1
                 self.emission_rate -= 1
             else:
                 self.count = math.ceil(self.expected_deficit)
@@ -170,25 +191,25 @@ class CompanyAgent:
             if self.expected_market_price > self.abatement_cost_per_ton:
                 self.state = "idle"
                 self.count = 0
-                self.abatement_costs.pop(0)
+                self.abatement_index += 1
                 self.emission_rate -= 1
             else:
                 self.count = math.ceil(self.expected_deficit)
 
                 # Dont buy everything at once, closer to the end of the year => buy bigger fractions
                 # "Time in the market beats timing the market" or something like that
-                self.count = np.ceil(np.random.uniform(min(self.day/301, 1), 1) * self.count)
+                self.count = np.ceil(self.trade_fraction() * self.count)
                 self.state = "buy"
                 self.trade_price = min(self.expected_market_price, self.max_buy_price)
         
         else:
             # keep percentage of expected emission as risk buffer, at the end of the year the buffer is reduced
-            risk_buffer = self.expected_emission * 0.01 if self.day < 301 else self.expected_emission * (365-self.day)/6400
+            risk_buffer = self.expected_emission * 0.01 if self.day < self.year_length - 64 else self.expected_emission * (self.year_length-self.day)/6400
 
             if self.expected_deficit <= -risk_buffer:
                 #sell
                 self.count = (-1)*math.ceil(self.expected_deficit) - risk_buffer
-                self.count = np.floor(np.random.uniform(min(self.day/301,1), 1) * self.count)
+                self.count = np.floor(self.trade_fraction() * self.count)
                 self.state = "sell"
                 self.trade_price = max(self.expected_market_price, self.min_sell_price)
 
@@ -196,6 +217,14 @@ class CompanyAgent:
                 self.state = "idle"
                 self.count = 0
     
+    def trade_fraction(self):
+        """
+        Fraction of the deficit/surplus that is traded today with advanced trading, uniform between min(day/(year_length - 64), 1) and 1.
+        """
+        draw = self.trade_draw if self.trade_draw is not None else self.rng.random()
+        low = min(self.day/(self.year_length - 64), 1)
+        return low + (1 - low) * draw
+
     def sell_allowance(self, trade_amount):
         """
         reduces the allowance and update trade count by the traded amount
@@ -260,24 +289,99 @@ class CompanyAgent:
         self.sale_counter = 0
         return
 
-    def update_agent(self, market_price):
+    def update_agent(self, market_price, emission_shock=None, trade_draw=None):
         """
         Update the agent.
 
         Update market price, emission rate, abatement costs per ton, past emissions, expected emission, and market position in that order.
+        The random numbers of the day can be passed in, so the environment can draw them for all agents at once.
+        Args:
+            market_price (float): The market price of the previous day.
+            emission_shock (float): Standard normal random number for the emission rate, None to draw it from the agent's generator.
+            trade_draw (float): Uniform random number in [0, 1) for advanced trading, None to draw it from the agent's generator.
         """
         self.day += 1
+        self.trade_draw = trade_draw
         self.update_expected_market_price(market_price)
-        self.update_emission_rate()
+        self.update_emission_rate(emission_shock)
         self.update_abatements()
         self.track_emission()
         self.update_expected_emission()
         self.update_market_position()
 
-    def __lt__(self, other):
+    def stays_idle(self):
+        """
+        Returns whether the agent provably stays idle until the end of the compliance year as long as it is not updated by trades:
+        it is idle without deficit, its emissions are deterministic (no emission rate noise and no abatement so far, so every
+        emission in its window is the current emission rate), and it trades with the simple strategy. Its expected emission is
+        then emission_rate * year_length on every remaining day, up to the rounding of the running sums (at most half a machine
+        epsilon of the expected emission per day of the year and of the window). The agent stays idle if the whole error
+        interval rounds up to the same expected emission without deficit, so whole-number expected emissions qualify as well.
+        """
+        if self.state != "idle" or self.count != 0 or self.expected_deficit != 0 or self.day < 1:
+            return False
+        if self.emission_rate_noise != 0 or self.abatement_index != 0 or self.update_market_position != self.update_market_position_simple:
+            return False
+        # the same float guard as update_expected_emission()
+        expected_emission = self.emission_rate * self.year_length - 1e-9
+        error = np.finfo(float).eps * (self.year_length + k) / 2 * max(1.0, abs(expected_emission))
+        lowest = math.ceil(expected_emission - error)
+        return lowest == math.ceil(expected_emission + error) and int(lowest - self.allowance) == 0
+
+    def catch_up(self, day, market_prices):
+        """
+        Advances an agent that was not updated since it was found to stay idle (see stays_idle()) to the given day.
+        The state that carries over from day to day (expected market price, emissions) is replayed day by day, the rest
+        is recalculated for the last day, so the agent ends up exactly like an agent that was updated every day.
+        Args:
+            day (int): The day of the year to advance to.
+            market_prices (dict): The market price passed to the agents on every day of the year.
+        """
+        while self.day < day:
+            self.day += 1
+            self.update_expected_market_price(market_prices[self.day])
+            self.update_emission_rate(0.0)
+            self.track_emission()
+        self.update_abatements()
+        self.update_expected_emission()
+        self.update_market_position()
+
+    def set_year_length(self, year_length):
+        """
+        Sets the number of days of the current compliance year before its first day, e.g. to simulate shorter years.
+        The emission rate is spread over the new year length, so the expected emission of the year stays the same.
+        Args:
+            year_length (int): The number of days of the year.
+        """
+        if self.day != 0:
+            raise ValueError("the year length can only be set before the first day of the year")
+        self.year_length = year_length
+        self.emission_rate = self.expected_emission / self.year_length
+
+    def start_compliance_year(self, allocation, banking=True, year_length=DAYS_PER_YEAR):
         """
-        Comparison operator for the company agent.
+        Surrender the allowances for the emissions of the finished year and start the next compliance year.
 
-        Randomly returns True or False so no company has a bias during sorting.
+        The remaining allowances are banked (without banking a surplus expires), a shortfall has to be covered
+        in the next year and is carried as negative balance. Emission rate, abatements and the expected market price
+        are kept, the expected emission of the new year is based on the current emission rate.
+        Args:
+            allocation (float): The free allocation of the new year.
+            banking (bool): Whether a surplus of allowances can be carried into the new year.
+            year_length (int): The number of days of the new year.
         """
-        return np.random.choice([True, False])
\ No newline at end of file
+        balance = self.allowance - self.total_emission
+        self.shortfall = max(0, -balance)
+        if not banking:
+            balance = min(balance, 0)
+        self.allowance = balance + allocation
+
+        self.year_length = year_length
+        self.day = 0
+        self.total_emission = 0
+        self.expected_emission = self.emission_rate * self.year_length
+        self.expected_deficit = self.expected_emission - self.allowance
+        self.sale_counter = 0
+        self.buy_counter = 0
+        self.count = 0
+        self.state = "idle"
@@ -1,46 +1,100 @@
-import heapq
 import numpy as np
-import random
-from matplotlib import pyplot as plt
+from market_clearing import clearing_price, match_orders, TRADE_DTYPE
+from AgentPopulation import AgentPopulation, BUY, SELL, STATE_CODES
+from CompanyAgent import DAYS_PER_YEAR
+from HistoryRecorder import HistoryRecorder
+from order_book import OrderBook
+from random_streams import make_rng
+from profiling import NO_PHASE
 
 
 class Environment:
     """The environment class for the carbon trading simulation, which models the market behavior.
     Properties:
         market_price (float): The current market price (intersection of supply and demand curves)
-        agents (list): The list of agents
-        daily_offers (list): A list of daily offers, used to calculate the supply curve
-        daily_demands (list): A list of daily demands, used to calculate the demand curve
-        trade_history_daily (list): A list of succesful daily trades
-        market_price_history (list): A list of daily market prices
+        agents (list or AgentPopulation): The list of agents, or a population holding the state of all agents in arrays
+        population (AgentPopulation): The agent population if the agents are given as population, otherwise None
+        year (int): The current compliance year, counted from 0
+        day_offset (int): The number of days of the finished compliance years
+        day (int): The day since the start of the simulation, used for the history
+        issued_allowances (float): The total allowances issued for the current compliance year
+        rng (np.random.Generator): Generator for the daily random numbers of the agents and the random order of buyers/sellers
+        tiebreak_rng (np.random.Generator): Generator for the random order of agents with the same price in the matching queues, spawned from rng
+        order_book (OrderBook): The buy and sell orders of the day, kept sorted across days and used for the supply and demand curves and the matching
+        history (HistoryRecorder): The recorder of the trade, market, and agent history
+        curves (CurveRecorder): Captures the supply and demand curves of selected days for deferred plotting, None to plot interactively
+        order_books (OrderBookStore): Stores the order book of every day on disk for later analysis, None to not store the books
+        active_set (bool): Whether agents that provably stay idle are skipped in the daily update (agent lists only)
+        active_ids (list): The ids of the agents updated every day, in ascending order (with active_set)
+        dormant_ids (list): The ids of the skipped agents, advanced with wake_agents() (with active_set)
+        unrecorded_ids (list): The ids of the agents that became dormant since the agent history was last tracked (with active_set)
+        agent_day (int): The day of the year of the agents (with active_set, the skipped agents keep their day)
+        update_prices (dict): The market price passed to the agents on every day of the year (with active_set)
+        profiler (Profiler): Records the time of the simulation phases and counters like the number of trades, None if profiling is disabled
         trade_hist_dict (dict): A dictionary of trade history, containing the day, trade price, and trade amount
         market_hist_dict (dict): A dictionary of market price history, containing the day and market price
-        agent_hist_dict (dict): A dictionary of agent history, containing the day, deficit, state, and trading volume of each agent
+        agent_hist_dict (dict): A dictionary of agent history, containing the day, agent, deficit, state, and trading volume of each agent
     """
 
-    def __init__(self, initial_market_price, agents, mode):
+    def __init__(self, initial_market_price, agents, mode, rng=None, history=None, sink=None, profiler=None, curves=None,
+                 order_books=None, active_set=False):
         """Initializes the environment with the initial market price and the agents
         Args:
             initial_market_price (float): The initial market price
-            agents (list): A list of agents
+            agents (list or AgentPopulation): A list of agents or an AgentPopulation, which updates all agents at once
             mode (str): The mode of the environment. Can be "buyer_preferred" or "seller_preferred". 
                 Buyer preferred means that the buyers are prioritized in the trade (random buyer chooses cheapest seller), 
                 while seller preferred means that the sellers are prioritized in the trade (random seller chooses highest paying buyer).
+            rng (np.random.Generator): The random number generator of the simulation (see random_streams.make_rng()).
+                The tiebreak generator is spawned from it, so a run is reproducible no matter how many runs share the process.
+            history (HistoryRecorder): The recorder for the simulation history, e.g. to sample the agent history.
+                Defaults to a recorder that records every agent on every day.
+            sink (HistorySink): Sink to stream the history to disk in batches during the run (see history_sinks.make_sink()).
+                Call close() at the end of the run to flush the remaining records.
+            profiler (Profiler): Profiler for the phases of every day (see profiling.Profiler), None disables profiling.
+            curves (CurveRecorder): Recorder for deferred plotting (see plotting.CurveRecorder). The curves of the days
+                it selects and of the days updated with plot=True are captured as arrays instead of being plotted,
+                so the simulation never calls matplotlib. None plots the days updated with plot=True right away.
+            order_books (OrderBookStore): Store for the sorted order book of every day (see order_book_store.OrderBookStore),
+                so the books and clearing prices of any day can be analysed after the run.
+            active_set (bool): Whether to skip the daily update of agents that provably stay idle until the end of the year
+                (see CompanyAgent.stays_idle()), so mostly idle runs cost time proportional to the active agents. Skipped agents
+                are advanced when the year ends or wake_agents() is called, the results are the same as without skipping.
+                Combine it with HistoryRecorder(changes_only=True), so the skipped agents are not tracked every day either.
+                Only used with a list of agents, an AgentPopulation always updates all agents in one vectorized pass.
         """
         self.market_price = initial_market_price
         self.agents = agents
-
-        self.daily_offers = []
-        self.daily_demands = []
-        self.trade_history_daily = []
-        self.market_price_history = []
-
-        self.trade_hist_dict = {"day": [],
-                                "trade_price": [], "trade_amount": []}
-        self.market_hist_dict = {"day": [], "market_price": []}
-        self.agent_hist_dict = {"day": [],
-                                "deficit": [], "state": [], "count": []}
-
+        self.population = agents if isinstance(agents, AgentPopulation) else None
+        self.year = 0
+        self.day_offset = 0
+        self.issued_allowances = float(np.sum(self.population.allowance)) if self.population is not None else float(sum(agent.allowance for agent in agents))
+        self.rng = make_rng(rng)
+        self.tiebreak_rng = self.rng.spawn(1)[0]
+
+        self.order_book = OrderBook(len(agents))
+
+        self.history = history if history is not None else HistoryRecorder()
+        if sink is not None:
+            self.history.sink = sink
+        self.profiler = profiler
+        self.curves = curves
+        self.order_books = order_books
+
+        self.active_set = active_set and self.population is None
+        self.active_ids = list(range(len(agents)))
+        self.dormant_ids = []
+        self.unrecorded_ids = []
+        self.agent_day = self.population.day if self.population is not None else self.agents[0].day
+        self.update_prices = {}
+
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        '''Sets the trading mode, used by update(). Can be changed during a simulation, e.g. in a forked branch.
+        Args:
+            mode (str): "buyer_preferred" or "seller_preferred", see __init__().
+        '''
         if mode == "buyer_preferred":
             self.update = self.update_buyer_preferred
         elif mode == "seller_preferred":
@@ -48,68 +102,44 @@ class Environment:
         else:
             raise Exception("Mode not supported")
 
-    def cartesian_product(self, *arrays):
-        '''
-        Returns the cartesian product of the input arrays.
-        '''
-        la = len(arrays)
-        dtype = np.result_type(*arrays)
-        arr = np.empty([len(a) for a in arrays] + [la], dtype=dtype)
-        for i, a in enumerate(np.ix_(*arrays)):
-            arr[..., i] = a
-        return arr.reshape(-1, la)
-
     def calculate_market_price(self, plot=False):
         '''
         Calculates the market price based on the intersection between the supply and demand curves.
         Args:
-            plot (bool): Whether to plot the supply and demand curves.'''
-
-        demands = None
-        if len(self.daily_demands) > 0 and len(self.daily_offers) > 0:
-            # Sort demands in descending order. Each entry in demand is a tuple of (price, quantity).
-            self.daily_demands = np.array(self.daily_demands)
-            sort_idx = np.argsort(self.daily_demands[:, 0])[::-1]
-            self.daily_demands[:, 0] = self.daily_demands[:, 0][sort_idx]
-            self.daily_demands[:, 1] = self.daily_demands[:, 1][sort_idx]
-
-            # Sort offers in ascending order
-            self.daily_offers = np.array(self.daily_offers)
-            sort_idx = np.argsort(self.daily_offers[:, 0])
-            self.daily_offers[:, 0] = self.daily_offers[:, 0][sort_idx]
-            self.daily_offers[:, 1] = self.daily_offers[:, 1][sort_idx]
-
-            # Get the demand and supply curves by taking the cumulative sum of the quantities.
-            demands = self.daily_demands
-            demands[:, 1] = np.cumsum(demands[:, 1])
-            offers = self.daily_offers
-            offers[:, 1] = np.cumsum(offers[:, 1])
+            plot (bool): Whether to plot the supply and demand curves (or capture them with the curve recorder).'''
 
+        # demand curve in descending and supply curve in ascending price order, with cumulative quantities
+        demands, offers = self.order_book.curves()
+        two_sided = demands is not None and offers is not None
+        if two_sided:
             # Calculate the intersection of the supply and demand curves.
-            prices = self.cartesian_product(offers[:, 0], demands[:, 0])
-            quantities = self.cartesian_product(offers[:, 1], demands[:, 1])
-            potential_intersection_indices = np.argwhere(
-                (prices[:, 0] <= prices[:, 1]) & (quantities[:, 0] < quantities[:, 1]))
+            intersection_price = clearing_price(offers[:, 0], offers[:, 1], demands[:, 0], demands[:, 1])
 
             # update market price if an intersection is found, otherwise the old market price is kept.
-            if len(potential_intersection_indices) > 0:
-                intersection_idx = potential_intersection_indices[-1]
-                intersection_price = (
-                    prices[intersection_idx, 0] + prices[intersection_idx, 1]) / 2
-                self.market_price = intersection_price[0]
-
-        self.market_hist_dict["market_price"].append(self.market_price)
-        self.market_hist_dict["day"].append(self.agents[0].day)
-
-        if plot and demands is not None:
-            self.get_supply_demand_plot(demands, offers)
+            if intersection_price is not None:
+                self.market_price = intersection_price
+
+        self.history.record_market(self.day, self.market_price)
+        if self.order_books is not None:
+            # empty sides are stored empty, so every day is indexed and one-sided books are kept
+            self.order_books.append(self.day, demands, offers, self.market_price)
+
+        if two_sided:
+            if self.curves is not None:
+                if plot or self.curves.selects(self.day):
+                    self.curves.record(self.day, demands, offers, self.market_price)
+            elif plot:
+                with self.phase("plot"):
+                    self.get_supply_demand_plot(demands, offers)
 
     def get_supply_demand_plot(self, demands, offers):
         '''
         Plots the supply and demand curves and the efficient market price.
+        pyplot is only imported here, so headless runs never load matplotlib.
         '''
+        from matplotlib import pyplot as plt
         plt.figure(figsize=(5, 3))
-        plt.title(f"Supply and Demand Curves, Day: {self.agents[0].day}")
+        plt.title(f"Supply and Demand Curves, Day: {self.day}")
         plt.step(demands[:, 1], demands[:, 0], label="Demand")
         plt.step(offers[:, 1], offers[:, 0], label="Supply")
         plt.axhline(self.market_price, color="black",
@@ -134,20 +164,306 @@ class Environment:
         buyer.buy_allowance(trade_amount)
         seller.sell_allowance(trade_amount)
 
-        self.trade_history_daily.append((price, trade_amount))
-        self.trade_hist_dict["day"].append(self.agents[0].day)
-        self.trade_hist_dict["trade_price"].append(price)
-        self.trade_hist_dict["trade_amount"].append(trade_amount)
+        self.history.record_trade(self.day, price, trade_amount)
+
+    @property
+    def day(self):
+        if self.population is not None:
+            return self.day_offset + self.population.day
+        return self.day_offset + (self.agent_day if self.active_set else self.agents[0].day)
+
+    def phase(self, name):
+        '''Returns the context of a profiled phase of the current day (see profiling.Profiler.phase()).
+        Does nothing if profiling is disabled.
+        Args:
+            name (str): The name of the phase.
+        '''
+        if self.profiler is None:
+            return NO_PHASE
+        return self.profiler.phase(name, lambda: self.day)
 
-    def track_agent_state(self, agent):
-        '''Tracks the state of the agent and saves it to the agent history.
+    def count(self, name, value):
+        '''Records a counter of the current day (e.g. the number of trades) if profiling is enabled.
         Args:
-            agent (Agent): The agent to track.
+            name (str): The name of the counter.
+            value (float): The value.
         '''
-        self.agent_hist_dict["day"].append(agent.day)
-        self.agent_hist_dict["deficit"].append(agent.expected_deficit)
-        self.agent_hist_dict["state"].append(agent.state)
-        self.agent_hist_dict["count"].append(agent.count)
+        if self.profiler is not None:
+            self.profiler.count(name, value, self.day)
+
+    def end_compliance_year(self, banking=True):
+        '''Tracks the final agent states of the current compliance year and records the surrender of allowances
+        for the emissions of the year in the compliance history.
+        Args:
+            banking (bool): Whether agents can carry a surplus of allowances into the next year.
+        '''
+        self.wake_agents()
+        self.track_agents_state()
+        if self.population is not None:
+            emissions = self.population.total_emission
+            balance = self.population.allowance - emissions
+        else:
+            emissions = np.array([agent.total_emission for agent in self.agents], dtype=float)
+            balance = np.array([agent.allowance for agent in self.agents], dtype=float) - emissions
+        self.history.record_compliance(self.year, self.day, np.sum(emissions), self.issued_allowances,
+                                       np.sum(np.maximum(balance, 0)) if banking else 0.0,
+                                       np.sum(np.maximum(-balance, 0)), self.market_price)
+
+    def set_year_length(self, year_length):
+        '''Sets the number of days of the current compliance year before its first day (see CompanyAgent.set_year_length()),
+        start_compliance_year() sets it for the following years.
+        Args:
+            year_length (int): The number of days of the year.
+        '''
+        if self.population is not None:
+            self.population.set_year_length(year_length)
+        else:
+            for agent in self.agents:
+                agent.set_year_length(year_length)
+
+    def start_compliance_year(self, allocation, banking=True, year_length=DAYS_PER_YEAR):
+        '''Ends the current compliance year (see end_compliance_year()) and starts the next one: the agents surrender
+        allowances for their emissions and receive the new free allocation. Agents keep their emission rates, abatements,
+        and price expectations, the day counter of the history continues.
+        Args:
+            allocation (float or np.ndarray): The free allocation of the new year, scalar or one value per agent.
+            banking (bool): Whether agents can carry a surplus of allowances into the new year.
+            year_length (int): The number of days of the new year.
+        '''
+        self.end_compliance_year(banking)
+
+        # day 0 of the new year follows the last day of the finished year
+        self.day_offset = self.day + 1
+        self.year += 1
+        allocation = np.broadcast_to(np.asarray(allocation, dtype=float), (len(self.agents),))
+        self.issued_allowances = float(np.sum(allocation))
+        if self.population is not None:
+            self.population.start_compliance_year(allocation, banking, year_length)
+        else:
+            for agent, agent_allocation in zip(self.agents, allocation.tolist()):
+                agent.start_compliance_year(agent_allocation, banking, year_length)
+            self.agent_day = 0
+            self.update_prices = {}
+
+    @property
+    def trade_hist_dict(self):
+        return self.history.trades.columns()
+
+    @property
+    def market_hist_dict(self):
+        return self.history.market.columns()
+
+    @property
+    def agent_hist_dict(self):
+        return self.history.agents.columns()
+
+    def close(self):
+        '''Flushes the remaining history to the sink and closes it. Does nothing if the history is kept in memory.
+        Flushes the order book store.
+        '''
+        self.history.close()
+        if self.order_books is not None:
+            self.order_books.flush()
+
+    def track_agents_state(self):
+        '''Tracks the state of all agents selected by the history recorder and saves it to the agent history.
+        '''
+        day = self.day
+        if not self.history.samples_day(day):
+            return
+        if self.active_set and self.history.changes_only:
+            # dormant agents do not change anymore, once they were tracked in their dormant state
+            agent_ids = np.array(sorted(self.active_ids + self.unrecorded_ids), dtype=np.int64)
+            if self.history.agent_ids is not None:
+                agent_ids = np.intersect1d(self.history.agent_ids, agent_ids)
+            self.unrecorded_ids = []
+        else:
+            agent_ids = self.history.sampled_agents(len(self.agents))
+        if self.population is not None:
+            population = self.population
+            self.history.record_agents(day, agent_ids, population.expected_deficit[agent_ids],
+                                       population.state_code[agent_ids], population.count[agent_ids])
+        else:
+            agents = [self.agents[i] for i in agent_ids]
+            self.history.record_agents(day, agent_ids, [agent.expected_deficit for agent in agents],
+                                       [STATE_CODES[agent.state] for agent in agents], [agent.count for agent in agents])
+
+    def book_orders(self, buyers, sellers):
+        '''Puts the orders of the buying and selling agents of the day into the order book.
+        Args:
+            buyers (list): The (agent id, agent) pairs of the buying agents, in ascending order of agent ids.
+            sellers (list): The (agent id, agent) pairs of the selling agents, in ascending order of agent ids.
+        '''
+        for side, orders in ((BUY, buyers), (SELL, sellers)):
+            self.order_book.update(side, [agent_id for agent_id, _ in orders], [agent.trade_price for _, agent in orders],
+                                   [agent.count for _, agent in orders])
+        self.count("book_repairs", self.order_book.repaired)
+
+    def update_agents(self):
+        '''Tracks and updates the internal state of all agents (based on emissions, allowances, prices, etc.)
+        and puts their orders into the order book.
+        Returns:
+            tuple: (buyers, sellers), the lists of (agent id, agent) pairs of the agents that want to buy and sell today.
+                The agent id is the position of the agent in the agent list.
+        '''
+        if self.active_set:
+            return self.update_active_agents()
+        buyers = []
+        sellers = []
+        with self.phase("track_history"):
+            self.track_agents_state()
+
+        # draw the random numbers of the day for all agents at once
+        emission_shocks = self.rng.standard_normal(len(self.agents))
+        trade_draws = self.rng.random(len(self.agents))
+
+        for agent_id, (agent, emission_shock, trade_draw) in enumerate(zip(self.agents, emission_shocks.tolist(), trade_draws.tolist())):
+            agent.update_agent(self.market_price, emission_shock, trade_draw)
+            if agent.state == "buy":
+                buyers.append((agent_id, agent))
+            elif agent.state == "sell":
+                sellers.append((agent_id, agent))
+        self.book_orders(buyers, sellers)
+        return buyers, sellers
+
+    def update_active_agents(self):
+        '''Like update_agents(), but only updates the active agents. Agents that provably stay idle until the end of the year
+        (see CompanyAgent.stays_idle()) become dormant and are skipped until wake_agents() is called.
+        The random numbers of the day are drawn for all agents, so the random stream is the same as without skipping.
+        Returns:
+            tuple: (buyers, sellers), see update_agents().
+        '''
+        buyers = []
+        sellers = []
+        with self.phase("track_history"):
+            self.track_agents_state()
+
+        emission_shocks = self.rng.standard_normal(len(self.agents)).tolist()
+        trade_draws = self.rng.random(len(self.agents)).tolist()
+        self.agent_day += 1
+        self.update_prices[self.agent_day] = self.market_price
+
+        active_ids = []
+        for agent_id in self.active_ids:
+            agent = self.agents[agent_id]
+            agent.update_agent(self.market_price, emission_shocks[agent_id], trade_draws[agent_id])
+            if agent.state == "buy":
+                buyers.append((agent_id, agent))
+            elif agent.state == "sell":
+                sellers.append((agent_id, agent))
+            elif agent.stays_idle():
+                self.dormant_ids.append(agent_id)
+                self.unrecorded_ids.append(agent_id)
+                continue
+            active_ids.append(agent_id)
+        self.active_ids = active_ids
+        self.count("active_agents", len(active_ids))
+        self.book_orders(buyers, sellers)
+        return buyers, sellers
+
+    def wake_agents(self):
+        '''Advances the dormant agents to the current day (see CompanyAgent.catch_up()) and updates them daily again.
+        Called at the end of every compliance year, call it before reading the agent states during or after a run.
+        '''
+        if not self.dormant_ids:
+            return
+        for agent_id in self.dormant_ids:
+            self.agents[agent_id].catch_up(self.agent_day, self.update_prices)
+        self.active_ids = sorted(self.active_ids + self.dormant_ids)
+        self.dormant_ids = []
+
+    def update_population_agents(self):
+        '''Tracks and updates the internal state of all agents of the population at once
+        and puts their orders into the order book.
+        Returns:
+            tuple: (buying, selling), the ids of the agents that want to buy and sell today.
+        '''
+        population = self.population
+        with self.phase("track_history"):
+            self.track_agents_state()
+
+        # draw the random numbers of the day for all agents at once
+        emission_shocks = self.rng.standard_normal(population.size)
+        trade_draws = self.rng.random(population.size)
+
+        population.update(self.market_price, emission_shocks, trade_draws)
+        buying = np.flatnonzero(population.state_code == BUY)
+        selling = np.flatnonzero(population.state_code == SELL)
+        self.order_book.update(BUY, buying, population.trade_price[buying], population.count[buying])
+        self.order_book.update(SELL, selling, population.trade_price[selling], population.count[selling])
+        self.count("book_repairs", self.order_book.repaired)
+        return buying, selling
+
+    def match_population(self, buying, selling, queue_side):
+        '''Matches the orders of the population with the vectorized matching engine (market_clearing.match_orders).
+        The agents on the queue side are taken in the order of the order book with the daily tiebreaks for equal prices
+        (price, daily tiebreak, agent id, like the matching queues of the agent lists),
+        the other side arrives in random order. Allowances and counters are updated with np.add.at,
+        agents with remaining counts are tracked as failed sales/buys.
+        Args:
+            buying (np.ndarray): The ids of the buying agents.
+            selling (np.ndarray): The ids of the selling agents.
+            queue_side (str): "buy" in seller preferred mode (sellers choose from the buyers), "sell" in buyer preferred mode.
+        Returns:
+            np.ndarray: The trades of the day as structured array (TRADE_DTYPE) in the order they happen.
+        '''
+        population = self.population
+        if queue_side == "buy":
+            queue, arrivals, side = buying, selling, BUY
+        else:
+            queue, arrivals, side = selling, buying, SELL
+
+        queue = self.order_book.priority(side, self.tiebreak_rng.random(len(queue)))
+        arrivals = arrivals[self.rng.permutation(len(arrivals))]
+
+        fills, _, _ = match_orders(population.trade_price[queue], population.count[queue],
+                                   population.trade_price[arrivals], population.count[arrivals], queue_side)
+
+        trades = np.empty(len(fills), dtype=TRADE_DTYPE)
+        trades["buyer"] = queue[fills["queue"]] if queue_side == "buy" else arrivals[fills["arrival"]]
+        trades["seller"] = arrivals[fills["arrival"]] if queue_side == "buy" else queue[fills["queue"]]
+        trades["price"] = fills["price"]
+        trades["amount"] = fills["amount"]
+
+        population.trade(trades["buyer"], trades["seller"], trades["amount"])
+
+        # agents with remaining counts failed to buy/sell, influences price expectations
+        population.failed_buy(buying[population.count[buying] > 0])
+        population.failed_sell(selling[population.count[selling] > 0])
+
+        self.count("trades", len(trades))
+        self.history.record_trades(self.day, trades["price"], trades["amount"])
+        return trades
+
+    def end_day(self, plot=False):
+        '''Updates the market price from the order book of the day.
+        Args:
+            plot (bool): Whether to plot the supply and demand curves. Passed to calculate_market_price().
+        '''
+        with self.phase("market_price"):
+            self.calculate_market_price(plot=plot)
+
+    def count_orders(self, buy_orders, sell_orders):
+        '''Records the order book size of the current day if profiling is enabled.
+        Args:
+            buy_orders (int): The number of buy orders.
+            sell_orders (int): The number of sell orders.
+        '''
+        self.count("buy_orders", buy_orders)
+        self.count("sell_orders", sell_orders)
+
+    def matching_queue(self, agents, side):
+        '''Returns the agents of one side of the order book in matching priority: best price first, agents with the same price
+        in the random order of tiebreaks drawn once per agent and day from the separate tiebreak generator, then by agent id.
+        The book is already sorted by price, so only the agents with equal prices are ordered.
+        Args:
+            agents (list): The (agent id, agent) pairs of the side, in ascending order of agent ids.
+            side (int): BUY (highest price first) or SELL (lowest price first).
+        Returns:
+            list: The agents in matching priority.
+        '''
+        tiebreaks = self.tiebreak_rng.random(len(agents))
+        return [self.agents[agent_id] for agent_id in self.order_book.priority(side, tiebreaks).tolist()]
 
     def update_seller_preferred(self, plot=False):
         '''Updates the environment in seller preferred mode. 
@@ -157,46 +473,63 @@ class Environment:
         Args:
             plot (bool): Whether to plot the supply and demand curves. Passed to calculate_market_price().'''
 
-        buyer_heap = []  # adds buyers in descending order of trade price
-        seller_list = []  # add selling agents
+        # update internal agent state (based on emissions, allowances, prices, etc.) and match the orders
+        if self.population is not None:
+            with self.phase("update_agents"):
+                buying, selling = self.update_population_agents()
+            self.count_orders(len(buying), len(selling))
+            with self.phase("matching"):
+                self.match_population(buying, selling, queue_side="buy")
+        else:
+            with self.phase("update_agents"):
+                buyers, sellers = self.update_agents()
+            self.count_orders(len(buyers), len(sellers))
+            with self.phase("matching"):
+                self.match_seller_preferred(buyers, sellers)
+
+        # update market price and reset daily offers and demands
+        self.end_day(plot=plot)
 
-        # update internal agent state (based on emissions, allowances, prices, etc.) and add to the respective lists
-        for agent in self.agents:
-            self.track_agent_state(agent)
-            agent.update_agent(self.market_price)
-            if agent.state == "sell":
-                self.daily_offers.append((agent.trade_price, agent.count))
-                seller_list.append(agent)
-            elif agent.state == "buy":
-                self.daily_demands.append((agent.trade_price, agent.count))
-                heapq.heappush(buyer_heap, (-agent.trade_price, agent))
+    def match_seller_preferred(self, buyers, sellers):
+        '''Matches the orders of the agents in seller preferred mode: the sellers arrive in random order
+        and sell to the highest paying buyers.
+        Args:
+            buyers (list): The (agent id, agent) pairs of the buying agents.
+            sellers (list): The (agent id, agent) pairs of the selling agents.
+        '''
+        buyer_queue = self.matching_queue(buyers, BUY)  # buyers in descending order of trade price
+        best = 0
+        seller_list = [seller for _, seller in sellers]
 
         # shuffle the seller list to randomize the order of sellers
-        random.shuffle(seller_list)
+        self.rng.shuffle(seller_list)
 
         # iterate through the sellers and assign best possible buyer.
+        trades = 0
+        pushes = 0
         for seller in seller_list:
             buyer = None
-            while len(buyer_heap) > 0 and seller.trade_price <= (-1)*buyer_heap[0][0] and seller.count > 0:
-                trade_price, buyer = heapq.heappop(buyer_heap)
+            while best < len(buyer_queue) and seller.trade_price <= buyer_queue[best].trade_price and seller.count > 0:
+                buyer = buyer_queue[best]
+                best += 1
                 self.trade(buyer, seller, trade_price=buyer.trade_price)
+                trades += 1
 
             # if seller still has allowances left => failed to sell, influences price expectations
             if seller.count > 0:
                 seller.failed_sell()
 
-            # if last checked buyer still has demand => re-add remaining volume to heap
+            # if last checked buyer still has demand => it stays the best buyer for the remaining volume
             if buyer is not None and buyer.count > 0:
-                heapq.heappush(buyer_heap, (-buyer.trade_price, buyer))
+                best -= 1
+                pushes += 1
 
         # if there are still buyers left, they failed to buy, influences price expectations
-        for buyer in buyer_heap:
-            buyer[1].failed_buy()
+        for buyer in buyer_queue[best:]:
+            buyer.failed_buy()
 
-        # update market price and reset daily offers and demands
-        self.calculate_market_price(plot=plot)
-        self.daily_offers = []
-        self.daily_demands = []
+        self.count("trades", trades)
+        self.count("queue_operations", trades + pushes)
 
     def update_buyer_preferred(self, plot=False):
         '''Updates the environment in buyer preferred mode. 
@@ -206,43 +539,60 @@ class Environment:
         Args:
             plot (bool): Whether to plot the supply and demand curves. Passed to calculate_market_price().
         '''
-        seller_heap = []  # adds sellers in ascending order of trade price
-        buyer_list = []  # add buying agents
+        # update internal agent state (based on emissions, allowances, prices, etc.) and match the orders
+        if self.population is not None:
+            with self.phase("update_agents"):
+                buying, selling = self.update_population_agents()
+            self.count_orders(len(buying), len(selling))
+            with self.phase("matching"):
+                self.match_population(buying, selling, queue_side="sell")
+        else:
+            with self.phase("update_agents"):
+                buyers, sellers = self.update_agents()
+            self.count_orders(len(buyers), len(sellers))
+            with self.phase("matching"):
+                self.match_buyer_preferred(buyers, sellers)
 
-        # update internal agent state (based on emissions, allowances, prices, etc.) and add to the respective lists
-        for agent in self.agents:
-            self.track_agent_state(agent)
-            agent.update_agent(self.market_price)
-            if agent.state == "buy":
-                self.daily_demands.append((agent.trade_price, agent.count))
-                buyer_list.append(agent)
-            elif agent.state == "sell":
-                self.daily_offers.append((agent.trade_price, agent.count))
-                heapq.heappush(seller_heap, (agent.trade_price, agent))
+        # update market price and reset daily offers and demands
+        self.end_day(plot=plot)
+
+    def match_buyer_preferred(self, buyers, sellers):
+        '''Matches the orders of the agents in buyer preferred mode: the buyers arrive in random order
+        and buy from the cheapest sellers.
+        Args:
+            buyers (list): The (agent id, agent) pairs of the buying agents.
+            sellers (list): The (agent id, agent) pairs of the selling agents.
+        '''
+        seller_queue = self.matching_queue(sellers, SELL)  # sellers in ascending order of trade price
+        best = 0
+        buyer_list = [buyer for _, buyer in buyers]
 
         # shuffle the buyer list to randomize the order of buyers
-        random.shuffle(buyer_list)
+        self.rng.shuffle(buyer_list)
 
         # iterate through the buyers and assign best possible seller.
+        trades = 0
+        pushes = 0
         for buyer in buyer_list:
             seller = None
-            while len(seller_heap) > 0 and buyer.trade_price >= seller_heap[0][0] and buyer.count > 0:
-                trade_price, seller = heapq.heappop(seller_heap)
+            while best < len(seller_queue) and buyer.trade_price >= seller_queue[best].trade_price and buyer.count > 0:
+                seller = seller_queue[best]
+                best += 1
                 self.trade(buyer, seller, trade_price=seller.trade_price)
+                trades += 1
 
             # if buyer still has demand => failed to buy, influences price expectations
             if buyer.count > 0:
                 buyer.failed_buy()
 
-            # if last checked seller still has allowances left => re-add remaining volume to heap
+            # if last checked seller still has allowances left => it stays the best seller for the remaining volume
             if seller is not None and seller.count > 0:
-                heapq.heappush(seller_heap, (seller.trade_price, seller))
+                best -= 1
+                pushes += 1
 
         # if there are still sellers left, they failed to sell => influences price expectations
-        for seller in seller_heap:
-            seller[1].failed_sell()
+        for seller in seller_queue[best:]:
+            seller.failed_sell()
 
-        # update market price and reset daily offers and demands
-        self.calculate_market_price(plot=plot)
-        self.daily_offers = []
-        self.daily_demands = []
+        self.count("trades", trades)
+        self.count("queue_operations", trades + pushes)
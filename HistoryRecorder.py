@@ -0,0 +1,333 @@
+import numpy as np
+import pandas as pd
+from AgentPopulation import STATES
+
+
+class ColumnTable:
+    """A table of preallocated NumPy columns that grows in chunks.
+    Filled rows are never overwritten: growing copies the columns to new buffers and clear() starts new buffers,
+    so the views returned by raw_columns(), columns(), and to_frame() keep their values.
+    Properties:
+        dtypes (dict): The dtype of each column.
+        categories (dict): Categories of columns that store category codes, used to decode them in columns() and to_frame().
+        chunk_size (int): The minimum number of rows the table grows by.
+        length (int): The number of rows in the table.
+        capacity (int): The number of preallocated rows.
+    """
+
+    def __init__(self, dtypes, categories=None, chunk_size=65536):
+        """Initializes an empty table.
+        Args:
+            dtypes (dict): The name and dtype of each column.
+            categories (dict): Categories of columns that store category codes.
+            chunk_size (int): The minimum number of rows the table grows by.
+        """
+        self.dtypes = dtypes
+        self.categories = categories if categories is not None else {}
+        self.chunk_size = chunk_size
+        self.length = 0
+        self.capacity = 0
+        self.data = {name: np.empty(0, dtype=dtype) for name, dtype in dtypes.items()}
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        '''
+        Only the filled rows are pickled (e.g. in checkpoints), the table grows again on the next append.
+        '''
+        state = self.__dict__.copy()
+        state["data"] = {name: column[:self.length] for name, column in self.data.items()}
+        state["capacity"] = self.length
+        return state
+
+    def reserve(self, rows):
+        '''
+        Makes sure there is space for the given number of additional rows.
+        Grows by at least one chunk and at least doubles the capacity, so appending is amortized O(1).
+        '''
+        needed = self.length + rows
+        if needed <= self.capacity:
+            return
+        self.capacity = max(needed, self.capacity + self.chunk_size, 2 * self.capacity)
+        for name, column in self.data.items():
+            grown = np.empty(self.capacity, dtype=column.dtype)
+            grown[:self.length] = column[:self.length]
+            self.data[name] = grown
+
+    def append(self, **values):
+        '''
+        Appends a single row.
+        '''
+        self.reserve(1)
+        for name, value in values.items():
+            self.data[name][self.length] = value
+        self.length += 1
+
+    def extend(self, **values):
+        '''
+        Appends many rows at once. Scalars are broadcast to the length of the array values.
+        '''
+        rows = max(np.size(value) for value in values.values())
+        self.reserve(rows)
+        for name, value in values.items():
+            self.data[name][self.length:self.length + rows] = value
+        self.length += rows
+
+    def clear(self):
+        '''
+        Removes all rows. New buffers are allocated on the next append, views of the removed rows (e.g. a frame taken
+        before a flush to a sink) keep their values.
+        '''
+        self.length = 0
+        self.capacity = 0
+        self.data = {name: np.empty(0, dtype=column.dtype) for name, column in self.data.items()}
+
+    def raw_columns(self):
+        '''
+        Returns the columns as a dictionary of arrays (views of the preallocated memory, no copy), category columns as codes.
+        The views stay valid after later appends and clear().
+        '''
+        return {name: column[:self.length] for name, column in self.data.items()}
+
+    def columns(self):
+        '''
+        Returns the columns as a dictionary of arrays (views of the preallocated memory, no copy).
+        Category codes are returned as pd.Categorical.
+        '''
+        columns = {}
+        for name, column in self.data.items():
+            column = column[:self.length]
+            if name in self.categories:
+                column = pd.Categorical.from_codes(column, categories=self.categories[name])
+            columns[name] = column
+        return columns
+
+    def to_frame(self):
+        '''
+        Returns the table as a pandas DataFrame without copying the columns. The frame shares the memory of the table,
+        its values do not change with later appends or clear().
+        '''
+        return pd.DataFrame(self.columns(), copy=False)
+
+
+class HistoryRecorder:
+    """The history recorder stores the trade, market, agent, and compliance history of a simulation in preallocated columns.
+    The agent history can be sampled to reduce memory further, or run-length encoded (changes_only): an agent is only
+    recorded when its deficit, state, or count differs from its last recorded row. With a sink, full tables are flushed to disk
+    during the run, so only the rows since the last flush are kept in memory.
+    Properties:
+        trades (ColumnTable): The trade history (day, trade_price, trade_amount)
+        market (ColumnTable): The market price history (day, market_price)
+        agents (ColumnTable): The agent history (day, agent, deficit, state, count), states are stored as int8 codes
+        compliance (ColumnTable): The yearly compliance history (year, day, emissions, allocation, banked, shortfall, market_price)
+        every (int): The agent history is recorded every `every` days
+        agent_ids (np.ndarray): The ids of the agents to record, None to record all agents
+        changes_only (bool): Whether the agent history only records changes (see agent_frame() to expand it to every day)
+        agent_days (list): The days the agent states were recorded on (with changes_only)
+        last_agents (ColumnTable): The last recorded row of every agent by agent id (with changes_only)
+        sink (HistorySink): The sink the tables are flushed to, None to keep the whole history in memory
+        flush_rows (int): The number of rows after which a table is flushed to the sink
+    """
+
+    def __init__(self, every=1, agent_ids=None, chunk_size=65536, sink=None, flush_rows=1000000, changes_only=False):
+        """Initializes an empty history.
+        Args:
+            every (int): Record the agent states every `every` days.
+            agent_ids (list): The ids (positions in the agent list) of the agents to record. None records all agents.
+            chunk_size (int): The minimum number of rows the tables grow by.
+            sink (HistorySink): The sink to flush the tables to, see history_sinks.make_sink().
+            flush_rows (int): The number of rows after which a table is flushed to the sink.
+            changes_only (bool): Whether to record an agent only when its deficit, state, or count changed since its last row.
+                Agents that stay idle then cost no rows, agent_frame(expand=True) restores the full daily history.
+        """
+        self.every = every
+        self.sink = sink
+        self.flush_rows = flush_rows
+        self.agent_ids = None if agent_ids is None else np.asarray(agent_ids, dtype=np.int64)
+
+        # float64 amounts, EU-scale volumes need more than the 7 significant digits of float32
+        self.trades = ColumnTable({"day": np.int32, "trade_price": np.float32, "trade_amount": np.float64}, chunk_size=chunk_size)
+        self.market = ColumnTable({"day": np.int32, "market_price": np.float64}, chunk_size=chunk_size)
+        self.agents = ColumnTable({"day": np.int32, "agent": np.int32, "deficit": np.float32, "state": np.int8, "count": np.int32},
+                                  categories={"state": STATES}, chunk_size=chunk_size)
+        self.changes_only = changes_only
+        self.agent_days = []
+        # the last row of every agent, indexed by agent id, state -1 marks agents that were not recorded yet
+        self.last_agents = ColumnTable({"deficit": np.float32, "state": np.int8, "count": np.int32}, chunk_size=chunk_size)
+        self.compliance = ColumnTable({"year": np.int32, "day": np.int32, "emissions": np.float64, "allocation": np.float64,
+                                       "banked": np.float64, "shortfall": np.float64, "market_price": np.float64}, chunk_size=16)
+
+    def samples_day(self, day):
+        '''
+        Returns whether the agent states of the given day are recorded.
+        '''
+        return day % self.every == 0
+
+    def sampled_agents(self, agent_count):
+        '''
+        Returns the ids of the agents that are recorded.
+        '''
+        if self.agent_ids is None:
+            return np.arange(agent_count)
+        return self.agent_ids
+
+    def record_trade(self, day, trade_price, trade_amount):
+        '''
+        Records a single trade.
+        '''
+        self.trades.append(day=day, trade_price=trade_price, trade_amount=trade_amount)
+        self.flush_if_full("trades")
+
+    def record_trades(self, day, trade_prices, trade_amounts):
+        '''
+        Records many trades of the same day.
+        '''
+        if len(trade_prices) == 0:
+            return
+        self.trades.extend(day=day, trade_price=trade_prices, trade_amount=trade_amounts)
+        self.flush_if_full("trades")
+
+    def record_market(self, day, market_price):
+        '''
+        Records the market price of a day.
+        '''
+        self.market.append(day=day, market_price=market_price)
+        self.flush_if_full("market")
+
+    def record_agents(self, day, agent_ids, deficit, state, count):
+        '''
+        Records the states of many agents of the same day.
+        Args:
+            day (int): The day.
+            agent_ids (np.ndarray): The ids of the agents.
+            deficit (np.ndarray): The expected deficits.
+            state (np.ndarray): The state codes (IDLE, BUY, SELL).
+            count (np.ndarray): The number of allowances to buy or sell.
+        '''
+        if self.changes_only:
+            agent_ids, deficit, state, count = self.changed_agents(day, agent_ids, deficit, state, count)
+            if len(agent_ids) == 0:
+                return
+        self.agents.extend(day=day, agent=agent_ids, deficit=deficit, state=state, count=count)
+        self.flush_if_full("agents")
+
+    def changed_agents(self, day, agent_ids, deficit, state, count):
+        '''
+        Returns the rows of the agents whose recorded values (after conversion to the column types) changed since their last row,
+        and remembers them as their last rows. Agents that are not passed are treated as unchanged.
+        '''
+        self.agent_days.append(day)
+        agent_ids = np.asarray(agent_ids, dtype=np.int64)
+        last = self.last_agents
+        if len(agent_ids) > 0 and agent_ids.max() >= len(last):
+            new_rows = int(agent_ids.max()) + 1 - len(last)
+            last.extend(deficit=np.zeros(new_rows), state=np.full(new_rows, -1), count=np.zeros(new_rows))
+        deficit = np.asarray(deficit, dtype=np.float32)
+        state = np.asarray(state, dtype=np.int8)
+        count = np.asarray(count, dtype=np.int32)
+
+        columns = last.raw_columns()
+        changed = ((columns["state"][agent_ids] != state) | (columns["deficit"][agent_ids] != deficit)
+                   | (columns["count"][agent_ids] != count))
+        agent_ids, deficit, state, count = agent_ids[changed], deficit[changed], state[changed], count[changed]
+        columns["deficit"][agent_ids] = deficit
+        columns["state"][agent_ids] = state
+        columns["count"][agent_ids] = count
+        return agent_ids, deficit, state, count
+
+    def record_compliance(self, year, day, emissions, allocation, banked, shortfall, market_price):
+        '''
+        Records the surrender at the end of a compliance year.
+        Args:
+            year (int): The number of the compliance year (0 for the first year).
+            day (int): The last day of the year.
+            emissions (float): The total emissions of all agents in the year.
+            allocation (float): The total allowances issued for the year.
+            banked (float): The total surplus carried into the next year.
+            shortfall (float): The total allowances missing at the surrender.
+            market_price (float): The market price at the end of the year.
+        '''
+        self.compliance.append(year=year, day=day, emissions=emissions, allocation=allocation, banked=banked,
+                               shortfall=shortfall, market_price=market_price)
+        self.flush_if_full("compliance")
+
+    def tables(self):
+        '''
+        Returns the tables by name.
+        '''
+        return {"trades": self.trades, "market": self.market, "agents": self.agents, "compliance": self.compliance}
+
+    def flush_if_full(self, name):
+        '''
+        Flushes the table to the sink if it holds at least flush_rows rows.
+        '''
+        if self.sink is not None and len(getattr(self, name)) >= self.flush_rows:
+            self.flush(name)
+
+    def flush(self, name=None):
+        '''
+        Writes the rows of a table (or of all tables if name is None) to the sink and removes them from memory.
+        '''
+        if self.sink is None:
+            return
+        for table_name, table in self.tables().items():
+            if name is None or name == table_name:
+                self.sink.write(table_name, table.raw_columns(), table.categories)
+                table.clear()
+
+    def close(self):
+        '''
+        Flushes the remaining rows and closes the sink.
+        '''
+        if self.sink is not None:
+            self.flush()
+            self.sink.close()
+
+    def trade_frame(self):
+        '''
+        Returns the trade history as DataFrame.
+        '''
+        return self.trades.to_frame()
+
+    def market_frame(self):
+        '''
+        Returns the market price history as DataFrame.
+        '''
+        return self.market.to_frame()
+
+    def agent_frame(self, expand=False):
+        '''
+        Returns the agent history as DataFrame, the states are returned as categorical column.
+        Args:
+            expand (bool): With changes_only, whether to restore the full history: one row per recorded day and agent
+                (ordered by day and agent) with the values of the last change. Only the rows kept in memory are expanded.
+        '''
+        if not (self.changes_only and expand):
+            return self.agents.to_frame()
+
+        rows = self.agents.raw_columns()
+        days = np.unique(np.asarray(self.agent_days, dtype=np.int64))
+        agents = np.unique(rows["agent"])
+        # rows ordered by (agent, day) and the row of every (agent, day) pair is the last one at or before the day
+        stride = int(days.max()) + 1 if len(days) > 0 else 1
+        keys = rows["agent"].astype(np.int64) * stride + rows["day"]
+        order = np.argsort(keys, kind="stable")
+        grid_agents = np.tile(agents, len(days))
+        grid_days = np.repeat(days, len(agents))
+        positions = np.searchsorted(keys[order], grid_agents * stride + grid_days, side="right") - 1
+        # agents that were not recorded yet on a day have no row there
+        found = positions >= 0
+        found[found] = rows["agent"][order[positions[found]]] == grid_agents[found]
+        source = order[positions[found]]
+        columns = {"day": grid_days[found].astype(np.int32), "agent": grid_agents[found].astype(np.int32)}
+        for name in ("deficit", "state", "count"):
+            columns[name] = rows[name][source]
+        columns["state"] = pd.Categorical.from_codes(columns["state"], categories=self.agents.categories["state"])
+        return pd.DataFrame(columns)
+
+    def compliance_frame(self):
+        '''
+        Returns the yearly compliance history as DataFrame.
+        '''
+        return self.compliance.to_frame()
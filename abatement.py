@@ -0,0 +1,155 @@
+import numpy as np
+from random_streams import make_rng
+
+
+class AbatementCurves:
+    """Abatement cost curves of many agents, generated lazily in blocks of abatement steps.
+    Every curve starts with a gamma distributed value (shape 2.5, scale `scale`), each following step adds a positive increment
+    (normal noise with a variance growing with the step plus uniform noise, clamped to 0), like CompanyAgent.init_abatement_costs().
+    Only the steps up to the largest abatement index in use are generated, which keeps memory low for large populations.
+    Properties:
+        count (int): The number of curves (agents).
+        length (int): The maximum number of abatement steps per curve.
+        active (np.ndarray): Whether the agents can abate, inactive agents have infinite abatement costs.
+        costs (np.ndarray): The generated abatement costs of the active agents, shape (number of active agents, generated steps).
+        block_size (int): The minimum number of steps generated at once.
+        scale (float): The scale of the gamma distribution of the first abatement cost.
+    """
+
+    def __init__(self, count, length=365, rng=None, active=True, block_size=32, scale=30000):
+        """Initializes the curves, only the start values and variance factors are drawn.
+        Args:
+            count (int): The number of curves.
+            length (int): The maximum number of abatement steps per curve.
+            rng (np.random.Generator): The random number generator.
+            active (bool or np.ndarray): Whether the agents can abate.
+            block_size (int): The minimum number of steps generated at once.
+            scale (float): The scale of the gamma distribution of the first abatement cost.
+        """
+        self.rng = make_rng(rng)
+        self.count = count
+        self.length = length
+        self.block_size = block_size
+        self.scale = scale
+        self.active = np.broadcast_to(np.asarray(active, dtype=bool), (count,)).copy()
+        self.rows = np.full(count, -1, dtype=np.int64)
+        self.rows[self.active] = np.arange(self.active.sum())
+
+        active_count = int(self.active.sum())
+        self.start_values = self.rng.gamma(shape=2.5, scale=scale, size=active_count)
+        self.variance_factors = self.rng.uniform(0.1, 100, size=active_count)
+        self.costs = np.empty((active_count, 0))
+
+    @classmethod
+    def from_array(cls, costs):
+        '''
+        Creates fully generated curves from an array of shape (count, length). Rows that are infinite everywhere are inactive.
+        '''
+        costs = np.asarray(costs, dtype=float)
+        curves = cls.__new__(cls)
+        curves.rng = None
+        curves.count, curves.length = costs.shape
+        curves.block_size = curves.length
+        curves.scale = None
+        curves.active = ~np.all(np.isinf(costs), axis=1)
+        curves.rows = np.full(curves.count, -1, dtype=np.int64)
+        curves.rows[curves.active] = np.arange(curves.active.sum())
+        curves.costs = costs[curves.active]
+        curves.start_values = curves.costs[:, 0] if curves.length > 0 else np.empty(0)
+        curves.variance_factors = np.empty(0)
+        return curves
+
+    @property
+    def width(self):
+        """The number of generated steps."""
+        return self.costs.shape[1]
+
+    def extend(self, width):
+        '''
+        Generates the steps of all active curves up to width (at most length).
+        '''
+        width = min(width, self.length)
+        if width <= self.width:
+            return
+        variances = np.arange(self.width, width)
+        increments = self.rng.normal(scale=variances[None, :] * self.variance_factors[:, None], size=(len(self.start_values), len(variances)))
+        increments += self.rng.uniform(0, 1000, size=increments.shape)
+        np.maximum(increments, 0, out=increments)
+        previous = self.costs[:, -1] if self.width > 0 else self.start_values
+        self.costs = np.hstack([self.costs, previous[:, None] + np.cumsum(increments, axis=1)])
+
+    def reserve(self, needed):
+        '''
+        Generates at least the steps up to needed, in blocks of at least block_size steps.
+        '''
+        if needed > self.width:
+            self.extend(max(needed, self.width + self.block_size))
+
+    def required_width(self, index):
+        '''
+        Returns the number of steps current() needs for the abatement indices, 0 if no agent can abate.
+        '''
+        available = self.active & (index < self.length)
+        return int(index[available].max()) + 1 if available.any() else 0
+
+    def subset(self, index):
+        '''
+        Returns the curves of the agents selected by index (slice or array of agent positions) with the steps generated so far.
+        The subset has no random number generator, further steps are added with add_steps().
+        '''
+        curves = AbatementCurves.__new__(AbatementCurves)
+        curves.rng = None
+        curves.length, curves.block_size, curves.scale = self.length, self.block_size, self.scale
+        curves.active = self.active[index]
+        curves.count = len(curves.active)
+        curves.rows = np.full(curves.count, -1, dtype=np.int64)
+        curves.rows[curves.active] = np.arange(curves.active.sum())
+        rows = self.rows[index][curves.active]
+        curves.costs = self.costs[rows]
+        curves.start_values = self.start_values[rows]
+        curves.variance_factors = self.variance_factors[rows] if len(self.variance_factors) > 0 else np.empty(0)
+        return curves
+
+    def add_steps(self, costs):
+        '''
+        Appends steps generated elsewhere (e.g. by the curves a subset was taken from), shape (active agents, new steps).
+        '''
+        self.costs = np.hstack([self.costs, costs])
+
+    def current(self, index):
+        '''
+        Returns the abatement cost of every agent at its abatement index. Agents that are inactive or used up their curve get np.inf.
+        Args:
+            index (np.ndarray): The abatement index of every agent, or of every agent in several scenarios with shape (scenarios, count).
+        Returns:
+            np.ndarray: The current abatement costs, shaped like index.
+        '''
+        available = self.active & (index < self.length)
+        if available.any():
+            self.reserve(int(index[available].max()) + 1)
+        costs = np.full(index.shape, np.inf)
+        costs[available] = self.costs[np.broadcast_to(self.rows, index.shape)[available], index[available]]
+        return costs
+
+    def to_array(self):
+        '''
+        Generates the full curves and returns them as array of shape (count, length), inactive agents have infinite costs.
+        '''
+        self.extend(self.length)
+        costs = np.full((self.count, self.length), np.inf)
+        costs[self.active] = self.costs
+        return costs
+
+
+def generate_abatement_curves(count, length=365, rng=None, scale=30000):
+    '''
+    Generates the complete abatement cost curves of count agents at once.
+    Args:
+        count (int): The number of curves.
+        length (int): The number of abatement steps per curve.
+        rng (np.random.Generator): The random number generator.
+        scale (float): The scale of the gamma distribution of the first abatement cost.
+    Returns:
+        np.ndarray: Array of shape (count, length) with the abatement costs of each agent.
+    '''
+    return AbatementCurves(count, length, rng=rng, scale=scale).to_array()
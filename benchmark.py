@@ -0,0 +1,223 @@
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from AgentPopulation import AgentPopulation
+from Environment import Environment
+from history_sinks import make_sink
+from market_clearing import clearing_price, match_orders
+from profiling import Profiler
+from simulation import generate_agents
+
+SIZES = (1000, 10000, 100000)
+MODES = ("seller_preferred", "buyer_preferred")
+IMPLEMENTATIONS = ("population", "objects")
+
+
+def phase_results(profiler):
+    '''
+    Returns the statistics of every phase of a profiler (see profiling.Profiler.summary()) as JSON-serializable dict.
+    Peak memory is only measured if the profiler traces memory, tracing slows down Python code, so the times of a run
+    with trace_memory=True are higher than the times of a run without it.
+    '''
+    summary = profiler.summary().rename(columns={"peak_bytes": "peak_memory_bytes"})
+    return {str(phase): {"calls": int(stats.calls), "total_seconds": float(stats.total_seconds), "mean_seconds": float(stats.mean_seconds),
+                         "peak_memory_bytes": int(stats.peak_memory_bytes)} for phase, stats in summary.iterrows()}
+
+
+def build_benchmark_agents(size, implementation="population", advanced_trading=True, rng=None):
+    '''
+    Builds the market of the notebook experiments with size agents: one half with an allowance surplus, one half with a deficit.
+    Args:
+        size (int): The number of agents.
+        implementation (str): "population" for an AgentPopulation, "objects" for a list of CompanyAgent objects.
+        advanced_trading (bool): Whether the agents use advanced trading.
+        rng (np.random.Generator): The random number generator.
+    Returns:
+        AgentPopulation or list: The agents.
+    '''
+    rng = np.random.default_rng(rng)
+    half = size // 2
+    if implementation == "objects":
+        agents = generate_agents(half, (10000, 11000), (10100, 11100), (0, 100), (0, 100), emission_rate_noise=0.1,
+                                 advanced_trading=advanced_trading, rng=rng)
+        agents += generate_agents(size - half, (10000, 11000), (9800, 10800), (0, 100), (0, 100), emission_rate_noise=0.1,
+                                  advanced_trading=advanced_trading, rng=rng)
+        return agents
+    initial_allowance = np.concatenate([rng.uniform(10100, 11100, half), rng.uniform(9800, 10800, size - half)])
+    return AgentPopulation(rng.uniform(10000, 11000, size), initial_allowance, rng.uniform(0, 100, size), rng.uniform(0, 100, size),
+                           emission_rate_noise=0.1, advanced_trading=advanced_trading, rng=rng)
+
+
+def benchmark_simulation(size, implementation="population", mode="seller_preferred", days=10, seed=0, trace_memory=True):
+    '''
+    Benchmarks the phases of a simulation: agent construction, the daily agent update, matching, the market price
+    calculation, and the export of the history (DataFrames and a history sink).
+    Args:
+        size (int): The number of agents.
+        implementation (str): "population" or "objects", see build_benchmark_agents().
+        mode (str): The mode of the environment.
+        days (int): The number of simulated days.
+        seed (int): The seed of the agents and the environment.
+        trace_memory (bool): Whether to measure the peak memory of every phase.
+    Returns:
+        dict: The benchmark parameters and the statistics of every phase.
+    '''
+    profiler = Profiler(trace_memory)
+    agent_seed, env_seed = np.random.SeedSequence(seed).spawn(2)
+    with profiler.phase("construction", 0):
+        agents = build_benchmark_agents(size, implementation, rng=np.random.default_rng(agent_seed))
+        env = Environment(5, agents, mode=mode, rng=np.random.default_rng(env_seed))
+
+    for day in range(days):
+        if env.population is not None:
+            with profiler.phase("update_agents", day):
+                buying, selling = env.update_population_agents()
+            with profiler.phase("matching", day):
+                env.match_population(buying, selling, queue_side="buy" if mode == "seller_preferred" else "sell")
+        else:
+            with profiler.phase("update_agents", day):
+                buyers, sellers = env.update_agents()
+            with profiler.phase("matching", day):
+                if mode == "seller_preferred":
+                    env.match_seller_preferred(buyers, sellers)
+                else:
+                    env.match_buyer_preferred(buyers, sellers)
+        with profiler.phase("market_price", day):
+            env.end_day()
+
+    with profiler.phase("history_export", days):
+        env.history.trade_frame()
+        env.history.market_frame()
+        env.history.agent_frame()
+        with tempfile.TemporaryDirectory() as directory:
+            sink = make_sink(directory)
+            for name, table in env.history.tables().items():
+                sink.write(name, table.raw_columns(), table.categories)
+            sink.close()
+
+    return {"benchmark": "simulation", "implementation": implementation, "size": size, "mode": mode, "days": days,
+            "phases": phase_results(profiler)}
+
+
+def benchmark_book(size, repeat=5, seed=0, trace_memory=True):
+    '''
+    Benchmarks the market clearing price and the order matching on random order books.
+    Args:
+        size (int): The number of offers and of demands in the book.
+        repeat (int): The number of repetitions.
+        seed (int): The seed of the random books.
+        trace_memory (bool): Whether to measure the peak memory of every phase.
+    Returns:
+        dict: The benchmark parameters and the statistics of every phase.
+    '''
+    profiler = Profiler(trace_memory)
+    rng = np.random.default_rng(seed)
+    for repetition in range(repeat):
+        offer_prices, demand_prices = rng.uniform(0, 100, size), rng.uniform(0, 100, size)
+        offer_counts, demand_counts = rng.integers(1, 1000, size).astype(float), rng.integers(1, 1000, size).astype(float)
+
+        with profiler.phase("clearing_price", repetition):
+            offers, demands = np.argsort(offer_prices), np.argsort(demand_prices)[::-1]
+            clearing_price(offer_prices[offers], np.cumsum(offer_counts[offers]),
+                           demand_prices[demands], np.cumsum(demand_counts[demands]))
+        with profiler.phase("match_seller_preferred", repetition):
+            match_orders(demand_prices[demands], demand_counts[demands], offer_prices, offer_counts, "buy")
+        with profiler.phase("match_buyer_preferred", repetition):
+            match_orders(offer_prices[offers], offer_counts[offers], demand_prices, demand_counts, "sell")
+
+    return {"benchmark": "book", "size": size, "repeat": repeat, "phases": phase_results(profiler)}
+
+
+def metadata():
+    '''
+    Returns the environment of a benchmark run (commit, versions, platform) to compare results between commits.
+    '''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__, "platform": platform.platform()}
+
+
+def run_benchmarks(sizes=SIZES, implementations=IMPLEMENTATIONS, modes=MODES, days=10, trace_memory=True, output=None):
+    '''
+    Runs the simulation benchmarks for all sizes, implementations, and modes and the order book benchmarks for all sizes.
+    Args:
+        sizes (tuple): The numbers of agents (and orders per book side).
+        implementations (tuple): The agent implementations, see build_benchmark_agents().
+        modes (tuple): The modes of the environment.
+        days (int): The number of simulated days per run.
+        trace_memory (bool): Whether to measure the peak memory of every phase.
+        output (str): JSON file to save the results to.
+    Returns:
+        dict: The metadata and the results of all runs.
+    '''
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        runs = [benchmark_simulation(size, implementation, mode, days, trace_memory=trace_memory)
+                for size in sizes for implementation in implementations for mode in modes]
+        runs += [benchmark_book(size, trace_memory=trace_memory) for size in sizes]
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    results = {"metadata": metadata(), "runs": runs}
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+def results_frame(results):
+    '''
+    Returns the results of run_benchmarks() (or the path of a saved result) as DataFrame with one row per run and phase.
+    '''
+    if isinstance(results, str):
+        with open(results) as f:
+            results = json.load(f)
+    rows = []
+    for run in results["runs"]:
+        for phase, stats in run["phases"].items():
+            rows.append({"benchmark": run["benchmark"], "implementation": run.get("implementation"), "size": run["size"],
+                         "mode": run.get("mode"), "phase": phase, **stats})
+    return pd.DataFrame(rows)
+
+
+def compare_results(baseline, current):
+    '''
+    Compares two benchmark results (dicts or paths of saved results) phase by phase.
+    Returns:
+        pd.DataFrame: The mean time and peak memory of both results and their ratios (current / baseline), ratios above 1 are regressions.
+    '''
+    keys = ["benchmark", "implementation", "size", "mode", "phase"]
+    columns = keys + ["mean_seconds", "peak_memory_bytes"]
+    merged = results_frame(baseline)[columns].merge(results_frame(current)[columns], on=keys, suffixes=("_baseline", "_current"))
+    merged["time_ratio"] = merged["mean_seconds_current"] / merged["mean_seconds_baseline"]
+    merged["memory_ratio"] = merged["peak_memory_bytes_current"] / merged["peak_memory_bytes_baseline"].where(merged["peak_memory_bytes_baseline"] > 0)
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the simulation phases at different population and book sizes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--implementations", nargs="+", default=list(IMPLEMENTATIONS), choices=IMPLEMENTATIONS)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--days", type=int, default=10)
+    parser.add_argument("--no-memory", action="store_true", help="do not trace the peak memory (faster, exact timings)")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="saved result to compare the new result with")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.implementations, args.modes, args.days, not args.no_memory, args.output)
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(results_frame(results)[["benchmark", "implementation", "size", "mode", "phase", "mean_seconds", "peak_memory_bytes"]])
+        if args.compare:
+            print(compare_results(args.compare, results))
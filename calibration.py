@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy.optimize import differential_evolution
+from simulation import init_eu, simulate_years, cap_trajectory
+from data_preparation_utils import get_price_data
+
+# search space of build_eu_agents(): name -> (lower bound, upper bound)
+EU_SPACE = {"sell_price_low": (0, 50),
+            "sell_price_width": (1, 100),
+            "buy_price_low": (0, 50),
+            "buy_price_width": (1, 100),
+            "emission_rate_noise": (0.001, 0.05),
+            "abatement_scale": (5000, 100000)}
+
+
+def price_target(start_year, years=1, steps=365, path='./data/price_data_eu_ets.csv'):
+    '''
+    Returns the historical allowance price on every simulated day, linearly interpolated between the observations.
+    Day d (counted from 0) of the simulation corresponds to the fractional year start_year + d // steps + (d % steps + 1) / steps.
+    Args:
+        start_year (int): The year of the first simulated day.
+        years (int): The number of simulated years.
+        steps (int): The number of days per year.
+        path (str): The historical price series (see data_preparation_utils.get_price_data()).
+    Returns:
+        np.ndarray: The target price path with years * steps entries.
+    '''
+    prices = get_price_data(path)
+    days = np.arange(years * steps)
+    times = start_year + days // steps + (days % steps + 1) / steps
+    return np.interp(times, prices['year'].to_numpy(), prices['price'].to_numpy())
+
+
+def build_eu_agents(sell_price_low, sell_price_width, buy_price_low, buy_price_width, emission_rate_noise, abatement_scale,
+                    rng=None, year=2018):
+    '''
+    Builds the EU population (see simulation.init_eu()) from scalar calibration parameters.
+    The price ranges are given as lower bound and width, so every parameter point is valid.
+    The emission rate noise of the installations is drawn between emission_rate_noise / 10 and emission_rate_noise.
+    '''
+    return init_eu(year=year, population=True, rng=rng,
+                   sell_price=(sell_price_low, sell_price_low + sell_price_width),
+                   buy_price=(buy_price_low, buy_price_low + buy_price_width),
+                   emission_rate_noise=(emission_rate_noise / 10, emission_rate_noise),
+                   abatement_scale=abatement_scale)
+
+
+class Objective:
+    """The calibration loss of a parameter point: the root mean squared error between the simulated market price path
+    and the target path, averaged over seeds. All points use the same seeds (common random numbers),
+    so differences between points come from the parameters and not from noise.
+    Properties:
+        target (np.ndarray): The target price on every simulated day, see price_target().
+        space (dict): The bounds of every calibrated parameter.
+        names (list): The names of the calibrated parameters, in the order of the parameter vectors.
+        build_agents (callable): Module level function that builds the agents from the parameters and an rng argument.
+        fixed (dict): Further parameters passed to build_agents.
+        seeds (tuple): The seeds every point is simulated with.
+        steps (int): The number of days per year.
+        mode (str): The mode of the environment.
+        initial_market_price (float): The initial market price, defaults to the first target price.
+        reduction_factor (float): The linear reduction of the allocation in multi-year runs (see simulation.cap_trajectory()).
+    """
+
+    def __init__(self, target, space=EU_SPACE, build_agents=build_eu_agents, fixed=None, seeds=(0,), steps=365,
+                 mode="seller_preferred", initial_market_price=None, reduction_factor=0.022):
+        """Initializes the objective, see the properties for the arguments."""
+        self.target = np.asarray(target, dtype=float)
+        self.space = dict(space)
+        self.names = list(self.space)
+        self.build_agents = build_agents
+        self.fixed = fixed if fixed is not None else {}
+        self.seeds = tuple(seeds)
+        self.steps = steps
+        self.mode = mode
+        self.initial_market_price = initial_market_price if initial_market_price is not None else float(self.target[0])
+        self.reduction_factor = reduction_factor
+
+    @property
+    def bounds(self):
+        return [self.space[name] for name in self.names]
+
+    def params(self, x):
+        '''
+        Returns the parameters of build_agents for a parameter vector.
+        '''
+        params = dict(self.fixed)
+        params.update({name: float(value) for name, value in zip(self.names, x)})
+        return params
+
+    def key(self):
+        '''
+        Returns a key of the objective configuration, cached losses are only reused for the same configuration.
+        '''
+        config = {"build_agents": f"{self.build_agents.__module__}.{self.build_agents.__qualname__}",
+                  "names": self.names, "fixed": self.fixed, "seeds": self.seeds, "steps": self.steps, "mode": self.mode,
+                  "initial_market_price": self.initial_market_price, "reduction_factor": self.reduction_factor,
+                  "target": hashlib.sha256(self.target.tobytes()).hexdigest()}
+        return json.dumps(config, sort_keys=True, default=str)
+
+    def simulate(self, params, seed):
+        '''
+        Simulates the market price path of a parameter point with one seed.
+        '''
+        agent_seed, env_seed = np.random.SeedSequence(seed).spawn(2)
+        agents = self.build_agents(rng=np.random.default_rng(agent_seed), **params)
+        years = len(self.target) // self.steps
+        allowance = agents.allowance.copy() if hasattr(agents, "allowance") else np.array([agent.allowance for agent in agents])
+        env = simulate_years(agents, cap_trajectory(allowance, years, self.reduction_factor), steps=self.steps, mode=self.mode,
+                             initial_market_price=self.initial_market_price, rng=np.random.default_rng(env_seed))
+        return env.history.market.raw_columns()["market_price"]
+
+    def __call__(self, x):
+        params = self.params(x)
+        losses = [np.sqrt(np.mean((self.simulate(params, seed) - self.target) ** 2)) for seed in self.seeds]
+        return float(np.mean(losses))
+
+
+class EvaluationCache:
+    """Map-like evaluator for scipy optimizers (the workers argument) that evaluates the points of a generation in parallel
+    processes and caches the losses on disk. Every evaluated point is appended to a CSV immediately, so a restarted
+    calibration with the same objective configuration does not repeat simulations.
+    Properties:
+        path (str): The CSV file of the cache, None to cache in memory only.
+        key (str): The configuration key of the objective (see Objective.key()).
+        names (list): The parameter names, used as column names.
+        executor (concurrent.futures.Executor): The executor running the simulations.
+        losses (dict): The cached loss of every point by point key.
+    """
+
+    def __init__(self, objective, path=None, executor=None):
+        """Initializes the cache and loads the points cached for the objective configuration.
+        Args:
+            objective (Objective): The objective.
+            path (str): The CSV file of the cache.
+            executor (concurrent.futures.Executor): The executor running the simulations, None to evaluate in this process.
+        """
+        self.path = path
+        self.key = objective.key()
+        self.names = objective.names
+        self.executor = executor
+        self.losses = {}
+        if path is not None and os.path.exists(path):
+            cached = pd.read_csv(path)
+            cached = cached[cached["config"] == self.key]
+            self.losses = dict(zip(cached["point"], cached["loss"]))
+
+    @staticmethod
+    def point_key(x):
+        return json.dumps([round(float(value), 12) for value in x])
+
+    def __call__(self, func, points):
+        points = [np.asarray(x, dtype=float) for x in points]
+        keys = [self.point_key(x) for x in points]
+        missing = {}
+        for key, x in zip(keys, points):
+            if key not in self.losses and key not in missing:
+                missing[key] = x
+
+        if missing:
+            evaluate = self.executor.map if self.executor is not None else map
+            losses = list(evaluate(func, missing.values()))
+            rows = []
+            for (key, x), loss in zip(missing.items(), losses):
+                self.losses[key] = loss
+                rows.append({"config": self.key, "point": key, **dict(zip(self.names, x.tolist())), "loss": loss})
+            if self.path is not None:
+                pd.DataFrame(rows).to_csv(self.path, mode="a", index=False, header=not os.path.exists(self.path))
+
+        return [self.losses[key] for key in keys]
+
+    def frame(self):
+        '''
+        Returns all cached points of the objective configuration with their losses, best first.
+        '''
+        rows = [dict(zip(self.names, json.loads(key)), loss=loss) for key, loss in self.losses.items()]
+        return pd.DataFrame(rows, columns=self.names + ["loss"]).sort_values("loss").reset_index(drop=True)
+
+
+def calibrate(objective, cache_path=None, max_workers=None, popsize=8, maxiter=20, seed=0, **optimizer_kwargs):
+    '''
+    Fits the parameters of the objective with differential evolution (scipy.optimize.differential_evolution).
+    Every generation is evaluated as one batch of parallel simulations, evaluated points are cached in cache_path.
+    Args:
+        objective (Objective): The calibration objective.
+        cache_path (str): CSV file caching the evaluated points, None to cache in memory only.
+        max_workers (int): The number of worker processes, defaults to the number of CPUs.
+        popsize (int): The population size multiplier of differential evolution (points per generation = popsize * parameters).
+        maxiter (int): The maximum number of generations.
+        seed (int): The seed of the optimizer.
+        optimizer_kwargs: Further arguments passed to differential_evolution.
+    Returns:
+        tuple: (best parameters as dict, loss of the best parameters, all evaluated points as DataFrame)
+    '''
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        cache = EvaluationCache(objective, cache_path, executor)
+        result = differential_evolution(objective, objective.bounds, workers=cache, updating="deferred",
+                                        popsize=popsize, maxiter=maxiter, seed=seed, polish=False, **optimizer_kwargs)
+    return objective.params(result.x), float(result.fun), cache.frame()
@@ -0,0 +1,143 @@
+import copy
+import os
+import pickle
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+CHECKPOINT_FILE = "state.pkl"
+
+
+class CheckpointPickler(pickle.Pickler):
+    """Pickler that writes large NumPy arrays to separate .npy files next to the pickle.
+    Every array is written once, arrays that are referenced several times stay shared after loading.
+    Properties:
+        directory (str): The checkpoint directory.
+        min_array_size (int): Arrays with fewer elements are pickled inline.
+        arrays (dict): The file name of every written array by id.
+        keep_alive (list): The written arrays, so their ids are not reused while pickling.
+    """
+
+    def __init__(self, file, directory, min_array_size=1024):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.min_array_size = min_array_size
+        self.arrays = {}
+        self.keep_alive = []
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray and not isinstance(obj, np.memmap):
+            return None
+        if obj.dtype.hasobject or obj.size < self.min_array_size:
+            return None
+        name = self.arrays.get(id(obj))
+        if name is None:
+            name = f"{len(self.arrays):05d}.npy"
+            np.save(os.path.join(self.directory, name), np.asarray(obj))
+            self.arrays[id(obj)] = name
+            self.keep_alive.append(obj)
+        return name
+
+
+class CheckpointUnpickler(pickle.Unpickler):
+    """Unpickler for checkpoints written by CheckpointPickler.
+    Properties:
+        directory (str): The checkpoint directory.
+        mmap (bool): Whether the arrays are memory mapped copy-on-write instead of read into memory.
+        arrays (dict): The loaded arrays by file name.
+    """
+
+    def __init__(self, file, directory, mmap=True):
+        super().__init__(file)
+        self.directory = directory
+        self.mmap = mmap
+        self.arrays = {}
+
+    def persistent_load(self, name):
+        array = self.arrays.get(name)
+        if array is None:
+            array = np.load(os.path.join(self.directory, name), mmap_mode="c" if self.mmap else None)
+            # plain ndarray view, results of array operations should not be memmaps
+            array = array.view(np.ndarray)
+            self.arrays[name] = array
+        return array
+
+
+def save_checkpoint(env, directory, min_array_size=1024):
+    '''
+    Saves the complete state of an environment (market, agents or population, random number generators, and the
+    in-memory history) to a directory. Large arrays are stored as .npy files, everything else as pickle.
+    The history sink and the order book store are not part of the checkpoint: rows flushed to disk already stay where they are,
+    a restored environment gets a new sink and store (see load_checkpoint()).
+    Args:
+        env (Environment): The environment, between two days.
+        directory (str): The checkpoint directory, created if it does not exist.
+        min_array_size (int): Arrays with fewer elements are stored in the pickle.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    with detached_outputs(env):
+        with open(os.path.join(directory, CHECKPOINT_FILE), "wb") as f:
+            CheckpointPickler(f, directory, min_array_size).dump(env)
+
+
+def load_checkpoint(directory, mmap=True, sink=None, order_books=None):
+    '''
+    Restores an environment saved by save_checkpoint(). The restored environment continues exactly like the saved one,
+    including the random numbers of the following days.
+    Args:
+        directory (str): The checkpoint directory.
+        mmap (bool): Whether to memory map the arrays copy-on-write. Pages are only copied when the simulation writes to them,
+            so several environments restored from one checkpoint share the unchanged memory.
+        sink (HistorySink): Sink for the history of the restored environment, None to keep the history in memory.
+        order_books (OrderBookStore): Store for the order books of the restored environment, None to not store them.
+    Returns:
+        Environment: The restored environment.
+    '''
+    with open(os.path.join(directory, CHECKPOINT_FILE), "rb") as f:
+        env = CheckpointUnpickler(f, directory, mmap).load()
+    env.history.sink = sink
+    env.order_books = order_books
+    return env
+
+
+def fork(env, count=1, sinks=None):
+    '''
+    Creates independent copies of an environment to simulate several what-if branches from the same state.
+    The state is written once to a temporary checkpoint and every branch maps it copy-on-write.
+    All branches continue with the same random numbers, so differences between branches come from the changes
+    applied to them (e.g. a different allocation or mode), not from noise.
+    Args:
+        env (Environment): The environment, between two days.
+        count (int): The number of branches.
+        sinks (list): One history sink per branch, None to keep the histories in memory.
+    Returns:
+        list: The branches.
+    '''
+    sinks = sinks if sinks is not None else [None] * count
+    with tempfile.TemporaryDirectory() as directory:
+        save_checkpoint(env, directory)
+        # the mapped files stay valid after the temporary directory is removed
+        return [load_checkpoint(directory, mmap=True, sink=sink) for sink in sinks]
+
+
+def copy_environment(env):
+    '''
+    Returns an in-memory deep copy of an environment (without its history sink and order book store), for small simulations
+    where writing a checkpoint is not worth it.
+    '''
+    with detached_outputs(env):
+        return copy.deepcopy(env)
+
+
+@contextmanager
+def detached_outputs(env):
+    '''
+    Context manager that removes the outputs writing to open files (history sink and order book store) from an environment
+    and restores them afterwards.
+    '''
+    sink, order_books = env.history.sink, env.order_books
+    env.history.sink, env.order_books = None, None
+    try:
+        yield
+    finally:
+        env.history.sink, env.order_books = sink, order_books
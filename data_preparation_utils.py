@@ -1,42 +1,122 @@
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import re
 import pandas as pd
 import numpy as np
 
-def get_allocation_over_years(austrian=False, years = range(2008, 2023), path='./data/data_2008-2022.xlsx'):
-    df_free_allowances = pd.read_excel(path, header=21)
+# columns of the registry that are repeated for every year, as <stub><year>
+STUBNAMES = ['ALLOCATION_', 'ALLOCATION_RESERVE_', 'ALLOCATION_TRANSITIONAL_', 'ALLOCATION_DIFF_', 'CH_ALLOCATION_',
+             'VERIFIED_EMISSIONS_', 'CH_VERIFIED_EMISSIONS_', 'ALLOCATION_DIFF_NORM_']
+YEAR_COLUMN = re.compile(r'^(?P<stub>\D+?)(?P<year>\d{4})$')
+
+
+def read_registry(path='./data/data_2008-2022.xlsx'):
+    '''
+    Reads the registry sheet of the EUTL data (installations with their yearly allocation and verified emissions) as it is.
+    '''
+    return pd.read_excel(path, header=21)
+
 
+def prepare_registry(df, austrian=False, years=range(2008, 2023), dtype=np.float32):
+    '''
+    Converts the raw registry sheet to compact columns in one pass: the yearly columns to dtype (non-numeric values such as 'Excluded' become NaN),
+    the text columns to categoricals, and adds the ALLOCATION_DIFF_<year> (verified emissions - allocation) and
+    ALLOCATION_DIFF_NORM_<year> (difference / verified emissions) columns of all years at once.
+    Args:
+        df (pd.DataFrame): The registry sheet, see read_registry().
+        austrian (bool): Whether to keep only the Austrian installations.
+        years (range): The years of the difference columns.
+        dtype (np.dtype): The type of the yearly columns, float32 halves the memory of the table.
+    Returns:
+        pd.DataFrame: One row per installation.
+    '''
     if austrian:
-        df_free_allowances = df_free_allowances[df_free_allowances.REGISTRY_CODE == 'AT']
-        
-    df_free_allowances.columns = [c if 'ALLOCATION_' in c else c.replace('ALLOCATION', 'ALLOCATION_') for c in df_free_allowances.columns]
-    allowance_cols = [c for c in df_free_allowances.columns if 'VERIFIED_EMISSIONS_2' in c or 'ALLOCATION_2' in c]
-    df_free_allowances = df_free_allowances.replace('Excluded', np.nan)
-    df_free_allowances[allowance_cols] = df_free_allowances[allowance_cols].astype(float)
+        df = df[df.REGISTRY_CODE == 'AT']
+    df = df.rename(columns={c: c.replace('ALLOCATION', 'ALLOCATION_') for c in df.columns if 'ALLOCATION' in c and 'ALLOCATION_' not in c})
 
-    for year in years:
-        df_free_allowances[f'ALLOCATION_DIFF_{year}'] = df_free_allowances[f'VERIFIED_EMISSIONS_{year}'] - df_free_allowances[f'ALLOCATION_{year}']
-        df_free_allowances[f'ALLOCATION_DIFF_NORM_{year}'] = df_free_allowances[f'ALLOCATION_DIFF_{year}'] / df_free_allowances[f'VERIFIED_EMISSIONS_{year}']
+    year_cols = [c for c in df.columns if YEAR_COLUMN.match(str(c))]
+    columns = {c: df[c] if pd.api.types.is_numeric_dtype(df[c]) else df[c].astype('category') for c in df.columns if c not in year_cols}
+    for c in year_cols:
+        values = df[c] if pd.api.types.is_numeric_dtype(df[c]) else pd.to_numeric(df[c], errors='coerce')
+        columns[c] = values.to_numpy(dtype=dtype, na_value=np.nan)
 
-    # df_free_allowances = df_free_allowances.drop(columns=['REGISTRY_CODE', 'IDENTIFIER_IN_REG', 'INSTALLATION_IDENTIFIER', 'PERMIT_IDENTIFIER', 'MAIN_ACTIVITY_TYPE_CODE'])
-    return df_free_allowances
+    emissions = np.column_stack([columns[f'VERIFIED_EMISSIONS_{year}'] for year in years])
+    diff = emissions - np.column_stack([columns[f'ALLOCATION_{year}'] for year in years])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm = diff / emissions
+    for i, year in enumerate(years):
+        columns[f'ALLOCATION_DIFF_{year}'] = diff[:, i]
+        columns[f'ALLOCATION_DIFF_NORM_{year}'] = norm[:, i]
+    return pd.DataFrame(columns, index=df.index)
 
 
-def get_allocation_melted(df_free_allowances, filter_out_non_verified_emissions=True):
-    id_cols = ['REGISTRY_CODE', 'IDENTIFIER_IN_REG', 'INSTALLATION_NAME',
-        'INSTALLATION_IDENTIFIER', 'PERMIT_IDENTIFIER',
-        'MAIN_ACTIVITY_TYPE_CODE']
-    # id_cols = ['INSTALLATION_NAME', 'ACTIVITY_TYPE']
+def get_allocation_over_years(austrian=False, years = range(2008, 2023), path='./data/data_2008-2022.xlsx', dtype=np.float32):
+    '''
+    Returns the registry with one row per installation and the yearly allocation, verified emissions, and their differences
+    (see prepare_registry()).
+    '''
+    return prepare_registry(read_registry(path), austrian=austrian, years=years, dtype=dtype)
+
+
+def get_allocation_melted(df_free_allowances, filter_out_non_verified_emissions=True, stubnames=STUBNAMES):
+    '''
+    Reshapes the registry (one row per installation) to one row per installation and year with the columns <stub> and year.
+    The yearly columns are stacked with a reshape, the other columns (including yearly columns of other stubs) are repeated
+    for every year.
+    Args:
+        df_free_allowances (pd.DataFrame): The registry, see get_allocation_over_years().
+        filter_out_non_verified_emissions (bool): Whether to remove the rows with an allocation or verified emissions of -1.
+        stubnames (list): The yearly columns to keep, stubs missing in a year are NaN.
+    Returns:
+        pd.DataFrame: The melted registry, ordered by installation and year.
+    '''
+    matches = [YEAR_COLUMN.match(str(c)) for c in df_free_allowances.columns]
+    present = {(m['stub'], int(m['year'])) for m in matches if m is not None and m['stub'] in stubnames}
+    years = sorted({year for _, year in present})
+    id_cols = [c for c, m in zip(df_free_allowances.columns, matches) if m is None or m['stub'] not in stubnames]
+    rows = len(df_free_allowances)
+
+    columns = {c: df_free_allowances[c].take(np.repeat(np.arange(rows), len(years))).reset_index(drop=True) for c in id_cols}
+    columns['year'] = np.tile(np.array(years, dtype=np.int64), rows)
+    for stub in stubnames:
+        if not any((stub, year) in present for year in years):
+            continue
+        dtype = np.result_type(*(df_free_allowances[f'{stub}{year}'].dtype for year in years if (stub, year) in present))
+        values = np.full((rows, len(years)), np.nan, dtype=dtype)
+        for i, year in enumerate(years):
+            if (stub, year) in present:
+                values[:, i] = df_free_allowances[f'{stub}{year}'].to_numpy()
+        columns[stub] = values.ravel()
+    df = pd.DataFrame(columns)
+
+    if filter_out_non_verified_emissions:
+        mask = np.ones(len(df), dtype=bool)
+        for c in ('ALLOCATION_', 'VERIFIED_EMISSIONS_'):
+            if c in df.columns:
+                mask &= df[c].to_numpy() != -1
+        df = df[mask].reset_index(drop=True)
+    return df
 
-    stubnames = ['ALLOCATION_', 'ALLOCATION_RESERVE_', 'ALLOCATION_TRANSITIONAL_', 'ALLOCATION_DIFF_', 'CH_ALLOCATION_',
-             'VERIFIED_EMISSIONS_', 'CH_VERIFIED_EMISSIONS_', 'ALLOCATION_DIFF_NORM_']
-    
-    df_free_allowances_melted = pd.wide_to_long(df_free_allowances, stubnames=stubnames, i=id_cols, j='year')
-    df_free_allowances_melted = df_free_allowances_melted.reset_index(drop=False)
 
-    for c in df_free_allowances_melted.columns:
-        if filter_out_non_verified_emissions:
-            if c == 'ALLOCATION_' or c == 'VERIFIED_EMISSIONS_':
-                df_free_allowances_melted = df_free_allowances_melted[df_free_allowances_melted[c] != -1]
-    return df_free_allowances_melted
+def iter_allocation_melted(df_free_allowances, by='REGISTRY_CODE', df_activity=None, filter_out_non_verified_emissions=True):
+    '''
+    Yields the melted registry (see get_allocation_melted()) of one country or activity at a time,
+    so analyses per subset never hold the melted table of all installations.
+    Args:
+        df_free_allowances (pd.DataFrame): The registry, see get_allocation_over_years().
+        by (str): The column to split by, e.g. REGISTRY_CODE or ACTIVITY_TYPE.
+        df_activity (pd.DataFrame): The activity types (see get_activity_df()), added before splitting if given.
+        filter_out_non_verified_emissions (bool): See get_allocation_melted().
+    Yields:
+        tuple: (value of the column, melted registry of the subset)
+    '''
+    if df_activity is not None:
+        df_free_allowances = add_activity_info(df_free_allowances, df_activity)
+    for key, subset in df_free_allowances.groupby(by, observed=True, sort=True):
+        yield key, get_allocation_melted(subset, filter_out_non_verified_emissions)
 
 
 def get_totals_by_year(df, cols=['ALLOCATION_', 'VERIFIED_EMISSIONS_']):
@@ -53,6 +133,131 @@ def get_activity_df(path='./data/data_activity_type.xlsx'):
 
 
 def add_activity_info(df, df_activity):
-    df = df.merge(df_activity, on='INSTALLATION_NAME', how='left')
-    df.loc[df.ACTIVITY_TYPE.isna(), 'ACTIVITY_TYPE'] = 'Unknown'
-    return df
\ No newline at end of file
+    '''
+    Adds the activity type of every installation ('Unknown' if it is not listed) as categorical column.
+    The types are looked up by installation name instead of merged, so the table is not copied and installations
+    listed twice in the activity table are not duplicated (the first listed type is used).
+    Works on the registry and on the melted registry.
+    '''
+    types = df_activity.drop_duplicates('INSTALLATION_NAME').set_index('INSTALLATION_NAME')['ACTIVITY_TYPE']
+    activity = df['INSTALLATION_NAME'].astype(object).map(types).fillna('Unknown')
+    return df.assign(ACTIVITY_TYPE=activity.astype('category'))
+
+def file_hash(path, block_size=1 << 20):
+    '''
+    Returns the sha256 hash of a file, used to invalidate cached snapshots when the source file changes.
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def save_snapshot(df, path):
+    '''
+    Saves a DataFrame as typed binary snapshot: Parquet if pyarrow is available, otherwise an .npz file with one array per column.
+    '''
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        np.savez(path, **{c: df[c].to_numpy() for c in df.columns})
+
+
+def load_snapshot(path):
+    '''
+    Loads a snapshot written by save_snapshot.
+    '''
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    with np.load(path, allow_pickle=True) as data:
+        return pd.DataFrame({c: data[c] for c in data.files})
+
+
+def cached_table(name, source_path, params, build, cache_dir='./data/cache'):
+    '''
+    Returns the table built by build(), cached as binary snapshot in cache_dir.
+    Every table has its own directory, the snapshot file is named by the key of the parameters and the hash of the source file.
+    When the source file changes, the outdated snapshot with the same parameters is removed, snapshots of other parameters
+    and other tables are kept.
+    Args:
+        name (str): The name of the table, used as directory of its snapshots.
+        source_path (str): The file the table is built from.
+        params (dict): The parameters of build(), part of the cache key.
+        build (callable): Function without arguments that builds the table as DataFrame.
+        cache_dir (str): The directory of the snapshots.
+    Returns:
+        pd.DataFrame: The table.
+    '''
+    params_key = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    source_key = file_hash(source_path)[:16]
+    extension = '.parquet' if importlib.util.find_spec('pyarrow') is not None else '.npz'
+    directory = os.path.join(cache_dir, name)
+    path = os.path.join(directory, f'{params_key}-{source_key}{extension}')
+    if os.path.exists(path):
+        return load_snapshot(path)
+
+    df = build()
+    os.makedirs(directory, exist_ok=True)
+    # the keys are hex digits, so the '-' delimiter only matches snapshots of exactly these parameters
+    for outdated in glob.glob(os.path.join(directory, f'{params_key}-*')):
+        os.remove(outdated)
+    save_snapshot(df, path)
+    return df
+
+
+def get_allocation_over_years_cached(austrian=False, years=range(2008, 2023), path='./data/data_2008-2022.xlsx', cache_dir='./data/cache',
+                                     dtype=np.float32):
+    '''
+    Cached version of get_allocation_over_years, the registry file is only parsed again if it or the parameters change.
+    '''
+    name = 'allocation_at' if austrian else 'allocation'
+    return cached_table(name, path, {'austrian': austrian, 'years': list(years), 'dtype': np.dtype(dtype).name},
+                        lambda: get_allocation_over_years(austrian=austrian, years=years, path=path, dtype=dtype), cache_dir)
+
+
+def get_init_labels(year=2018, column='REGISTRY_CODE', path='./data/data_for_init_melted.csv', cache_dir='./data/cache'):
+    '''
+    Returns a label column (e.g. REGISTRY_CODE or ACTIVITY_TYPE) of the installations returned by get_init_data(), in the same order,
+    e.g. to shard the EU population by country (see sharding.partition()).
+    '''
+    def build():
+        df = pd.read_csv(path, usecols=['year', 'INSTALLATION_NAME', 'ALLOCATION_', 'VERIFIED_EMISSIONS_', column])
+        df = df[df.year == year].dropna(subset=['year', 'INSTALLATION_NAME', 'ALLOCATION_', 'VERIFIED_EMISSIONS_'])
+        return df[[column]].astype(str).reset_index(drop=True)
+
+    df = cached_table(f'init_{column.lower()}_{year}', path, {'year': year, 'column': column}, build, cache_dir)
+    return df[column].to_numpy()
+
+
+def get_price_data(path='./data/price_data_eu_ets.csv'):
+    '''
+    Returns the historical EU ETS allowance price as DataFrame with the columns year (fractional year) and price.
+    '''
+    df = pd.read_csv(path, sep=';').dropna()
+    return df.sort_values('year').reset_index(drop=True)
+
+
+def get_total_allocation(years=range(2008, 2023), austrian=False, path='./data/data_2008-2022.xlsx', cache_dir='./data/cache'):
+    '''
+    Returns the total free allocation of all installations in every year, e.g. as cap schedule for simulation.allocation_schedule().
+    '''
+    df = get_allocation_over_years_cached(austrian=austrian, years=years, path=path, cache_dir=cache_dir)
+    # summed in float64, the float32 columns are not exact enough for the EU totals
+    return np.array([df[f'ALLOCATION_{year}'].to_numpy(np.float64).sum() for year in years])
+
+
+def get_init_data(year=2018, path='./data/data_for_init_melted.csv', cache_dir='./data/cache'):
+    '''
+    Returns the allocation and verified emissions of all installations in the given year, used to initialize the EU agents.
+    Cached as snapshot keyed by the hash of the source file and the year.
+    Returns:
+        tuple: (allocation, verified_emissions) as float64 arrays.
+    '''
+    def build():
+        df = pd.read_csv(path, usecols=['year', 'INSTALLATION_NAME', 'ALLOCATION_', 'VERIFIED_EMISSIONS_'])
+        df = df[df.year == year].dropna()
+        return df[['ALLOCATION_', 'VERIFIED_EMISSIONS_']].astype(np.float64).reset_index(drop=True)
+
+    df = cached_table(f'init_{year}', path, {'year': year}, build, cache_dir)
+    return df['ALLOCATION_'].to_numpy(), df['VERIFIED_EMISSIONS_'].to_numpy()
@@ -0,0 +1,92 @@
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from simulation import generate_market, simulate, summarize_run
+
+# parameters that configure the environment, all other parameters are passed to the agent factory
+ENV_PARAMETERS = ("mode", "steps", "initial_market_price")
+
+
+def parameter_grid(grid):
+    '''
+    Expands a grid of parameter values into the list of all parameter combinations.
+    Args:
+        grid (dict): The values of each parameter, e.g. {"mode": ["seller_preferred", "buyer_preferred"], "advanced_trading": [False, True]}
+    Returns:
+        list: One dictionary per combination.
+    '''
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def run_id(params, seed):
+    '''
+    Returns the key of a run, used to skip finished runs when an ensemble is resumed.
+    '''
+    return json.dumps({"params": params, "seed": seed}, sort_keys=True, default=str)
+
+
+def run_single(build_agents, params, seed):
+    '''
+    Runs one simulation of the ensemble. The generators of the agents and of the environment are spawned from a SeedSequence
+    of the seed, so runs are independent of each other and of the order in which the workers process them.
+    Args:
+        build_agents (callable): Module level function that builds the agents from the agent parameters and an rng argument.
+        params (dict): The parameters of the run.
+        seed (int): The seed of the run.
+    Returns:
+        dict: The run id, seed, parameters, and the summary statistics of the run.
+    '''
+    start = time.perf_counter()
+    agent_seed, env_seed = np.random.SeedSequence(seed).spawn(2)
+
+    env_params = {name: value for name, value in params.items() if name in ENV_PARAMETERS}
+    agent_params = {name: value for name, value in params.items() if name not in ENV_PARAMETERS}
+    env = simulate(build_agents(rng=np.random.default_rng(agent_seed), **agent_params), rng=np.random.default_rng(env_seed), **env_params)
+
+    result = {"run_id": run_id(params, seed), "seed": seed}
+    result.update({name: value if np.isscalar(value) else str(value) for name, value in params.items()})
+    result.update(summarize_run(env))
+    result["runtime"] = time.perf_counter() - start
+    return result
+
+
+def run_ensemble(grid, seeds, build_agents=generate_market, results_path=None, max_workers=None):
+    '''
+    Runs a Monte Carlo ensemble over a parameter grid and seeds in parallel processes.
+    The summary of every finished run is appended to results_path immediately, so an interrupted ensemble
+    continues with the missing runs when it is started again with the same results_path.
+    Args:
+        grid (dict or list): The parameter grid (see parameter_grid()) or a list of parameter dictionaries.
+            The parameters mode, steps, and initial_market_price configure the environment, all others are passed to build_agents.
+        seeds (list): The seeds, every parameter combination is run once per seed.
+        build_agents (callable): Module level function that builds the agents, called with the agent parameters and an
+            np.random.Generator as rng argument. Defaults to simulation.generate_market.
+        results_path (str): CSV file to stream the results to, None to keep them in memory only.
+        max_workers (int): The number of worker processes, defaults to the number of CPUs.
+    Returns:
+        pd.DataFrame: One row per run with the parameters and the summary statistics.
+    '''
+    runs = parameter_grid(grid) if isinstance(grid, dict) else list(grid)
+    tasks = [(params, seed) for params in runs for seed in seeds]
+
+    results = []
+    if results_path is not None and os.path.exists(results_path):
+        results = pd.read_csv(results_path).to_dict("records")
+        finished = {result["run_id"] for result in results}
+        tasks = [(params, seed) for params, seed in tasks if run_id(params, seed) not in finished]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_single, build_agents, params, seed) for params, seed in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if results_path is not None:
+                pd.DataFrame([result]).to_csv(results_path, mode="a", index=False,
+                                              header=not os.path.exists(results_path))
+
+    return pd.DataFrame(results)
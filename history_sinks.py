@@ -0,0 +1,160 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class HistorySink:
+    """Base class of the sinks that write the simulation history to disk in batches.
+    Every table (trades, market, agents, compliance) is stored in its own directory as a sequence of chunks,
+    described by a manifest.json with the columns, categories, and the day range of each chunk.
+    The manifest is rewritten after every chunk, so the history of an interrupted run can still be read.
+    Properties:
+        directory (str): The output directory.
+        format (str): The file format of the chunks ("npy" or "parquet").
+        manifests (dict): The manifest of each table.
+    """
+    format = None
+
+    def __init__(self, directory):
+        """Initializes the sink.
+        Args:
+            directory (str): The output directory, created if it does not exist.
+        """
+        self.directory = directory
+        self.manifests = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, table, columns, categories=None):
+        '''
+        Writes a batch of rows of a table as new chunk.
+        Args:
+            table (str): The name of the table.
+            columns (dict): The columns of the batch as arrays.
+            categories (dict): Categories of columns that store category codes.
+        '''
+        rows = len(columns["day"])
+        if rows == 0:
+            return
+        table_directory = os.path.join(self.directory, table)
+        manifest = self.manifests.get(table)
+        if manifest is None:
+            os.makedirs(table_directory, exist_ok=True)
+            manifest = {"format": self.format,
+                        "columns": {name: np.asarray(column).dtype.str for name, column in columns.items()},
+                        "categories": {name: list(values) for name, values in (categories or {}).items()},
+                        "chunks": []}
+            self.manifests[table] = manifest
+
+        chunk = f"{len(manifest['chunks']):05d}"
+        self.write_chunk(table_directory, chunk, columns)
+        manifest["chunks"].append({"name": chunk, "rows": rows,
+                                   "day_min": int(np.min(columns["day"])), "day_max": int(np.max(columns["day"]))})
+        with open(os.path.join(table_directory, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+    def write_chunk(self, table_directory, chunk, columns):
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        Closes the sink. All chunks are already on disk, so there is nothing left to do by default.
+        '''
+        pass
+
+
+class NpySink(HistorySink):
+    """Writes every chunk as one .npy file per column, which can be memory-mapped when reading.
+    """
+    format = "npy"
+
+    def write_chunk(self, table_directory, chunk, columns):
+        for name, column in columns.items():
+            np.save(os.path.join(table_directory, f"{name}.{chunk}.npy"), np.asarray(column))
+
+
+class ParquetSink(HistorySink):
+    """Writes every chunk as one Parquet file. Requires pyarrow.
+    """
+    format = "parquet"
+
+    def __init__(self, directory):
+        if pa is None:
+            raise ImportError("ParquetSink requires pyarrow")
+        super().__init__(directory)
+
+    def write_chunk(self, table_directory, chunk, columns):
+        pq.write_table(pa.table({name: np.asarray(column) for name, column in columns.items()}),
+                       os.path.join(table_directory, f"{chunk}.parquet"))
+
+
+def make_sink(directory, format="auto"):
+    '''
+    Creates a sink for the given directory.
+    Args:
+        directory (str): The output directory.
+        format (str): "parquet", "npy", or "auto" (Parquet if pyarrow is available, otherwise .npy).
+    Returns:
+        HistorySink: The sink.
+    '''
+    if format == "auto":
+        format = "parquet" if pa is not None else "npy"
+    if format == "parquet":
+        return ParquetSink(directory)
+    elif format == "npy":
+        return NpySink(directory)
+    raise Exception("Format not supported")
+
+
+def load_history(directory, table, days=None, agents=None):
+    '''
+    Loads (parts of) a table written by a sink. Only the chunks overlapping the requested days are read,
+    .npy chunks are memory-mapped and only the selected rows are copied.
+    Args:
+        directory (str): The output directory of the sink.
+        table (str): The name of the table ("trades", "market", "agents", or "compliance").
+        days (tuple): Inclusive (first day, last day) range to load, None loads all days.
+        agents (list): The agent ids to load (only for tables with an agent column), None loads all agents.
+    Returns:
+        pd.DataFrame: The selected rows.
+    '''
+    table_directory = os.path.join(directory, table)
+    with open(os.path.join(table_directory, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    chunks = manifest["chunks"]
+    if days is not None:
+        chunks = [c for c in chunks if c["day_max"] >= days[0] and c["day_min"] <= days[1]]
+    agents = None if agents is None else np.asarray(agents)
+
+    parts = {name: [] for name in manifest["columns"]}
+    for chunk in chunks:
+        if manifest["format"] == "parquet":
+            columns = pq.read_table(os.path.join(table_directory, f"{chunk['name']}.parquet"))
+            columns = {name: columns.column(name).to_numpy() for name in manifest["columns"]}
+        else:
+            columns = {name: np.load(os.path.join(table_directory, f"{name}.{chunk['name']}.npy"), mmap_mode="r")
+                       for name in manifest["columns"]}
+
+        mask = np.ones(chunk["rows"], dtype=bool)
+        if days is not None:
+            mask &= (columns["day"] >= days[0]) & (columns["day"] <= days[1])
+        if agents is not None:
+            mask &= np.isin(columns["agent"], agents)
+        for name, column in columns.items():
+            parts[name].append(np.asarray(column[mask]))
+
+    frame = {}
+    for name, dtype in manifest["columns"].items():
+        column = np.concatenate(parts[name]) if parts[name] else np.empty(0, dtype=np.dtype(dtype))
+        if name in manifest["categories"]:
+            column = pd.Categorical.from_codes(column, categories=manifest["categories"][name])
+        frame[name] = column
+    return pd.DataFrame(frame, copy=False)
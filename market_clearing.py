@@ -0,0 +1,229 @@
+import numpy as np
+
+
+def find_intersection(offer_prices, offer_quantities, demand_prices, demand_quantities):
+    '''
+    Finds the last crossing between the supply and the demand curve.
+    Offers have to be sorted by ascending price and demands by descending price, the quantities are the
+    cumulative quantities of the curves.
+
+    A pair (i, j) crosses if offer_prices[i] <= demand_prices[j] and offer_quantities[i] < demand_quantities[j].
+    The returned pair is the last crossing pair in offer-major order, which is the same pair the
+    cartesian product of both curves would select. Runs in O(n log n) time and O(n) memory.
+    Args:
+        offer_prices (np.ndarray): Offer prices in ascending order.
+        offer_quantities (np.ndarray): Cumulative offer quantities.
+        demand_prices (np.ndarray): Demand prices in descending order.
+        demand_quantities (np.ndarray): Cumulative demand quantities.
+    Returns:
+        tuple: (offer index, demand index) of the crossing, or None if the curves do not cross.
+    '''
+    if len(offer_prices) == 0 or len(demand_prices) == 0:
+        return None
+
+    # number of demands willing to pay at least the offer price (demand prices are descending)
+    n_matching_demands = np.searchsorted(-demand_prices, -offer_prices, side="right")
+
+    # an offer crosses if any of its price compatible demands has a larger cumulative quantity.
+    # The running maximum keeps this exact even if the cumulative quantities are not monotonic.
+    max_demand_quantities = np.maximum.accumulate(demand_quantities)
+    has_match = n_matching_demands > 0
+    crosses = np.zeros(len(offer_prices), dtype=bool)
+    crosses[has_match] = max_demand_quantities[n_matching_demands[has_match] - 1] > offer_quantities[has_match]
+
+    offer_indices = np.flatnonzero(crosses)
+    if len(offer_indices) == 0:
+        return None
+    offer_idx = offer_indices[-1]
+
+    demand_indices = np.flatnonzero(demand_quantities[:n_matching_demands[offer_idx]] > offer_quantities[offer_idx])
+    return offer_idx, demand_indices[-1]
+
+
+def clearing_price(offer_prices, offer_quantities, demand_prices, demand_quantities):
+    '''
+    Returns the market clearing price (midpoint of the last crossing offer/demand pair) or None if the
+    supply and demand curves do not cross. See find_intersection() for the expected input format.
+    '''
+    intersection = find_intersection(offer_prices, offer_quantities, demand_prices, demand_quantities)
+    if intersection is None:
+        return None
+    offer_idx, demand_idx = intersection
+    return (offer_prices[offer_idx] + demand_prices[demand_idx]) / 2
+
+
+FILL_DTYPE = np.dtype([("arrival", np.int64), ("queue", np.int64), ("price", np.float64), ("amount", np.float64)])
+TRADE_DTYPE = np.dtype([("buyer", np.int64), ("seller", np.int64), ("price", np.float64), ("amount", np.float64)])
+
+
+def match_orders(queue_prices, queue_counts, arrival_prices, arrival_counts, queue_side):
+    '''
+    Matches the orders of a continuous double auction in which agents arrive one after another and trade with the
+    best orders of a priority queue, e.g. in seller preferred mode the sellers arrive in random order and each seller
+    sells to the highest paying buyers as long as they pay at least the seller's price. The trades happen at the price
+    of the queue order.
+
+    Every arrival consumes a contiguous interval of the cumulative queue quantity, so only the interval ends are computed
+    sequentially (one scalar recurrence per arrival) and the fills are the overlaps of the arrival intervals with the
+    queue order intervals, computed with array operations.
+    Args:
+        queue_prices (np.ndarray): Prices of the queue orders in priority order (best first).
+        queue_counts (np.ndarray): Quantities of the queue orders, non-positive quantities do not trade.
+        arrival_prices (np.ndarray): Prices of the arriving orders in arrival order.
+        arrival_counts (np.ndarray): Quantities of the arriving orders, non-positive quantities do not trade.
+        queue_side (str): "buy" if the queue holds the buyers (descending prices), "sell" if it holds the sellers (ascending prices).
+    Returns:
+        tuple: (fills, arrival_traded, queue_traded). fills is a structured array (FILL_DTYPE) with the arrival position,
+            queue position, price, and amount of every fill in the order the trades happen.
+            arrival_traded and queue_traded are the traded quantities per order.
+    '''
+    sign = -1 if queue_side == "buy" else 1
+    queue_counts = np.maximum(queue_counts, 0)
+    queue_cumulative = np.concatenate(([0.0], np.cumsum(queue_counts)))
+
+    # quantity of the queue orders each arrival accepts (all orders up to the last one with a compatible price)
+    compatible = np.searchsorted(sign * queue_prices, sign * arrival_prices, side="right")
+    available = queue_cumulative[compatible]
+
+    # end of the consumed queue interval after each arrival
+    consumed = 0.0
+    consumed_after = []
+    for count, limit in zip(arrival_counts.tolist(), available.tolist()):
+        if count > 0 and limit > consumed:
+            consumed = min(consumed + count, limit)
+        consumed_after.append(consumed)
+    arrival_ends = np.array(consumed_after, dtype=float)
+    arrival_starts = np.concatenate(([0.0], arrival_ends[:-1]))
+    arrival_traded = arrival_ends - arrival_starts
+
+    # fills are the overlaps of the arrival intervals and the queue order intervals
+    boundaries = np.union1d(arrival_ends, queue_cumulative[queue_cumulative < consumed])
+    boundaries = np.union1d(boundaries, [0.0])
+    starts = boundaries[:-1]
+    amounts = np.diff(boundaries)
+    fills = np.empty(len(amounts), dtype=FILL_DTYPE)
+    fills["arrival"] = np.searchsorted(arrival_ends, starts, side="right")
+    fills["queue"] = np.searchsorted(queue_cumulative, starts, side="right") - 1
+    fills["price"] = queue_prices[fills["queue"]]
+    fills["amount"] = amounts
+
+    queue_traded = np.zeros(len(queue_prices))
+    np.add.at(queue_traded, fills["queue"], fills["amount"])
+    return fills, arrival_traded, queue_traded
+
+
+def searchsorted_rows(a, v, side="left"):
+    '''
+    Row-wise np.searchsorted: the insertion positions of the values of every row of v into the same row of a.
+    Both are merged per row with one stable sort, so all rows are searched at once.
+    Args:
+        a (np.ndarray): Rows sorted in ascending order, shape (rows, n). Shorter rows can be padded with np.inf.
+        v (np.ndarray): The values to insert, shape (rows, m).
+        side (str): "left" or "right", see np.searchsorted().
+    Returns:
+        np.ndarray: The positions, shape (rows, m).
+    '''
+    n, m = a.shape[1], v.shape[1]
+    # the stable sort keeps the values before equal elements of a for side="left" and after them for side="right"
+    if side == "left":
+        merged, from_a = np.concatenate((v, a), axis=1), np.concatenate((np.zeros(m, dtype=bool), np.ones(n, dtype=bool)))
+    else:
+        merged, from_a = np.concatenate((a, v), axis=1), np.concatenate((np.ones(n, dtype=bool), np.zeros(m, dtype=bool)))
+    order = np.argsort(merged, axis=1, kind="stable")
+    sorted_from_a = from_a[order]
+    a_before = np.cumsum(sorted_from_a, axis=1) - sorted_from_a
+    positions = np.empty_like(a_before)
+    np.put_along_axis(positions, order, a_before, axis=1)
+    return positions[:, :m] if side == "left" else positions[:, n:]
+
+
+def clearing_prices(offer_prices, offer_quantities, demand_prices, demand_quantities):
+    '''
+    Row-wise clearing_price() for the curves of many markets at once, e.g. the scenarios of scenario_batch.ScenarioBatch.
+    Every row holds the curves of one market in the format of find_intersection(), shorter curves are padded at the end
+    with np.inf offer prices and -np.inf demand prices (the quantities of the padding are ignored).
+    Returns:
+        tuple: (prices, found), the clearing price of every market (np.nan if the curves do not cross) and whether the curves cross.
+    '''
+    markets = len(offer_prices)
+    prices = np.full(markets, np.nan)
+    if offer_prices.shape[1] == 0 or demand_prices.shape[1] == 0:
+        return prices, np.zeros(markets, dtype=bool)
+
+    # same steps as find_intersection(), on all rows at once
+    n_matching_demands = searchsorted_rows(-demand_prices, -offer_prices, side="right")
+    max_demand_quantities = np.maximum.accumulate(demand_quantities, axis=1)
+    best_demand_quantities = np.take_along_axis(max_demand_quantities, np.maximum(n_matching_demands - 1, 0), axis=1)
+    crosses = (n_matching_demands > 0) & (best_demand_quantities > offer_quantities)
+
+    found = crosses.any(axis=1)
+    rows = np.arange(markets)
+    offer_idx = crosses.shape[1] - 1 - np.argmax(crosses[:, ::-1], axis=1)
+    demand_crosses = ((np.arange(demand_prices.shape[1]) < n_matching_demands[rows, offer_idx][:, None])
+                      & (demand_quantities > offer_quantities[rows, offer_idx][:, None]))
+    demand_idx = demand_crosses.shape[1] - 1 - np.argmax(demand_crosses[:, ::-1], axis=1)
+    prices[found] = (offer_prices[rows, offer_idx][found] + demand_prices[rows, demand_idx][found]) / 2
+    return prices, found
+
+
+ROW_FILL_DTYPE = np.dtype([("row", np.int64)] + [(name, FILL_DTYPE[name]) for name in FILL_DTYPE.names])
+
+
+def match_orders_rows(queue_prices, queue_counts, arrival_prices, arrival_counts, queue_sides):
+    '''
+    Row-wise match_orders() for many markets at once, e.g. the scenarios of scenario_batch.ScenarioBatch.
+    Every row holds the orders of one market, the sequential recurrence over the arrivals runs for all rows at once
+    and the fills of all rows are computed with array operations, so the results of every row are the same as with match_orders().
+    Shorter rows are padded at the end: queue orders with quantity 0 and the worst price (np.inf for sell queues, -np.inf
+    for buy queues), arrivals with quantity 0.
+    Args:
+        queue_prices (np.ndarray): Prices of the queue orders in priority order, shape (rows, queue orders).
+        queue_counts (np.ndarray): Quantities of the queue orders.
+        arrival_prices (np.ndarray): Prices of the arriving orders in arrival order, shape (rows, arrivals).
+        arrival_counts (np.ndarray): Quantities of the arriving orders.
+        queue_sides (np.ndarray): "buy" or "sell" for every row, see match_orders().
+    Returns:
+        tuple: (fills, arrival_traded, queue_traded). fills is a structured array (ROW_FILL_DTYPE) with the row, arrival position,
+            queue position, price, and amount of every fill, by row and in the order the trades happen.
+            arrival_traded and queue_traded are the traded quantities per order, shaped like the orders.
+    '''
+    rows = len(queue_prices)
+    signs = np.where(np.asarray(queue_sides) == "buy", -1.0, 1.0)[:, None]
+    queue_counts = np.maximum(queue_counts, 0)
+    queue_cumulative = np.concatenate((np.zeros((rows, 1)), np.cumsum(queue_counts, axis=1)), axis=1)
+
+    compatible = searchsorted_rows(signs * queue_prices, signs * arrival_prices, side="right")
+    available = np.take_along_axis(queue_cumulative, compatible, axis=1)
+
+    # end of the consumed queue interval after each arrival, one step for all rows
+    consumed = np.zeros(rows)
+    arrival_ends = np.empty(arrival_counts.shape)
+    for i in range(arrival_counts.shape[1]):
+        count, limit = arrival_counts[:, i], available[:, i]
+        consumed = np.where((count > 0) & (limit > consumed), np.minimum(consumed + count, limit), consumed)
+        arrival_ends[:, i] = consumed
+    arrival_starts = np.concatenate((np.zeros((rows, 1)), arrival_ends[:, :-1]), axis=1)
+    arrival_traded = arrival_ends - arrival_starts
+
+    # unique interval boundaries of every row, padded with np.inf
+    boundaries = np.concatenate((np.zeros((rows, 1)), arrival_ends,
+                                 np.where(queue_cumulative < consumed[:, None], queue_cumulative, np.inf)), axis=1)
+    boundaries.sort(axis=1)
+    boundaries[:, 1:][boundaries[:, 1:] == boundaries[:, :-1]] = np.inf
+    boundaries.sort(axis=1)
+    starts = boundaries[:, :-1]
+    valid = np.isfinite(boundaries[:, 1:])
+
+    arrival_positions = searchsorted_rows(arrival_ends, starts, side="right")
+    queue_positions = searchsorted_rows(queue_cumulative, starts, side="right") - 1
+    row, column = np.nonzero(valid)
+    fills = np.empty(len(row), dtype=ROW_FILL_DTYPE)
+    fills["row"] = row
+    fills["arrival"] = arrival_positions[row, column]
+    fills["queue"] = queue_positions[row, column]
+    fills["price"] = queue_prices[row, fills["queue"]]
+    fills["amount"] = boundaries[row, column + 1] - boundaries[row, column]
+
+    queue_traded = np.zeros(queue_prices.shape)
+    np.add.at(queue_traded, (row, fills["queue"]), fills["amount"])
+    return fills, arrival_traded, queue_traded
@@ -0,0 +1,166 @@
+import numpy as np
+from AgentPopulation import BUY, SELL
+
+
+def sort_ties(order, keys, *tiebreaks):
+    '''
+    Sorts the runs of equal keys of an order in place, by the tiebreak arrays (indexed by agent id, the first one is
+    the primary tiebreak) and then by agent id. Only the tied positions are sorted, so this is cheap if ties are rare.
+    Args:
+        order (np.ndarray): Agent ids sorted by their keys.
+        keys (np.ndarray): The keys of the agents in order.
+    Returns:
+        np.ndarray: The order.
+    '''
+    tied = keys[1:] == keys[:-1]
+    if not tied.any():
+        return order
+    positions = np.flatnonzero(np.concatenate(([False], tied)) | np.concatenate((tied, [False])))
+    agents = order[positions]
+    order[positions] = agents[np.lexsort((agents,) + tuple(tiebreak[agents] for tiebreak in reversed(tiebreaks)) + (keys[positions],))]
+    return order
+
+
+class BookSide:
+    """One side of the order book. The orders are kept sorted by sign * price (the best price first) and by agent id.
+    Properties:
+        sign (int): 1 for the sell orders (ascending prices), -1 for the buy orders (descending prices).
+        keys (np.ndarray): sign * order price of every agent, by agent id.
+        counts (np.ndarray): The order quantity of every agent, by agent id.
+        member (np.ndarray): Whether the agent has an order on this side, by agent id.
+        ids (np.ndarray): The agents with an order in ascending order.
+        order (np.ndarray): The agents with an order in book order.
+        repair_share (float): Share of the orders that may be out of place and are still repaired instead of sorting the side again.
+        repaired (int): The number of orders sorted in the last update (all orders if the side was sorted again).
+    """
+
+    def __init__(self, size, sign, repair_share=0.125):
+        """Initializes an empty side.
+        Args:
+            size (int): The number of agents.
+            sign (int): 1 for the sell side, -1 for the buy side.
+            repair_share (float): See the properties.
+        """
+        self.sign = sign
+        self.keys = np.zeros(size)
+        self.counts = np.zeros(size)
+        self.member = np.zeros(size, dtype=bool)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.order = np.empty(0, dtype=np.int64)
+        self.repair_share = repair_share
+        self.repaired = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def update(self, ids, prices, counts):
+        '''
+        Replaces the orders by the orders of the day. The orders of the previous day that are still in the book keep
+        their position, the new orders are added at the end and the book order is restored with repair().
+        Args:
+            ids (np.ndarray): The agents with an order, in ascending order.
+            prices (np.ndarray): The order prices.
+            counts (np.ndarray): The order quantities.
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        added = ids[~self.member[ids]]
+        self.member[self.ids] = False
+        self.member[ids] = True
+        kept = self.order[self.member[self.order]]
+        self.ids = ids
+        self.keys[ids] = np.asarray(prices, dtype=float) * self.sign
+        self.counts[ids] = counts
+        self.order = self.repair(np.concatenate((kept, added)))
+
+    def repair(self, candidates):
+        '''
+        Returns the candidates in book order. The orders that are out of place (below an earlier order or above a later one,
+        whichever are fewer) are taken out, sorted, and merged back into the sorted rest. If more than repair_share
+        of the orders are out of place, all of them are sorted.
+        '''
+        keys = self.keys[candidates]
+        in_place = keys == np.maximum.accumulate(keys)
+        not_above_later = keys == np.minimum.accumulate(keys[::-1])[::-1]
+        if np.count_nonzero(not_above_later) > np.count_nonzero(in_place):
+            in_place = not_above_later
+        displaced = len(keys) - np.count_nonzero(in_place)
+
+        if displaced == 0:
+            order = candidates
+            self.repaired = 0
+        elif displaced <= self.repair_share * len(keys):
+            moved = candidates[~in_place]
+            moved_keys = keys[~in_place]
+            by_key = np.argsort(moved_keys)
+            positions = np.searchsorted(keys[in_place], moved_keys[by_key], side="right")
+            order = np.insert(candidates[in_place], positions, moved[by_key])
+            self.repaired = displaced
+        else:
+            order = candidates[np.argsort(keys)]
+            self.repaired = len(keys)
+        return sort_ties(order, self.keys[order])
+
+    def curve(self):
+        '''
+        Returns the curve of the side as (price, cumulative quantity) rows in book order, None if the side is empty.
+        '''
+        if len(self.order) == 0:
+            return None
+        return np.column_stack((self.keys[self.order] * self.sign, np.cumsum(self.counts[self.order])))
+
+    def priority(self, tiebreaks):
+        '''
+        Returns the agents in matching priority: book order, equal prices ordered by the tiebreaks and then by agent id.
+        Args:
+            tiebreaks (np.ndarray): One random number per order, for the agents in ascending order (ids).
+        '''
+        tiebreak = np.zeros(len(self.keys))
+        tiebreak[self.ids] = tiebreaks
+        return sort_ties(self.order.copy(), self.keys[self.order], tiebreak)
+
+
+class OrderBook:
+    """The order book of a market, kept across days instead of being rebuilt and sorted every day.
+    The trade prices of the agents change by small steps from one day to the next, so most orders keep their place
+    and only the orders that moved past others are sorted again (see BookSide.repair()).
+    The market price is calculated from the curves of the book and the orders are matched in the order of the book.
+    Properties:
+        sides (dict): The BookSide of the buy orders (BUY) and of the sell orders (SELL).
+    """
+
+    def __init__(self, size, repair_share=0.125):
+        """Initializes an empty book.
+        Args:
+            size (int): The number of agents.
+            repair_share (float): See BookSide.
+        """
+        self.sides = {BUY: BookSide(size, -1, repair_share), SELL: BookSide(size, 1, repair_share)}
+
+    @property
+    def repaired(self):
+        """The number of orders sorted in the last update of both sides."""
+        return sum(side.repaired for side in self.sides.values())
+
+    def update(self, side, ids, prices, counts):
+        '''
+        Replaces the orders of one side by the orders of the day, see BookSide.update().
+        Args:
+            side (int): BUY or SELL.
+            ids (np.ndarray): The agents with an order, in ascending order.
+            prices (np.ndarray): The order prices.
+            counts (np.ndarray): The order quantities.
+        '''
+        self.sides[side].update(ids, prices, counts)
+
+    def curves(self):
+        '''
+        Returns the demand curve (descending prices) and the supply curve (ascending prices) as (price, cumulative quantity) rows,
+        None for an empty side (see BookSide.curve()).
+        '''
+        return self.sides[BUY].curve(), self.sides[SELL].curve()
+
+    def priority(self, side, tiebreaks):
+        '''
+        Returns the agents of one side in matching priority, see BookSide.priority().
+        '''
+        return self.sides[side].priority(tiebreaks)
@@ -0,0 +1,165 @@
+import os
+import numpy as np
+from market_clearing import clearing_price
+
+# one fixed size index record per stored day
+INDEX_DTYPE = np.dtype([("day", np.int64), ("offset", np.int64), ("demands", np.int64), ("offers", np.int64),
+                        ("quantity_type", np.int64), ("market_price", np.float64)])
+# encodings of the order quantities, the first one that represents the quantities exactly is used
+QUANTITY_DTYPES = (np.dtype(np.int32), np.dtype(np.float32), np.dtype(np.float64))
+
+
+class OrderBookStore:
+    """Append-only store of the daily order books (sorted supply and demand curves) of a simulation.
+    The books are written to a single data file, a day index with one fixed size record per day is written next to it.
+    Both files are read back memory mapped, so the book of any day is available in O(1) without simulating again.
+
+    Prices are stored as float32. The cumulative quantities of the curves are delta encoded (the quantity of every order)
+    and stored as int32 if the order quantities are integers, otherwise as float32 or float64, whichever is exact.
+    Properties:
+        directory (str): The directory of the store.
+        writable (bool): Whether books can be appended.
+    """
+
+    def __init__(self, directory, mode="a"):
+        """Opens or creates a store.
+        Args:
+            directory (str): The directory of the store, created in append mode if it does not exist.
+            mode (str): "a" to append books (existing books are kept), "r" to read only.
+        """
+        self.directory = directory
+        self.writable = mode == "a"
+        self.data_path = os.path.join(directory, "books.bin")
+        self.index_path = os.path.join(directory, "index.bin")
+        if self.writable:
+            os.makedirs(directory, exist_ok=True)
+            self.data_file = open(self.data_path, "ab")
+            self.index_file = open(self.index_path, "ab")
+            self.size = self.data_file.tell()
+        else:
+            self.data_file = None
+            self.index_file = None
+            self.size = os.path.getsize(self.data_path)
+        self.mapped_index = None
+        self.mapped_data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, day, demands, offers, market_price):
+        '''
+        Appends the order book of a day.
+        Args:
+            day (int): The day, days have to be appended in increasing order.
+            demands (np.ndarray): The demand curve as (price, cumulative quantity) rows in descending price order, None if empty.
+            offers (np.ndarray): The supply curve as (price, cumulative quantity) rows in ascending price order, None if empty.
+            market_price (float): The market price of the day.
+        '''
+        demands = np.empty((0, 2)) if demands is None else np.asarray(demands, dtype=float).reshape(-1, 2)
+        offers = np.empty((0, 2)) if offers is None else np.asarray(offers, dtype=float).reshape(-1, 2)
+        quantities = np.concatenate([np.diff(demands[:, 1], prepend=0), np.diff(offers[:, 1], prepend=0)])
+        quantity_type = next(i for i, dtype in enumerate(QUANTITY_DTYPES) if self.exact(quantities, dtype))
+
+        record = np.array([(day, self.size, len(demands), len(offers), quantity_type, market_price)], dtype=INDEX_DTYPE)
+        data = (np.concatenate([demands[:, 0], offers[:, 0]]).astype(np.float32).tobytes()
+                + quantities.astype(QUANTITY_DTYPES[quantity_type]).tobytes())
+        # keep every book 8 byte aligned
+        data += bytes(-len(data) % 8)
+        self.data_file.write(data)
+        self.index_file.write(record.tobytes())
+        self.size += len(data)
+
+    @staticmethod
+    def exact(values, dtype):
+        '''
+        Returns whether the values are represented exactly by dtype.
+        '''
+        if len(values) == 0:
+            return True
+        if dtype.kind == "i":
+            info = np.iinfo(dtype)
+            return bool(np.all(values == np.rint(values)) and values.min() >= info.min and values.max() <= info.max)
+        return bool(np.all(values.astype(dtype) == values))
+
+    def flush(self):
+        '''
+        Writes the buffered books to disk.
+        '''
+        if self.writable:
+            self.data_file.flush()
+            self.index_file.flush()
+
+    def close(self):
+        '''
+        Flushes and closes the files, the store can still be read.
+        '''
+        if self.writable:
+            self.flush()
+            self.data_file.close()
+            self.index_file.close()
+            self.writable = False
+
+    @property
+    def index(self):
+        """The day index as memory mapped structured array (INDEX_DTYPE)."""
+        self.flush()
+        records = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        if self.mapped_index is None or len(self.mapped_index) != records:
+            self.mapped_index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode="r", shape=(records,)) if records > 0 \
+                else np.empty(0, dtype=INDEX_DTYPE)
+        return self.mapped_index
+
+    @property
+    def data(self):
+        """The book data as memory mapped bytes."""
+        self.flush()
+        if self.mapped_data is None or len(self.mapped_data) != self.size:
+            self.mapped_data = np.memmap(self.data_path, dtype=np.uint8, mode="r") if self.size > 0 else np.empty(0, dtype=np.uint8)
+        return self.mapped_data
+
+    def days(self):
+        '''
+        Returns the stored days.
+        '''
+        return np.asarray(self.index["day"])
+
+    def position(self, day):
+        '''
+        Returns the position of a day in the index. Consecutive days are found directly, others by binary search.
+        '''
+        days = self.index["day"]
+        if len(days) == 0:
+            raise KeyError(day)
+        position = day - days[0]
+        if not (0 <= position < len(days) and days[position] == day):
+            position = np.searchsorted(days, day)
+            if position == len(days) or days[position] != day:
+                raise KeyError(day)
+        return int(position)
+
+    def book(self, day):
+        '''
+        Returns the order book of a day in the format of plotting.CurveRecorder (so it can be plotted with
+        plotting.plot_supply_demand()): day, market_price, demand_prices, demand_quantities, offer_prices, offer_quantities,
+        the quantities are cumulative.
+        '''
+        record = self.index[self.position(day)]
+        demands, offers, offset = int(record["demands"]), int(record["offers"]), int(record["offset"])
+        data = self.data
+        prices = np.frombuffer(data, dtype=np.float32, count=demands + offers, offset=offset)
+        quantity_dtype = QUANTITY_DTYPES[int(record["quantity_type"])]
+        quantities = np.frombuffer(data, dtype=quantity_dtype, count=demands + offers, offset=offset + 4 * (demands + offers))
+        quantities = quantities.astype(np.float64)
+        return {"day": int(record["day"]), "market_price": float(record["market_price"]),
+                "demand_prices": prices[:demands], "demand_quantities": np.cumsum(quantities[:demands]),
+                "offer_prices": prices[demands:], "offer_quantities": np.cumsum(quantities[demands:])}
+
+    def clearing_price(self, day):
+        '''
+        Recalculates the clearing price of a day from the stored book (see market_clearing.clearing_price()).
+        Prices are stored as float32, so the result can differ from the recorded market price in the last digits.
+        Returns None if the curves do not cross.
+        '''
+        book = self.book(day)
+        return clearing_price(book["offer_prices"].astype(np.float64), book["offer_quantities"],
+                              book["demand_prices"].astype(np.float64), book["demand_quantities"])
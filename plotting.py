@@ -0,0 +1,220 @@
+import logging
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+logger = logging.getLogger(__name__)
+# the worker process of submit_to_background(), started on first use
+_background_executor = None
+
+
+class CurveRecorder:
+    """Captures the supply and demand curves of selected days during a simulation as compact float32 arrays,
+    so they can be plotted after the run (see render_curves()) instead of blocking the simulation on matplotlib.
+    Properties:
+        days (set): The days to capture, None to capture only the days the environment is updated with plot=True.
+        every (int): Additionally capture every `every` days, None to disable.
+        curves (list): The captured curves, one dictionary per day (day, market_price, demand_prices, demand_quantities,
+            offer_prices, offer_quantities) with the cumulative quantities.
+    """
+
+    def __init__(self, days=None, every=None):
+        """Initializes an empty recorder.
+        Args:
+            days (list): The days to capture.
+            every (int): Capture every `every` days.
+        """
+        self.days = set(days) if days is not None else set()
+        self.every = every
+        self.curves = []
+
+    def __len__(self):
+        return len(self.curves)
+
+    def selects(self, day):
+        '''
+        Returns whether the curves of a day are captured without the plot flag.
+        '''
+        return day in self.days or (self.every is not None and day % self.every == 0)
+
+    def record(self, day, demands, offers, market_price):
+        '''
+        Captures the curves of a day.
+        Args:
+            day (int): The day.
+            demands (np.ndarray): The demand curve as (price, cumulative quantity) rows in descending price order.
+            offers (np.ndarray): The supply curve as (price, cumulative quantity) rows in ascending price order.
+            market_price (float): The market price of the day.
+        '''
+        self.curves.append({"day": day, "market_price": float(market_price),
+                            "demand_prices": demands[:, 0].astype(np.float32), "demand_quantities": demands[:, 1].astype(np.float32),
+                            "offer_prices": offers[:, 0].astype(np.float32), "offer_quantities": offers[:, 1].astype(np.float32)})
+
+    def save(self, path):
+        '''
+        Saves the captured curves to a .npz file, e.g. to render them in another process after the run.
+        '''
+        arrays = {}
+        for i, curve in enumerate(self.curves):
+            for name, value in curve.items():
+                arrays[f"{i}_{name}"] = np.asarray(value)
+        np.savez(path, count=len(self.curves), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads curves saved by save().
+        '''
+        recorder = cls()
+        with np.load(path) as data:
+            names = ("day", "market_price", "demand_prices", "demand_quantities", "offer_prices", "offer_quantities")
+            for i in range(int(data["count"])):
+                curve = {name: data[f"{i}_{name}"] for name in names}
+                curve["day"] = int(curve["day"])
+                curve["market_price"] = float(curve["market_price"])
+                recorder.curves.append(curve)
+        return recorder
+
+
+def plot_supply_demand(ax, curve):
+    '''
+    Plots the supply and demand curves and the market price of a captured day on a matplotlib axis.
+    '''
+    ax.set_title(f"Supply and Demand Curves, Day: {curve['day']}")
+    ax.step(curve["demand_quantities"], curve["demand_prices"], label="Demand")
+    ax.step(curve["offer_quantities"], curve["offer_prices"], label="Supply")
+    ax.axhline(curve["market_price"], color="black", linestyle="--", label="Market Price")
+    ax.legend()
+    ax.set_xlabel("Quantity")
+    ax.set_ylabel("Price")
+
+
+def supply_demand_figure(curve):
+    '''
+    Returns a figure of the supply and demand curves of a captured day. The figure is created without pyplot,
+    so it is not registered globally and is freed like any other object.
+    '''
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(5, 3))
+    plot_supply_demand(fig.add_subplot(), curve)
+    fig.tight_layout()
+    return fig
+
+
+def background_executor():
+    '''
+    Returns a single worker process for rendering. The worker is spawned instead of forked, so it does not inherit
+    locks held by other threads (e.g. a rendering thread importing matplotlib).
+    '''
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+
+
+def submit_to_background(function, *args):
+    '''
+    Runs a function in the rendering worker process (see background_executor()). The worker is started once and reused
+    by all calls, a new one is started if it died. Failures are logged when they happen, in case nobody waits for the future.
+    Returns:
+        concurrent.futures.Future: Resolves to the result of the function.
+    '''
+    global _background_executor
+    if _background_executor is None:
+        _background_executor = background_executor()
+    try:
+        future = _background_executor.submit(function, *args)
+    except BrokenProcessPool:
+        _background_executor = background_executor()
+        future = _background_executor.submit(function, *args)
+    future.add_done_callback(log_failure)
+    return future
+
+
+def log_failure(future):
+    '''
+    Logs the error of a failed background job.
+    '''
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("background rendering failed", exc_info=future.exception())
+
+
+def wait_for_figures(futures):
+    '''
+    Waits until the figures saved in the background are written, e.g. at the end of a notebook.
+    Raises the error of the first failed figure.
+    Returns:
+        list: The paths of the written images.
+    '''
+    return [future.result() for future in futures]
+
+
+def render_curves(curves, directory, dpi=150, fmt="png"):
+    '''
+    Renders captured curves to image files with the Agg backend (no display needed).
+    Args:
+        curves (CurveRecorder or str): The recorder or the path of curves saved with CurveRecorder.save().
+        directory (str): The output directory, created if it does not exist.
+        dpi (int): The resolution of the images.
+        fmt (str): The image format.
+    Returns:
+        list: The paths of the written images.
+    '''
+    if isinstance(curves, str):
+        curves = CurveRecorder.load(curves)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for curve in curves.curves:
+        path = os.path.join(directory, f"supply_demand_day_{curve['day']:05d}.{fmt}")
+        supply_demand_figure(curve).savefig(path, dpi=dpi)
+        paths.append(path)
+    return paths
+
+
+def render_in_background(curves, directory, dpi=150, fmt="png", process=False):
+    '''
+    Renders captured curves (see render_curves()) in a background thread, or in a separate process with process=True.
+    Returns:
+        concurrent.futures.Future: Resolves to the paths of the written images.
+    '''
+    if process:
+        return submit_to_background(render_curves, curves, directory, dpi, fmt)
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(render_curves, curves, directory, dpi, fmt)
+    executor.shutdown(wait=False)
+    return future
+
+
+def show_curves(curves):
+    '''
+    Shows captured curves with pyplot, e.g. in the notebook after a run.
+    '''
+    from matplotlib import pyplot as plt
+    for curve in curves.curves:
+        fig, ax = plt.subplots(figsize=(5, 3))
+        plot_supply_demand(ax, curve)
+        plt.show()
+
+
+def save_figure_in_background(fig, path, dpi=450):
+    '''
+    Saves a figure in the rendering worker process (see submit_to_background()), so rendering large images does not block
+    the caller. The figure is pickled, so it can be shown or closed right away. The directory of the path is created first.
+    Returns:
+        concurrent.futures.Future: Resolves to the path of the written image, see wait_for_figures().
+    '''
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return submit_to_background(save_pickled_figure, pickle.dumps(fig), path, dpi)
+
+
+def save_pickled_figure(data, path, dpi):
+    '''
+    Saves a pickled figure with the Agg backend, used by save_figure_in_background().
+    '''
+    import matplotlib
+    matplotlib.use("Agg")
+    fig = pickle.loads(data)
+    fig.savefig(path, dpi=dpi)
+    return path
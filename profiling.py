@@ -0,0 +1,153 @@
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+import numpy as np
+from HistoryRecorder import ColumnTable
+
+# context of disabled profiling, shared so a disabled phase costs only a method call
+NO_PHASE = nullcontext()
+
+
+class Profiler:
+    """Opt-in instrumentation of a simulation. Records the wall time and allocations of every phase per day and
+    counters like the order book sizes, number of trades, and matching queue operations. Phases can be nested.
+    The records are kept in compact columns (see HistoryRecorder.ColumnTable), so long runs can be profiled.
+    Properties:
+        trace_memory (bool): Whether to record the peak traced memory of every phase with tracemalloc (slow).
+        names (list): The phase and counter names, stored as category codes.
+        phases (ColumnTable): One row per phase call (day, phase, start, duration, allocated blocks, peak bytes, depth).
+        counters (ColumnTable): One row per counter value (day, counter, value).
+        origin (float): The perf_counter time the profiler was created, start times are relative to it.
+        depth (int): The current nesting depth of phases.
+        peaks (list): The traced memory peak of every open phase so far, the peaks of nested phases are folded into their parents.
+    """
+
+    def __init__(self, trace_memory=False, chunk_size=4096):
+        """Initializes an empty profile.
+        Args:
+            trace_memory (bool): Whether to record the peak traced memory of every phase. Starts tracemalloc if needed.
+            chunk_size (int): The minimum number of rows the record tables grow by.
+        """
+        self.trace_memory = trace_memory
+        self.names = []
+        self.codes = {}
+        self.phases = ColumnTable({"day": np.int32, "phase": np.int32, "start": np.float64, "duration": np.float64,
+                                   "allocated_blocks": np.int64, "peak_bytes": np.int64, "depth": np.int8},
+                                  categories={"phase": self.names}, chunk_size=chunk_size)
+        self.counters = ColumnTable({"day": np.int32, "counter": np.int32, "value": np.float64},
+                                    categories={"counter": self.names}, chunk_size=chunk_size)
+        self.origin = time.perf_counter()
+        self.depth = 0
+        self.peaks = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def code(self, name):
+        '''
+        Returns the category code of a phase or counter name.
+        '''
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    @contextmanager
+    def phase(self, name, day):
+        '''
+        Context manager that records one call of a phase.
+        Args:
+            name (str): The name of the phase.
+            day (int or callable): The simulation day, or a function returning it at the end of the phase,
+                so phases that advance the day are recorded on the new day.
+        '''
+        if self.trace_memory:
+            # the peak is reset for this phase, the peak of the enclosing phase so far is kept on the stack
+            start_memory, peak = tracemalloc.get_traced_memory()
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self.peaks.append(start_memory)
+        start_blocks = sys.getallocatedblocks()
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.depth -= 1
+            peak = 0
+            if self.trace_memory:
+                peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self.peaks:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+                peak -= start_memory
+            if callable(day):
+                day = day()
+            self.phases.append(day=day, phase=self.code(name), start=start - self.origin, duration=end - start,
+                               allocated_blocks=sys.getallocatedblocks() - start_blocks, peak_bytes=peak, depth=self.depth)
+
+    def count(self, name, value, day):
+        '''
+        Records the value of a counter (e.g. the number of trades) on a day.
+        '''
+        self.counters.append(day=day, counter=self.code(name), value=value)
+
+    def phase_frame(self):
+        '''
+        Returns the phase records as DataFrame. allocated_blocks is the net change of allocated Python memory blocks
+        (sys.getallocatedblocks()), peak_bytes the peak traced memory above the start of the phase (only with trace_memory).
+        '''
+        return self.phases.to_frame().rename(columns={"start": "start_seconds", "duration": "duration_seconds"})
+
+    def counter_frame(self):
+        '''
+        Returns the counters as DataFrame with one row per day and one column per counter.
+        '''
+        counters = self.counters.to_frame()
+        return counters.pivot_table(index="day", columns="counter", values="value", aggfunc="sum", observed=True)
+
+    def summary(self):
+        '''
+        Returns the statistics of every phase over all days (calls, total, mean, and max duration, allocations, peak memory),
+        slowest phase first.
+        '''
+        frame = self.phase_frame()
+        summary = frame.groupby("phase", observed=True).agg(calls=("duration_seconds", "size"),
+                                                            total_seconds=("duration_seconds", "sum"),
+                                                            mean_seconds=("duration_seconds", "mean"),
+                                                            max_seconds=("duration_seconds", "max"),
+                                                            allocated_blocks=("allocated_blocks", "sum"),
+                                                            peak_bytes=("peak_bytes", "max"))
+        return summary.sort_values("total_seconds", ascending=False)
+
+    def chrome_trace(self):
+        '''
+        Returns the profile in the Chrome trace event format (phases as complete events, counters as counter events).
+        '''
+        events = []
+        phases = self.phases.raw_columns()
+        for day, phase, start, duration, blocks, peak in zip(phases["day"].tolist(), phases["phase"].tolist(), phases["start"].tolist(),
+                                                             phases["duration"].tolist(), phases["allocated_blocks"].tolist(),
+                                                             phases["peak_bytes"].tolist()):
+            events.append({"name": self.names[phase], "cat": "phase", "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                           "pid": 0, "tid": 0, "args": {"day": day, "allocated_blocks": blocks, "peak_bytes": peak}})
+
+        # counters are placed at the start of the first phase of their day
+        day_starts = {}
+        for day, start in zip(phases["day"].tolist(), phases["start"].tolist()):
+            day_starts.setdefault(day, start)
+        counters = self.counters.raw_columns()
+        for day, counter, value in zip(counters["day"].tolist(), counters["counter"].tolist(), counters["value"].tolist()):
+            events.append({"name": self.names[counter], "cat": "counter", "ph": "C", "ts": day_starts.get(day, 0.0) * 1e6,
+                           "pid": 0, "args": {"value": value}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path):
+        '''
+        Writes the profile as Chrome trace JSON (open it in chrome://tracing or https://ui.perfetto.dev).
+        '''
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def make_rng(rng=None):
+    '''
+    Returns a np.random.Generator for a simulation component.
+    Args:
+        rng (np.random.Generator, np.random.SeedSequence, int or None): A generator is returned as is, seeds and seed sequences
+            create a new generator. None creates a generator seeded from the global NumPy random state, so code that only
+            calls np.random.seed() (like the notebook) stays reproducible.
+    Returns:
+        np.random.Generator: The generator.
+    '''
+    if isinstance(rng, np.random.Generator):
+        return rng
+    if rng is None:
+        rng = np.random.randint(0, 2**32, dtype=np.uint64)
+    return np.random.default_rng(rng)
+
+
+def spawn_rngs(rng, count):
+    '''
+    Spawns count independent child generators (through the SeedSequence of rng).
+    Args:
+        rng (np.random.Generator, np.random.SeedSequence, int or None): The parent, see make_rng().
+        count (int): The number of children.
+    Returns:
+        list: The child generators.
+    '''
+    return make_rng(rng).spawn(count)
@@ -0,0 +1,161 @@
+import numpy as np
+
+
+def compensated_add(total, compensation, value):
+    '''
+    Adds a value to a sum with Neumaier's compensated summation, for floats and elementwise for arrays.
+    The compensation collects the rounding error of every addition, total + compensation is the sum
+    up to a rounding error that does not grow with the number of additions.
+    Returns:
+        tuple: The new total and compensation.
+    '''
+    new_total = total + value
+    if isinstance(new_total, np.ndarray):
+        compensation = compensation + np.where(np.abs(total) >= np.abs(value), (total - new_total) + value, (value - new_total) + total)
+    elif abs(total) >= abs(value):
+        compensation = compensation + ((total - new_total) + value)
+    else:
+        compensation = compensation + ((value - new_total) + total)
+    return new_total, compensation
+
+
+def compensated_replace(total, compensation, value, dropped):
+    '''
+    Adds value to and subtracts dropped from a scalar compensated sum, the same operations as two calls of compensated_add()
+    without their overhead (push() runs once per agent and day).
+    '''
+    added = total + value
+    compensation += (total - added) + value if abs(total) >= abs(value) else (value - added) + total
+    new_total = added - dropped
+    compensation += (added - new_total) - dropped if abs(added) >= abs(dropped) else (-dropped - new_total) + added
+    return new_total, compensation
+
+
+class RollingWindow:
+    """Ring buffer over the last values of a series with running sums, so the window statistics are updated in O(1) per step.
+    Works for scalar series (shape=None, values are kept in a list) and for series of arrays, e.g. one value per agent.
+    The running sums use compensated summation (see compensated_add()), so values leaving the window do not leave rounding
+    errors behind: mean() and recent_mean() stay within 2 units in the last place of the exactly rounded mean of the window
+    values, while a plain running sum drifts by orders of magnitude more once large values left the window.
+    Scalar and array series do the same operations, so an agent and its column in an array series get identical statistics.
+    Properties:
+        size (int): The number of values in the full window.
+        recent (int): The number of values in the short window of the most recent values.
+        count (int): The number of values pushed so far.
+        total (float or np.ndarray): Running sum over the full window.
+        recent_total (float or np.ndarray): Running sum over the short window.
+        compensation (float or np.ndarray): The rounding error of total, see compensated_add().
+        recent_compensation (float or np.ndarray): The rounding error of recent_total.
+    """
+
+    def __init__(self, size, recent=10, shape=None):
+        """Initializes an empty window.
+        Args:
+            size (int): The number of values in the full window.
+            recent (int): The number of values in the short window, has to be at most size.
+            shape (tuple): The shape of the values, None for scalar values.
+        """
+        if recent > size:
+            raise ValueError("recent window can not be larger than the full window")
+        self.size = size
+        self.recent = recent
+        self.shape = shape
+        self.count = 0
+        self.position = 0
+        if shape is None:
+            self.buffer = [0.0] * size
+            self.total = self.compensation = 0.0
+            self.recent_total = self.recent_compensation = 0.0
+        else:
+            self.buffer = np.zeros((size,) + tuple(shape))
+            self.total, self.compensation = np.zeros(shape), np.zeros(shape)
+            self.recent_total, self.recent_compensation = np.zeros(shape), np.zeros(shape)
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def push(self, value):
+        '''
+        Adds a value to the window, the oldest value drops out of the full window once it is filled.
+        '''
+        # read the values leaving the windows before the slot is overwritten
+        dropped = self.buffer[self.position]
+        dropped_recent = self.buffer[(self.position - self.recent) % self.size] if self.count >= self.recent else 0.0
+        if self.shape is None:
+            self.total, self.compensation = compensated_replace(self.total, self.compensation, value, dropped)
+            self.recent_total, self.recent_compensation = compensated_replace(self.recent_total, self.recent_compensation,
+                                                                              value, dropped_recent)
+        else:
+            self.total, self.compensation = compensated_add(*compensated_add(self.total, self.compensation, value), -dropped)
+            self.recent_total, self.recent_compensation = compensated_add(
+                *compensated_add(self.recent_total, self.recent_compensation, value), -dropped_recent)
+        self.buffer[self.position] = value
+
+        self.position = (self.position + 1) % self.size
+        self.count += 1
+
+        # recompute the sums once per window length, so not even the second order errors can accumulate
+        if self.position == 0:
+            self.resync()
+
+    def resync(self):
+        '''
+        Recomputes the running sums from the values in the window, in chronological order.
+        '''
+        values = self.values()
+        self.total, self.compensation = self.compensated_sum(values)
+        self.recent_total, self.recent_compensation = self.compensated_sum(values[-self.recent:])
+
+    def compensated_sum(self, values):
+        '''
+        Returns the compensated sum (total, compensation) of values, see compensated_add().
+        '''
+        if self.shape is None:
+            total = compensation = 0.0
+        else:
+            total, compensation = np.zeros(self.shape), np.zeros(self.shape)
+        for value in values:
+            total, compensation = compensated_add(total, compensation, value)
+        return total, compensation
+
+    def subset(self, index):
+        '''
+        Returns the window of the selected entries of an array series (e.g. the agents of a shard), with the same position.
+        '''
+        window = RollingWindow.__new__(RollingWindow)
+        window.size, window.recent, window.count, window.position = self.size, self.recent, self.count, self.position
+        window.buffer = self.buffer[:, index].copy()
+        window.total = self.total[index].copy()
+        window.recent_total = self.recent_total[index].copy()
+        window.compensation = self.compensation[index].copy()
+        window.recent_compensation = self.recent_compensation[index].copy()
+        window.shape = window.total.shape
+        return window
+
+    def values(self):
+        '''
+        Returns the values of the full window in chronological order.
+        '''
+        n = len(self)
+        indices = [(self.position - n + i) % self.size for i in range(n)]
+        if self.shape is None:
+            return [self.buffer[i] for i in indices]
+        return self.buffer[indices]
+
+    def last(self):
+        '''
+        Returns the most recent value.
+        '''
+        return self.buffer[(self.position - 1) % self.size]
+
+    def mean(self):
+        '''
+        Returns the mean over the full window.
+        '''
+        return (self.total + self.compensation) / len(self)
+
+    def recent_mean(self):
+        '''
+        Returns the mean over the short window of the most recent values.
+        '''
+        return (self.recent_total + self.recent_compensation) / min(self.count, self.recent)
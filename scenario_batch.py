@@ -0,0 +1,330 @@
+import numpy as np
+import pandas as pd
+from AgentPopulation import AgentPopulation, BUY, SELL, IDLE
+from CompanyAgent import k, DAYS_PER_YEAR
+from HistoryRecorder import ColumnTable
+from market_clearing import clearing_prices, match_orders_rows
+from random_streams import make_rng
+from rolling_statistics import RollingWindow
+from abatement import AbatementCurves
+
+# parameters of generate_scenario_market() with the defaults of simulation.generate_market()
+MARKET_PARAMETERS = {"sell_price": (0, 100), "buy_price": (0, 100), "activate_abatement": True, "emission_rate_noise": 0.1,
+                     "expected_emission_noise": 0.1, "advanced_trading": False}
+# parameters of the scenarios that configure the market of ScenarioBatch
+BATCH_PARAMETERS = {"mode": "seller_preferred", "initial_market_price": 5}
+
+
+class ScenarioPopulation(AgentPopulation):
+    """The same agents in several scenarios, held in one AgentPopulation whose state arrays have the shape (scenarios, agents).
+    The phases of the daily update are elementwise array operations, so the AgentPopulation methods update all scenarios at once.
+    The abatement cost curves belong to the agents and are shared by all scenarios, the agents of scenarios without
+    abatement never abate.
+    Properties:
+        abatement (np.ndarray): Whether the agents of each scenario can abate, shape (scenarios,).
+    """
+
+    def __init__(self, expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise=0.1,
+                 emission_rate_noise=0.01, activate_abatement=True, advanced_trading=False, abatement=True, rng=None,
+                 abatement_scale=30000, common_random_numbers=True):
+        """Initialize the population. The agent parameters are broadcast to the shape (scenarios, agents), their meaning is
+        the same as in AgentPopulation.__init__(). activate_abatement has one entry per agent (the abatement curves are shared),
+        abatement one entry per scenario.
+        Args:
+            abatement (bool or np.ndarray): Whether the agents of each scenario can abate.
+            common_random_numbers (bool): Whether the expected emission noise of an agent is drawn once for all scenarios.
+        """
+        self.rng = make_rng(rng)
+        expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise, emission_rate_noise, advanced_trading = np.broadcast_arrays(
+            *[np.atleast_2d(np.asarray(a)) for a in (expected_emission, initial_allowance, min_sell_price, max_buy_price, expected_emission_noise, emission_rate_noise, advanced_trading)])
+        shape = expected_emission.shape
+
+        self.day = 0
+        self.year_length = DAYS_PER_YEAR
+        self.expected_emission = expected_emission + expected_emission_noise * self.rng.standard_normal(shape[1:] if common_random_numbers else shape)
+        self.allowance = initial_allowance.astype(float)
+        self.shortfall = np.zeros(shape)
+
+        self.emission_rate = self.expected_emission / self.year_length
+        self.emission_rate_noise = emission_rate_noise.astype(float)
+
+        self.total_emission = np.zeros(shape)
+        self.expected_emission_rate = np.zeros(shape)
+        self.expected_deficit = self.expected_emission - self.allowance
+
+        self.min_sell_price = min_sell_price.astype(float)
+        self.max_buy_price = max_buy_price.astype(float)
+        self.expected_market_price = (self.min_sell_price + self.max_buy_price) / 2
+
+        self.sale_counter = np.zeros(shape)
+        self.buy_counter = np.zeros(shape)
+        self.count = np.zeros(shape)
+        self.state_code = np.full(shape, IDLE, dtype=np.int8)
+        self.trade_price = self.expected_market_price.copy()
+
+        self.abatement_curves = AbatementCurves(shape[1], rng=self.rng, active=activate_abatement, scale=abatement_scale)
+        self.abatement = np.broadcast_to(np.asarray(abatement, dtype=bool), shape[:1]).copy()
+        self.abatement_index = np.zeros(shape, dtype=np.int64)
+        self.abatement_cost_per_ton = np.full(shape, np.inf)
+
+        self.advanced_trading = advanced_trading.astype(bool)
+
+        self.last_k_emissions = RollingWindow(k, recent=10, shape=shape)
+
+    @property
+    def size(self):
+        """The number of agents per scenario."""
+        return self.allowance.shape[1]
+
+    @property
+    def scenarios(self):
+        """The number of scenarios."""
+        return self.allowance.shape[0]
+
+    def update_abatements(self):
+        """
+        Update the abatement costs per ton, see AgentPopulation.update_abatements(). Scenarios without abatement get infinite costs.
+        """
+        super().update_abatements()
+        self.abatement_cost_per_ton[~self.abatement] = np.inf
+
+    def update(self, market_price, emission_shocks=None, trade_draws=None):
+        """
+        Update all agents of all scenarios, see AgentPopulation.update().
+        Args:
+            market_price (np.ndarray): The market price of the previous day of every scenario.
+            emission_shocks (np.ndarray): Standard normal random numbers, shape (agents,) to use the same numbers in all scenarios
+                or (scenarios, agents). None draws them from rng, the same for all scenarios.
+            trade_draws (np.ndarray): Uniform random numbers in [0, 1) for advanced trading, shaped like emission_shocks.
+        """
+        super().update(np.asarray(market_price, dtype=float)[:, None], emission_shocks, trade_draws)
+
+
+def generate_scenario_market(scenarios, count=100, rng=None, common_random_numbers=True):
+    '''
+    Generate the market of simulation.generate_market() for several scenarios at once: count agents with an allowance surplus
+    and count agents with a deficit in every scenario.
+    With common random numbers the agents of all scenarios are drawn from the same uniform and normal numbers, e.g. an agent
+    has the same position within the sell price range in every scenario, so the scenarios only differ by their parameters.
+    Args:
+        scenarios (list): One dictionary per scenario with the parameters of generate_market() that differ from its defaults
+            (sell_price, buy_price, activate_abatement, emission_rate_noise, expected_emission_noise, advanced_trading),
+            other keys are ignored.
+        count (int): Number of agents per group.
+        rng (np.random.Generator): The random number generator.
+        common_random_numbers (bool): Whether all scenarios use the same random numbers.
+    Returns:
+        ScenarioPopulation: The agents of all scenarios.
+    '''
+    rng = make_rng(rng)
+    params = {name: [scenario.get(name, default) for scenario in scenarios] for name, default in MARKET_PARAMETERS.items()}
+    shape = (2 * count,) if common_random_numbers else (len(scenarios), 2 * count)
+    # sellers first, then buyers like generate_market()
+    expected_emission = rng.uniform(10000, 11000, shape)
+    initial_allowance = rng.uniform(0, 1000, shape) + np.repeat([10100, 9800], count)
+    sell_draws = rng.random(shape)
+    buy_draws = rng.random(shape)
+
+    sell_price = np.array(params["sell_price"], dtype=float)
+    buy_price = np.array(params["buy_price"], dtype=float)
+    min_sell_price = sell_price[:, :1] + (sell_price[:, 1:] - sell_price[:, :1]) * sell_draws
+    max_buy_price = buy_price[:, :1] + (buy_price[:, 1:] - buy_price[:, :1]) * buy_draws
+
+    column = lambda values: np.asarray(values)[:, None]
+    return ScenarioPopulation(expected_emission, initial_allowance, min_sell_price, max_buy_price,
+                              expected_emission_noise=column(params["expected_emission_noise"]),
+                              emission_rate_noise=column(params["emission_rate_noise"]),
+                              advanced_trading=column(params["advanced_trading"]),
+                              abatement=np.array(params["activate_abatement"], dtype=bool),
+                              rng=rng, common_random_numbers=common_random_numbers)
+
+
+class ScenarioBatch:
+    """Runs several scenarios of a market in lockstep in one process. The agents of all scenarios are updated together
+    (see ScenarioPopulation), the market prices of all scenarios are cleared with market_clearing.clearing_prices() and
+    the orders of all scenarios are matched with market_clearing.match_orders_rows(), so a batch of scenarios costs a small
+    multiple of a single run.
+    The rules are those of Environment with an AgentPopulation: the queue side is ordered by price, daily tiebreak, and
+    agent id, the other side arrives in random order (ordered by a random key per agent and day), equal prices in the
+    supply and demand curves are ordered by agent id.
+    With common random numbers every agent gets the same emission shocks, trade draws, tiebreaks, and arrival keys in all
+    scenarios, so differences between the scenarios come from their parameters and not from sampling noise.
+    Properties:
+        population (ScenarioPopulation): The agents of all scenarios.
+        scenarios (list): The parameters of every scenario.
+        queue_sides (np.ndarray): "buy" for seller preferred scenarios (the sellers choose from the buyers), "sell" for buyer preferred ones.
+        market_price (np.ndarray): The current market price of every scenario.
+        day (int): The day since the start of the simulation.
+        rng (np.random.Generator): Generator for the daily random numbers.
+        common_random_numbers (bool): Whether all scenarios get the same daily random numbers.
+        history (ColumnTable): One row per day and scenario (day, scenario, market_price, buy_orders, sell_orders, trade_count, traded_volume).
+    """
+
+    def __init__(self, population, scenarios, rng=None, common_random_numbers=True):
+        """Initializes the batch.
+        Args:
+            population (ScenarioPopulation): The agents of all scenarios, e.g. from generate_scenario_market().
+            scenarios (list): One dictionary per scenario, the keys mode ("seller_preferred" or "buyer_preferred", see Environment)
+                and initial_market_price configure the market, defaults are seller preferred and 5.
+            rng (np.random.Generator): The random number generator of the daily random numbers.
+            common_random_numbers (bool): Whether all scenarios get the same daily random numbers.
+        """
+        if population.scenarios != len(scenarios):
+            raise ValueError("the population needs one row of agents per scenario")
+        modes = [scenario.get("mode", BATCH_PARAMETERS["mode"]) for scenario in scenarios]
+        if any(mode not in ("seller_preferred", "buyer_preferred") for mode in modes):
+            raise Exception("Mode not supported")
+        self.population = population
+        self.scenarios = list(scenarios)
+        self.queue_sides = np.where(np.array(modes) == "seller_preferred", "buy", "sell")
+        self.market_price = np.array([scenario.get("initial_market_price", BATCH_PARAMETERS["initial_market_price"])
+                                      for scenario in scenarios], dtype=float)
+        self.day = 0
+        self.rng = make_rng(rng)
+        self.common_random_numbers = common_random_numbers
+        self.history = ColumnTable({"day": np.int32, "scenario": np.int32, "market_price": np.float64, "buy_orders": np.int32,
+                                    "sell_orders": np.int32, "trade_count": np.int32, "traded_volume": np.float64})
+
+    def random(self, draw):
+        '''
+        Returns the random numbers of a draw (e.g. rng.random) for every agent, shared by all scenarios with common random numbers.
+        '''
+        population = self.population
+        if self.common_random_numbers:
+            return np.broadcast_to(draw(population.size), population.state_code.shape)
+        return draw(population.state_code.shape)
+
+    def side_orders(self, on_side, keys):
+        '''
+        Returns the agents of one side of every scenario, ordered by keys (ties by agent id), with the mask of the real orders.
+        The rows are trimmed to the largest side, the padding follows the real orders.
+        '''
+        width = int(on_side.sum(axis=1).max(initial=0))
+        order = np.argsort(np.where(on_side, keys, np.inf), axis=1, kind="stable")[:, :width]
+        return order, np.take_along_axis(on_side, order, axis=1)
+
+    def calculate_market_price(self, buying, selling):
+        '''
+        Calculates the market price of every scenario from its supply and demand curves, see Environment.calculate_market_price().
+        Scenarios whose curves do not cross keep their market price.
+        '''
+        population = self.population
+        demand_order, demands = self.side_orders(buying, -population.trade_price)
+        offer_order, offers = self.side_orders(selling, population.trade_price)
+        demand_quantities = np.cumsum(np.where(demands, np.take_along_axis(population.count, demand_order, axis=1), 0), axis=1)
+        offer_quantities = np.cumsum(np.where(offers, np.take_along_axis(population.count, offer_order, axis=1), 0), axis=1)
+        prices, found = clearing_prices(np.where(offers, np.take_along_axis(population.trade_price, offer_order, axis=1), np.inf),
+                                        offer_quantities,
+                                        np.where(demands, np.take_along_axis(population.trade_price, demand_order, axis=1), -np.inf),
+                                        demand_quantities)
+        self.market_price = np.where(found, prices, self.market_price)
+
+    def match(self, buying, selling):
+        '''
+        Matches the orders of all scenarios, see Environment.match_population().
+        Returns:
+            np.ndarray: The number of trades and the traded volume of every scenario.
+        '''
+        population = self.population
+        queue_buys = (self.queue_sides == "buy")[:, None]
+        signs = np.where(queue_buys, -1.0, 1.0)
+        tiebreaks = self.random(self.rng.random)
+        arrival_keys = self.random(self.rng.random)
+
+        on_queue = np.where(queue_buys, buying, selling)
+        width = int(on_queue.sum(axis=1).max(initial=0))
+        agent_ids = np.broadcast_to(np.arange(population.size), on_queue.shape)
+        queue = np.lexsort((agent_ids, tiebreaks, np.where(on_queue, signs * population.trade_price, np.inf)), axis=-1)[:, :width]
+        queued = np.take_along_axis(on_queue, queue, axis=1)
+        arrivals, arrived = self.side_orders(np.where(queue_buys, selling, buying), arrival_keys)
+
+        fills, _, _ = match_orders_rows(
+            np.where(queued, np.take_along_axis(population.trade_price, queue, axis=1), signs * np.inf),
+            np.where(queued, np.take_along_axis(population.count, queue, axis=1), 0),
+            np.where(arrived, np.take_along_axis(population.trade_price, arrivals, axis=1), 0),
+            np.where(arrived, np.take_along_axis(population.count, arrivals, axis=1), 0),
+            self.queue_sides)
+
+        scenario = fills["row"]
+        queue_agents = queue[scenario, fills["queue"]]
+        arrival_agents = arrivals[scenario, fills["arrival"]]
+        buyers = np.where(queue_buys[scenario, 0], queue_agents, arrival_agents)
+        sellers = np.where(queue_buys[scenario, 0], arrival_agents, queue_agents)
+        population.trade((scenario, buyers), (scenario, sellers), fills["amount"])
+
+        # agents with remaining counts failed to buy/sell, influences price expectations
+        population.failed_buy(buying & (population.count > 0))
+        population.failed_sell(selling & (population.count > 0))
+
+        trade_count = np.bincount(scenario, minlength=population.scenarios)
+        traded_volume = np.bincount(scenario, weights=fills["amount"], minlength=population.scenarios)
+        return trade_count, traded_volume
+
+    def update(self):
+        '''
+        Simulates one day of all scenarios: updates the agents, matches the orders, and updates the market prices.
+        '''
+        population = self.population
+        self.day += 1
+        population.update(self.market_price, self.random(self.rng.standard_normal), self.random(self.rng.random))
+        buying = population.state_code == BUY
+        selling = population.state_code == SELL
+        buy_orders, sell_orders = buying.sum(axis=1), selling.sum(axis=1)
+
+        # the curves use the orders before they are matched, the matching does not depend on the market price
+        self.calculate_market_price(buying, selling)
+        trade_count, traded_volume = self.match(buying, selling)
+
+        self.history.extend(day=self.day, scenario=np.arange(population.scenarios), market_price=self.market_price,
+                            buy_orders=buy_orders, sell_orders=sell_orders, trade_count=trade_count, traded_volume=traded_volume)
+
+    def frame(self):
+        '''
+        Returns the daily history of all scenarios as a pandas DataFrame.
+        '''
+        return self.history.to_frame()
+
+    def summary(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        '''
+        Summary statistics of every scenario, like simulation.summarize_run().
+        Returns:
+            pd.DataFrame: One row per scenario with the scenario parameters and the summary statistics.
+        '''
+        columns = self.history.raw_columns()
+        scenarios = self.population.scenarios
+        market_prices = columns["market_price"].reshape(-1, scenarios)
+        results = []
+        for scenario, params in enumerate(self.scenarios):
+            result = {"scenario": scenario}
+            result.update({name: value if np.isscalar(value) else str(value) for name, value in params.items()})
+            result["final_price"] = float(self.market_price[scenario])
+            result["mean_price"] = float(np.mean(market_prices[:, scenario]))
+            for q, value in zip(quantiles, np.quantile(market_prices[:, scenario], quantiles)):
+                result[f"price_q{int(round(q * 100)):02d}"] = float(value)
+            result["total_abatement"] = int(self.population.abatement_index[scenario].sum())
+            result["traded_volume"] = float(np.sum(columns["traded_volume"][columns["scenario"] == scenario]))
+            result["trade_count"] = int(np.sum(columns["trade_count"][columns["scenario"] == scenario]))
+            results.append(result)
+        return pd.DataFrame(results)
+
+
+def simulate_scenarios(scenarios, steps=365, count=100, common_random_numbers=True, rng=None):
+    '''
+    Runs the market of simulation.generate_market() for several scenarios in lockstep, e.g. a sensitivity study over
+    the parameter grid of ensemble.parameter_grid().
+    Args:
+        scenarios (list): One dictionary per scenario with the parameters of generate_scenario_market() and ScenarioBatch
+            (mode, initial_market_price).
+        steps (int): The number of days to run.
+        count (int): Number of agents per group.
+        common_random_numbers (bool): Whether all scenarios use the same random numbers for the agents and the daily updates.
+        rng (np.random.Generator): The random number generator, the agents and the daily random numbers get their own spawned generators.
+    Returns:
+        ScenarioBatch: The batch after the last step, see ScenarioBatch.summary().
+    '''
+    market_rng, batch_rng = make_rng(rng).spawn(2)
+    population = generate_scenario_market(scenarios, count, rng=market_rng, common_random_numbers=common_random_numbers)
+    batch = ScenarioBatch(population, scenarios, rng=batch_rng, common_random_numbers=common_random_numbers)
+    for _ in range(steps):
+        batch.update()
+    return batch
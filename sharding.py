@@ -0,0 +1,298 @@
+import multiprocessing
+import os
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from AgentPopulation import AgentPopulation, AGENT_ARRAYS
+from CompanyAgent import DAYS_PER_YEAR
+
+
+def partition(size, shards, groups=None):
+    '''
+    Splits the agents of a population into shards.
+    Args:
+        size (int): The number of agents.
+        shards (int): The number of shards.
+        groups (np.ndarray): A label of every agent (e.g. the REGISTRY_CODE or ACTIVITY_TYPE of the installations,
+            see data_preparation_utils.get_init_labels()). Agents with the same label end up in the same shard,
+            the labels are distributed so the shards have about the same size. None splits the agents into contiguous blocks.
+    Returns:
+        list: The agents of every shard, slices for contiguous blocks, otherwise sorted arrays of agent positions.
+            Empty shards are left out.
+    '''
+    if groups is None:
+        bounds = np.linspace(0, size, shards + 1).round().astype(int)
+        return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    labels, inverse, counts = np.unique(np.asarray(groups), return_inverse=True, return_counts=True)
+    # largest label first to the currently smallest shard
+    shard_sizes = np.zeros(shards, dtype=np.int64)
+    label_shard = np.empty(len(labels), dtype=np.int64)
+    for label in np.argsort(-counts, kind="stable"):
+        label_shard[label] = np.argmin(shard_sizes)
+        shard_sizes[label_shard[label]] += counts[label]
+    agent_shard = label_shard[inverse.ravel()]
+    return [np.flatnonzero(agent_shard == shard) for shard in range(shards) if shard_sizes[shard] > 0]
+
+
+def array_layout(arrays, alignment=64):
+    '''
+    Returns the layout of arrays placed one after another in one buffer: name -> (offset, dtype, shape), and the buffer size.
+    '''
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // alignment) * alignment
+        layout[name] = (offset, array.dtype.str, array.shape)
+        offset += array.nbytes
+    return layout, max(offset, 1)
+
+
+def array_views(buffer, layout):
+    '''
+    Returns views of the arrays of a layout (see array_layout()) on a buffer.
+    '''
+    return {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer, offset=offset) for name, (offset, dtype, shape) in layout.items()}
+
+
+class Shard:
+    """The part of a sharded population simulated by one worker process. The agent arrays of the shard population are views
+    of the shared memory (or copies for non-contiguous shards that are written back after every command), the rolling
+    emission window and the generated abatement steps are private to the worker.
+    Properties:
+        population (AgentPopulation): The agents of the shard, see AgentPopulation.subset().
+        index (slice or np.ndarray): The positions of the agents of the shard in the full population.
+        shared (dict): The views of the shared arrays of the full population.
+        loaded (dict): The arrays the population had after the last load().
+    """
+
+    def __init__(self, population, index, shared):
+        self.population = population
+        self.index = index
+        self.shared = shared
+        self.loaded = {}
+        self.load()
+
+    def load(self):
+        '''
+        Points the shard population to the current shared state.
+        '''
+        for name in AGENT_ARRAYS:
+            self.loaded[name] = self.shared[name][self.index]
+            setattr(self.population, name, self.loaded[name])
+
+    def store(self):
+        '''
+        Writes the state of the shard population back to the shared arrays. Arrays the population replaced
+        (e.g. population.expected_deficit = ...) are copied, views that were updated in place are already shared.
+        '''
+        contiguous = isinstance(self.index, slice)
+        for name in AGENT_ARRAYS:
+            value = getattr(self.population, name)
+            if value is not self.loaded[name] or not contiguous:
+                self.shared[name][self.index] = value
+        if contiguous:
+            self.load()
+
+    def update(self, market_price, steps):
+        '''
+        Updates the agents of the shard (see AgentPopulation.update()) with their part of the random numbers of the day.
+        Returns:
+            int: The number of abatement steps the shard needs on the next day (see AbatementCurves.required_width()).
+        '''
+        if steps is not None:
+            self.population.abatement_curves.add_steps(steps)
+        if not isinstance(self.index, slice):
+            self.load()
+        self.population.update(market_price, self.shared["emission_shocks"][self.index], self.shared["trade_draws"][self.index])
+        self.store()
+        return self.population.abatement_curves.required_width(self.population.abatement_index)
+
+    def set_year_length(self, year_length):
+        '''
+        Sets the length of the current compliance year for the agents of the shard (see AgentPopulation.set_year_length()).
+        '''
+        if not isinstance(self.index, slice):
+            self.load()
+        self.population.set_year_length(year_length)
+        self.store()
+
+    def start_compliance_year(self, allocation, banking, year_length):
+        '''
+        Starts the next compliance year for the agents of the shard (see AgentPopulation.start_compliance_year()).
+        '''
+        if not isinstance(self.index, slice):
+            self.load()
+        self.population.start_compliance_year(allocation, banking, year_length)
+        self.store()
+
+
+def run_shard(connection, memory_name, layout, population, index):
+    '''
+    Main function of a worker process: runs the commands of the coordinator on one shard until it is closed.
+    Every command is answered with (True, result) or (False, traceback).
+    '''
+    memory = SharedMemory(name=memory_name)
+    try:
+        shard = Shard(population, index, array_views(memory.buf, layout))
+        while True:
+            command, args = connection.recv()
+            if command == "close":
+                break
+            try:
+                connection.send((True, getattr(shard, command)(*args)))
+            except Exception:
+                connection.send((False, traceback.format_exc()))
+    finally:
+        # release the views of the shared memory before closing it
+        shard = population = None
+        memory.close()
+
+
+class ShardedPopulation(AgentPopulation):
+    """An AgentPopulation whose daily update and compliance year changes run in parallel worker processes, one per shard.
+    The agent arrays live in shared memory: the workers update their shards in place, the environment reads the offers
+    and demands and applies the trades of the global matching directly to the shared arrays.
+    The random numbers of the day and the abatement steps are drawn centrally, so a run gives exactly the same
+    results as a run with the unsharded population and the same seeds.
+    Use it like the population it was created from and close() it at the end of the run. Scripts that create it
+    need an `if __name__ == "__main__":` guard, the workers are spawned processes.
+    Properties:
+        shards (list): The agents of every shard, see partition().
+        memory (SharedMemory): The shared memory of the agent arrays and the random numbers of the day.
+        layout (dict): The layout of the shared arrays, see array_layout().
+        connections (list): The pipes to the workers.
+        processes (list): The worker processes.
+        needed_width (int): The number of abatement steps the agents need on the next day.
+    """
+
+    def __init__(self, population, shards=None, groups=None, mp_context="spawn"):
+        """Moves the state of a population to shared memory and starts the workers.
+        Args:
+            population (AgentPopulation): The population, it should not be used on its own afterwards.
+            shards (int): The number of shards (worker processes), defaults to the number of CPUs.
+            groups (np.ndarray): A label of every agent to shard by, see partition().
+            mp_context (str): The multiprocessing start method of the workers.
+        """
+        self.rng = population.rng
+        self.day = population.day
+        self.year_length = population.year_length
+        self.abatement_curves = population.abatement_curves
+        # the emission windows are kept by the shards
+        self.last_k_emissions = None
+        self.shards = partition(population.size, shards or os.cpu_count() or 1, groups)
+
+        arrays = {name: getattr(population, name) for name in AGENT_ARRAYS}
+        arrays["emission_shocks"] = arrays["trade_draws"] = np.zeros(population.size)
+        self.layout, nbytes = array_layout(arrays)
+        self.memory = SharedMemory(create=True, size=nbytes)
+        views = array_views(self.memory.buf, self.layout)
+        for name, view in views.items():
+            view[...] = arrays[name]
+            setattr(self, name, view)
+
+        # positions of the active agents of every shard in the rows of the generated abatement steps
+        curves = self.abatement_curves
+        self.shard_rows = [curves.rows[index][curves.active[index]] for index in self.shards]
+        self.sent_width = curves.width
+        self.needed_width = curves.required_width(self.abatement_index)
+
+        context = multiprocessing.get_context(mp_context)
+        self.connections = []
+        self.processes = []
+        for index in self.shards:
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=run_shard, args=(worker_connection, self.memory.name, self.layout,
+                                                              population.subset(index), index), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def closed(self):
+        return not self.processes
+
+    def broadcast(self, command, shard_args):
+        '''
+        Sends a command with the arguments of every shard to all workers and returns their results.
+        '''
+        if self.closed:
+            raise RuntimeError("the sharded population is closed")
+        for connection, args in zip(self.connections, shard_args):
+            connection.send((command, args))
+        results = [connection.recv() for connection in self.connections]
+        for ok, result in results:
+            if not ok:
+                raise RuntimeError(f"shard worker failed:\n{result}")
+        return [result for _, result in results]
+
+    def update(self, market_price, emission_shocks=None, trade_draws=None):
+        """
+        Update all agents in the shard workers, see AgentPopulation.update().
+        """
+        self.day += 1
+        # same order of random numbers as AgentPopulation.update()
+        if emission_shocks is None:
+            emission_shocks = self.rng.standard_normal(self.size)
+        self.abatement_curves.reserve(self.needed_width)
+        if trade_draws is None and self.advanced_trading.any():
+            trade_draws = self.rng.random(self.size)
+
+        steps = [None] * len(self.shards)
+        if self.abatement_curves.width > self.sent_width:
+            new_steps = self.abatement_curves.costs[:, self.sent_width:]
+            steps = [new_steps[rows] for rows in self.shard_rows]
+            self.sent_width = self.abatement_curves.width
+
+        self.emission_shocks[:] = emission_shocks
+        self.trade_draws[:] = trade_draws if trade_draws is not None else 0
+        widths = self.broadcast("update", [(market_price, shard_steps) for shard_steps in steps])
+        self.needed_width = max(widths)
+
+    def set_year_length(self, year_length):
+        """
+        Sets the length of the current compliance year in the shard workers, see AgentPopulation.set_year_length().
+        """
+        if self.day != 0:
+            raise ValueError("the year length can only be set before the first day of the year")
+        self.broadcast("set_year_length", [(year_length,)] * len(self.shards))
+        self.year_length = year_length
+
+    def start_compliance_year(self, allocation, banking=True, year_length=DAYS_PER_YEAR):
+        """
+        Starts the next compliance year in the shard workers, see AgentPopulation.start_compliance_year().
+        """
+        allocation = np.asarray(allocation, dtype=float)
+        self.broadcast("start_compliance_year", [(allocation[index] if allocation.ndim > 0 else allocation, banking, year_length)
+                                                 for index in self.shards])
+        self.year_length = year_length
+        self.day = 0
+
+    def close(self):
+        '''
+        Stops the workers and releases the shared memory. The agent arrays are copied out first, so the final state can still be read.
+        '''
+        if self.closed:
+            return
+        for connection in self.connections:
+            connection.send(("close", ()))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.connections = []
+        for name in self.layout:
+            setattr(self, name, getattr(self, name).copy())
+        try:
+            self.memory.close()
+        except BufferError:
+            # views of the shared arrays are still referenced elsewhere, the memory is released with them
+            pass
+        self.memory.unlink()
@@ -0,0 +1,246 @@
+import numpy as np
+import tqdm
+from CompanyAgent import CompanyAgent
+from Environment import Environment
+from AgentPopulation import AgentPopulation
+from random_streams import make_rng, spawn_rngs
+from abatement import generate_abatement_curves
+from data_preparation_utils import get_init_data
+
+
+def generate_agents(
+        count,
+        expected_emission,
+        initial_allowance,
+        sell_price,
+        buy_price,
+        activate_abatement=True,
+        emission_rate_noise=0.01,
+        expected_emission_noise=0.1,
+        advanced_trading=False,
+        rng=None):
+    '''
+    Generate a list of agents with random parameters.
+    Args:
+        count: Number of agents to generate
+        expected_emission: A tuple of (min, max) expected emission
+        initial_allowance: A tuple of (min, max) initial allowance
+        sell_price: A tuple of (min, max) sell price
+        buy_price: A tuple of (min, max) buy price
+        activate_abatement: Whether the agent will use abatement
+        emission_rate_noise: The noise for the emission rate
+        expected_emission_noise: The noise for the expected emission
+        advanced_trading: Whether the agent will use advanced trading
+        rng: The random number generator, every agent gets its own generator spawned from it
+    Returns:
+        A list of agents'''
+    rng = make_rng(rng)
+    agent_rngs = spawn_rngs(rng, count)
+    # abatement cost curves of all agents in one batch
+    abatement_costs = generate_abatement_curves(count, rng=rng) if activate_abatement else [None] * count
+    agents = []
+    for i in range(count):
+        agents.append(CompanyAgent(
+            rng.uniform(*expected_emission),
+            rng.uniform(*initial_allowance),
+            rng.uniform(*sell_price),
+            rng.uniform(*buy_price),
+            activate_abatement=activate_abatement,
+            emission_rate_noise=emission_rate_noise,
+            expected_emission_noise=expected_emission_noise,
+            advanced_trading=advanced_trading,
+            rng=agent_rngs[i],
+            abatement_costs=abatement_costs[i]))
+    return agents
+
+
+def generate_market(
+        count=100,
+        sell_price=(0, 100),
+        buy_price=(0, 100),
+        activate_abatement=True,
+        emission_rate_noise=0.1,
+        expected_emission_noise=0.1,
+        advanced_trading=False,
+        population=False,
+        rng=None):
+    '''
+    Generate the market of the notebook experiments: count agents with an allowance surplus and count agents with a deficit.
+    Args:
+        count: Number of agents per group
+        sell_price: A tuple of (min, max) sell price
+        buy_price: A tuple of (min, max) buy price
+        activate_abatement: Whether the agents will use abatement
+        emission_rate_noise: The noise for the emission rate
+        expected_emission_noise: The noise for the expected emission
+        advanced_trading: Whether the agents will use advanced trading
+        population: Whether to return the agents as AgentPopulation
+        rng: The random number generator
+    Returns:
+        A list of agents or an AgentPopulation'''
+    seller_rng, buyer_rng, population_rng = spawn_rngs(rng, 3)
+    agents = generate_agents(count, (10000, 11000), (10100, 11100), sell_price, buy_price, activate_abatement,
+                             emission_rate_noise, expected_emission_noise, advanced_trading, rng=seller_rng)
+    agents += generate_agents(count, (10000, 11000), (9800, 10800), sell_price, buy_price, activate_abatement,
+                              emission_rate_noise, expected_emission_noise, advanced_trading, rng=buyer_rng)
+    if population:
+        return AgentPopulation.from_agents(agents, rng=population_rng)
+    return agents
+
+
+def simulate(agents, steps=365, mode="seller_preferred", initial_market_price=5, progress=False, rng=None, **env_kwargs):
+    '''
+    Run the simulation for a number of steps/days without plotting.
+    Args:
+        agents: A list of agents or an AgentPopulation
+        steps: The number of days to run
+        mode: The mode of the environment ("seller_preferred" or "buyer_preferred")
+        initial_market_price: The initial market price
+        progress: Whether to show a progress bar
+        rng: The random number generator of the environment
+        env_kwargs: Further arguments passed to Environment
+    Returns:
+        The environment after the last step, the final agent states are tracked'''
+    env = Environment(initial_market_price, agents, mode=mode, rng=rng, **env_kwargs)
+    days = tqdm.tqdm(range(steps)) if progress else range(steps)
+    for _ in days:
+        env.update(plot=False)
+    env.wake_agents()
+    env.track_agents_state()
+    return env
+
+
+def simulate_years(agents, allocations, steps=365, banking=True, mode="seller_preferred", initial_market_price=5, progress=False, rng=None, **env_kwargs):
+    '''
+    Run several compliance years back to back. At the end of every year the agents surrender allowances for their
+    emissions and receive the free allocation of the next year, their state (emission rates, abatements, price expectations,
+    banked allowances) carries over, so the agents are not rebuilt.
+    Args:
+        agents: A list of agents or an AgentPopulation, their initial allowance is the allocation of the first year
+        allocations: The free allocation of every following year (scalar or one value per agent),
+            e.g. from cap_trajectory() or allocation_schedule(). len(allocations) + 1 years are simulated
+        steps: The number of days of every year, including the first year (see Environment.set_year_length())
+        banking: Whether agents can carry a surplus of allowances into the next year
+        mode: The mode of the environment ("seller_preferred" or "buyer_preferred")
+        initial_market_price: The initial market price
+        progress: Whether to show a progress bar
+        rng: The random number generator of the environment
+        env_kwargs: Further arguments passed to Environment
+    Returns:
+        The environment after the last year, the results of every year are in env.history.compliance_frame()'''
+    env = Environment(initial_market_price, agents, mode=mode, rng=rng, **env_kwargs)
+    allocations = list(allocations)
+    bar = tqdm.tqdm(total=(len(allocations) + 1) * steps) if progress else None
+    env.set_year_length(steps)
+    for year in range(len(allocations) + 1):
+        if year > 0:
+            env.start_compliance_year(allocations[year - 1], banking=banking, year_length=steps)
+        for _ in range(steps):
+            env.update(plot=False)
+            if bar is not None:
+                bar.update()
+    env.end_compliance_year(banking=banking)
+    if bar is not None:
+        bar.close()
+    return env
+
+
+def cap_trajectory(base_allocation, years, reduction_factor=0.022):
+    '''
+    Free allocation of the years following the base year under a linear reduction of the cap.
+    Args:
+        base_allocation: The allocation of the first year (scalar or one value per agent)
+        years: The total number of years including the first year
+        reduction_factor: The yearly reduction as fraction of the base allocation (2.2% in the EU ETS since 2021)
+    Returns:
+        A list with the allocation of every following year, see simulate_years()'''
+    base_allocation = np.asarray(base_allocation, dtype=float)
+    return [np.maximum(0, base_allocation * (1 - reduction_factor * year)) for year in range(1, years)]
+
+
+def allocation_schedule(base_allocation, totals):
+    '''
+    Free allocation of the following years with the base allocation scaled by the total allocation of every year,
+    e.g. the totals from data_preparation_utils.get_total_allocation().
+    Args:
+        base_allocation: The allocation of the first year (scalar or one value per agent)
+        totals: The total allocation of every year, starting with the year of the base allocation
+    Returns:
+        A list with the allocation of every following year, see simulate_years()'''
+    base_allocation = np.asarray(base_allocation, dtype=float)
+    totals = np.asarray(totals, dtype=float)
+    return [base_allocation * total / totals[0] for total in totals[1:]]
+
+
+def summarize_run(env, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    '''
+    Summary statistics of a finished simulation.
+    Args:
+        env: The environment of the simulation
+        quantiles: The quantiles of the market price path to report
+    Returns:
+        A dictionary with the final price, the price path quantiles, the total abatement, and the traded volume'''
+    market_prices = env.history.market.raw_columns()["market_price"]
+    trade_amounts = env.history.trades.raw_columns()["trade_amount"]
+    if env.population is not None:
+        total_abatement = int(env.population.abatement_index.sum())
+    else:
+        total_abatement = sum(agent.abatement_index for agent in env.agents)
+
+    summary = {"final_price": float(env.market_price),
+               "mean_price": float(np.mean(market_prices))}
+    for q, value in zip(quantiles, np.quantile(market_prices, quantiles)):
+        summary[f"price_q{int(round(q * 100)):02d}"] = float(value)
+    summary["total_abatement"] = total_abatement
+    summary["traded_volume"] = float(np.sum(trade_amounts, dtype=np.float64))
+    summary["trade_count"] = len(trade_amounts)
+    return summary
+
+
+def init_eu(year=2018, population=True, rng=None, path='./data/data_for_init_melted.csv', cache_dir='./data/cache',
+            sell_price=(0, 100), buy_price=(0, 100), emission_rate_noise=(0.001, 0.01), abatement_scale=30000):
+    '''
+    Initialize the agents with the data from the EU ETS.
+    Every installation becomes an agent with advanced trading, its verified emissions as expected emission and its allocation
+    as initial allowance. One additional agent without emissions supplies 98% of the total allowance deficit.
+    The installation data is read from a cached snapshot (see data_preparation_utils.get_init_data) and the population
+    is built in one batched call.
+    Args:
+        year: The year of the installation data
+        population: Whether to return the agents as AgentPopulation (fast) or as list of CompanyAgent objects
+        rng: The random number generator
+        path: The prepared installation data
+        cache_dir: The directory of the cached snapshots
+        sell_price: A tuple of (min, max) minimum sell price of the installations
+        buy_price: A tuple of (min, max) maximum buy price of the installations
+        emission_rate_noise: A tuple of (min, max) emission rate noise as fraction of the daily emission rate
+        abatement_scale: The scale of the gamma distributed first abatement costs
+    Returns:
+        An AgentPopulation or a list of agents'''
+    rng = make_rng(rng)
+    allocation, emissions = get_init_data(year=year, path=path, cache_dir=cache_dir)
+    count = len(allocation)
+    expected_deficit = emissions.sum() - allocation.sum()
+
+    # installations followed by the agent supplying the missing allowances
+    expected_emission = np.append(emissions, 0)
+    initial_allowance = np.append(allocation, 0.98 * expected_deficit)
+    min_sell_price = np.append(rng.uniform(*sell_price, count), 0)
+    max_buy_price = np.append(rng.uniform(*buy_price, count), 100)
+    emission_rate_noise = np.append(emissions * rng.uniform(*emission_rate_noise, count) / 365, 0)  # default 0.1% to 1% of the emission rate
+    expected_emission_noise = np.append(emissions * 0.1, 0)
+    active = np.append(np.ones(count, dtype=bool), False)
+
+    if population:
+        return AgentPopulation(expected_emission, initial_allowance, min_sell_price, max_buy_price,
+                               expected_emission_noise=expected_emission_noise, emission_rate_noise=emission_rate_noise,
+                               activate_abatement=active, advanced_trading=active, rng=rng,
+                               abatement_scale=abatement_scale)
+
+    agent_rngs = spawn_rngs(rng, count + 1)
+    abatement_costs = generate_abatement_curves(count, rng=rng, scale=abatement_scale)
+    return [CompanyAgent(expected_emission[i], initial_allowance[i], min_sell_price[i], max_buy_price[i],
+                         expected_emission_noise=expected_emission_noise[i], emission_rate_noise=emission_rate_noise[i],
+                         activate_abatement=active[i], advanced_trading=active[i], rng=agent_rngs[i],
+                         abatement_costs=abatement_costs[i] if active[i] else None)
+            for i in range(count + 1)]
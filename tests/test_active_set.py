@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from Environment import Environment
+from HistoryRecorder import HistoryRecorder
+from simulation import cap_trajectory, generate_agents, generate_market, simulate, simulate_years
+
+AGENT_STATE = ["expected_emission", "allowance", "emission_rate", "total_emission", "day", "expected_deficit",
+               "expected_market_price", "sale_counter", "buy_counter", "count", "state", "trade_price"]
+
+
+def balanced_agents(count=100):
+    # the balanced base case of the notebook: whole-number expected emissions equal to the allowance
+    return generate_agents(count, (10000, 10000), (10000, 10000), (0, 0), (100, 100), activate_abatement=False,
+                           emission_rate_noise=0, expected_emission_noise=0, rng=np.random.default_rng(0))
+
+
+def mixed_agents(seed, count=100):
+    # idle agents with fractional expected emissions next to agents with noisy emissions that trade
+    rng = np.random.default_rng(seed)
+    agents = generate_agents(count, (10000, 11000), (10000, 11000), (0, 100), (0, 100), emission_rate_noise=0.0,
+                             activate_abatement=False, rng=rng)
+    for agent in agents:
+        agent.allowance = float(np.ceil(agent.expected_emission - 1e-9))
+    return agents + generate_agents(count // 10, (10000, 11000), (9800, 11200), (0, 100), (0, 100), emission_rate_noise=0.1, rng=rng)
+
+
+def assert_same_run(ref, env):
+    for a, b in zip(ref.agents, env.agents):
+        assert [getattr(a, name) for name in AGENT_STATE] == [getattr(b, name) for name in AGENT_STATE]
+    pd.testing.assert_frame_equal(ref.history.market_frame(), env.history.market_frame())
+    pd.testing.assert_frame_equal(ref.history.trade_frame(), env.history.trade_frame())
+    pd.testing.assert_frame_equal(ref.history.agent_frame(), env.history.agent_frame(expand=True))
+
+
+def test_balanced_agents_become_dormant():
+    env = Environment(5, balanced_agents(), "seller_preferred", rng=np.random.default_rng(1), active_set=True)
+    env.update()
+    assert env.active_ids == []
+    assert len(env.dormant_ids) == 100
+
+
+def test_dormant_agents_match_full_run():
+    ref = simulate(balanced_agents(), rng=np.random.default_rng(1))
+    env = simulate(balanced_agents(), rng=np.random.default_rng(1), active_set=True, history=HistoryRecorder(changes_only=True))
+    assert_same_run(ref, env)
+
+
+@pytest.mark.parametrize("mode", ["seller_preferred", "buyer_preferred"])
+def test_active_set_matches_full_run(mode):
+    ref = simulate(mixed_agents(0), mode=mode, rng=np.random.default_rng(1))
+    env = simulate(mixed_agents(0), mode=mode, rng=np.random.default_rng(1), active_set=True, history=HistoryRecorder(changes_only=True))
+    assert_same_run(ref, env)
+    assert len(env.history.agents) < len(ref.history.agents)
+
+
+def test_active_set_matches_full_run_over_years():
+    allocations = cap_trajectory([agent.allowance for agent in mixed_agents(3)], 3, 0.001)
+    ref = simulate_years(mixed_agents(3), allocations, steps=100, rng=np.random.default_rng(4))
+    env = simulate_years(mixed_agents(3), allocations, steps=100, rng=np.random.default_rng(4), active_set=True)
+    assert_same_run(ref, env)
+    pd.testing.assert_frame_equal(ref.history.compliance_frame(), env.history.compliance_frame())
+
+
+def test_changes_only_history_of_population():
+    def run(**history):
+        agents = generate_market(advanced_trading=True, population=True, rng=np.random.default_rng(0))
+        return simulate(agents, steps=100, rng=np.random.default_rng(1), history=HistoryRecorder(every=3, agent_ids=[5, 1, 7, 100], **history))
+    ref = run().history.agent_frame().sort_values(["day", "agent"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(ref, run(changes_only=True).history.agent_frame(expand=True))
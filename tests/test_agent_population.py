@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+from AgentPopulation import AgentPopulation, STATE_CODES
+from simulation import generate_market, simulate
+
+AGENT_STATE = ["allowance", "emission_rate", "total_emission", "expected_deficit", "expected_market_price", "count",
+               "trade_price", "abatement_index"]
+
+
+def run(population, advanced_trading, mode, steps=200):
+    agents = generate_market(count=50, advanced_trading=advanced_trading, population=population, rng=np.random.default_rng(0))
+    return simulate(agents, steps=steps, mode=mode, rng=np.random.default_rng(1))
+
+
+@pytest.mark.parametrize("mode", ["seller_preferred", "buyer_preferred"])
+@pytest.mark.parametrize("advanced_trading", [False, True])
+def test_population_matches_agent_objects(advanced_trading, mode):
+    agents = run(False, advanced_trading, mode)
+    population = run(True, advanced_trading, mode)
+
+    trades = agents.history.trade_frame()
+    # the vectorized matching does not record the zero-amount trades of orders without quantity
+    trades = trades[trades["trade_amount"] > 0].reset_index(drop=True)
+    pd.testing.assert_frame_equal(trades, population.history.trade_frame())
+    pd.testing.assert_frame_equal(agents.history.market_frame(), population.history.market_frame())
+    pd.testing.assert_frame_equal(agents.history.agent_frame(), population.history.agent_frame())
+    for name in AGENT_STATE:
+        np.testing.assert_array_equal([getattr(agent, name) for agent in agents.agents], getattr(population.population, name))
+    np.testing.assert_array_equal([STATE_CODES[agent.state] for agent in agents.agents], population.population.state_code)
+
+
+def test_population_from_agents_continues_the_run():
+    agents = run(False, True, "seller_preferred", steps=100).agents
+    population = AgentPopulation.from_agents(agents)
+    rng = np.random.default_rng(2)
+    for market_price in rng.uniform(0, 100, 50).tolist():
+        shocks, draws = rng.standard_normal(len(agents)), rng.random(len(agents))
+        for agent, shock, draw in zip(agents, shocks.tolist(), draws.tolist()):
+            agent.update_agent(market_price, shock, draw)
+        population.update(market_price, shocks, draws)
+    for name in AGENT_STATE:
+        np.testing.assert_array_equal([getattr(agent, name) for agent in agents], getattr(population, name))
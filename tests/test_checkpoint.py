@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+from checkpoint import copy_environment, fork, load_checkpoint, save_checkpoint
+from Environment import Environment
+from simulation import generate_market
+
+
+def make_environment(population):
+    agents = generate_market(count=50, advanced_trading=True, population=population, rng=np.random.default_rng(1))
+    return Environment(5, agents, "seller_preferred", rng=np.random.default_rng(2))
+
+
+def advance(env, days):
+    for _ in range(days):
+        env.update()
+    return env
+
+
+def assert_same_run(ref, env):
+    assert env.market_price == ref.market_price
+    pd.testing.assert_frame_equal(ref.history.trade_frame(), env.history.trade_frame())
+    pd.testing.assert_frame_equal(ref.history.market_frame(), env.history.market_frame())
+    pd.testing.assert_frame_equal(ref.history.agent_frame(), env.history.agent_frame())
+
+
+@pytest.mark.parametrize("population", [False, True])
+def test_restored_and_forked_runs_are_identical(tmp_path, population):
+    ref = advance(make_environment(population), 100)
+    env = advance(make_environment(population), 60)
+    # small arrays are stored as .npy files as well, so the memory mapped arrays are covered
+    save_checkpoint(env, str(tmp_path), min_array_size=16)
+    branches = [load_checkpoint(str(tmp_path)), load_checkpoint(str(tmp_path), mmap=False), copy_environment(env)] + fork(env, 2)
+    for branch in [env] + branches:
+        assert_same_run(ref, advance(branch, 40))
+
+
+def test_forked_branches_are_independent():
+    env = advance(make_environment(True), 50)
+    first, second = fork(env, 2)
+    second.set_mode("buyer_preferred")
+    advance(first, 50)
+    advance(second, 50)
+    assert_same_run(advance(env, 50), first)
+    assert not second.history.trade_frame().equals(first.history.trade_frame())
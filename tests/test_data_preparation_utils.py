@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import pandas as pd
+from data_preparation_utils import cached_table, get_allocation_melted, prepare_registry
+
+
+def make_source(tmp_path, content="source"):
+    path = tmp_path / "source.csv"
+    path.write_text(content)
+    return str(path)
+
+
+def cached(name, source, params, cache_dir, builds):
+    def build():
+        builds.append((name, tuple(sorted(params.items()))))
+        return pd.DataFrame({"value": [len(builds)]})
+    return cached_table(name, source, params, build, cache_dir)
+
+
+def test_tables_with_shared_prefix_stay_cached(tmp_path):
+    source, cache_dir, builds = make_source(tmp_path), str(tmp_path / "cache"), []
+    for _ in range(3):
+        cached("allocation", source, {"austrian": False}, cache_dir, builds)
+        cached("allocation_at", source, {"austrian": True}, cache_dir, builds)
+    assert len(builds) == 2
+
+
+def test_parameter_variants_stay_cached(tmp_path):
+    source, cache_dir, builds = make_source(tmp_path), str(tmp_path / "cache"), []
+    first = [cached("init", source, {"year": year}, cache_dir, builds) for year in (2018, 2019)]
+    second = [cached("init", source, {"year": year}, cache_dir, builds) for year in (2018, 2019)]
+    assert len(builds) == 2
+    for a, b in zip(first, second):
+        pd.testing.assert_frame_equal(a, b)
+
+
+def test_changed_source_replaces_only_its_snapshot(tmp_path):
+    source, cache_dir, builds = make_source(tmp_path), str(tmp_path / "cache"), []
+    cached("init", source, {"year": 2018}, cache_dir, builds)
+    cached("init", source, {"year": 2019}, cache_dir, builds)
+    make_source(tmp_path, "changed")
+    cached("init", source, {"year": 2018}, cache_dir, builds)
+    assert len(builds) == 3
+    assert len(os.listdir(os.path.join(cache_dir, "init"))) == 2
+
+
+def make_registry():
+    return pd.DataFrame({
+        "INSTALLATION_NAME": ["a", "b", "c"],
+        "ALLOCATION2008": [1.0, 2.0, 3.0],
+        "ALLOCATION2009": ["4", "Excluded", "n/a"],
+        "VERIFIED_EMISSIONS_2008": [2.0, -1, 4.0],
+        "VERIFIED_EMISSIONS_2009": ["5", "6", "Excluded"],
+        "OTHER_2008": [7.0, 8.0, 9.0],
+    })
+
+
+def test_non_numeric_registry_values_become_nan():
+    df = prepare_registry(make_registry(), years=range(2008, 2010))
+    np.testing.assert_array_equal(df["ALLOCATION_2009"].to_numpy(), np.array([4, np.nan, np.nan], dtype=np.float32))
+    np.testing.assert_array_equal(df["VERIFIED_EMISSIONS_2009"].to_numpy(), np.array([5, 6, np.nan], dtype=np.float32))
+    assert df["ALLOCATION_2009"].dtype == np.float32
+
+
+def test_melted_registry_keeps_other_yearly_columns():
+    melted = get_allocation_melted(prepare_registry(make_registry(), years=range(2008, 2010)))
+    assert list(melted["year"]) == [2008, 2009, 2009, 2008, 2009]
+    np.testing.assert_array_equal(melted["OTHER_2008"].to_numpy(), [7, 7, 8, 9, 9])
+    np.testing.assert_array_equal(melted["ALLOCATION_"].to_numpy(), np.array([1, 4, np.nan, 3, np.nan], dtype=np.float32))
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+from HistoryRecorder import ColumnTable, HistoryRecorder
+from history_sinks import make_sink
+
+
+def test_frame_keeps_values_after_clear():
+    table = ColumnTable({"day": np.int32, "value": np.float64}, chunk_size=4)
+    table.extend(day=[1, 2, 3], value=[1.0, 2.0, 3.0])
+    frame = table.to_frame()
+    expected = frame.copy()
+    table.clear()
+    table.extend(day=[4, 5, 6], value=[4.0, 5.0, 6.0])
+    pd.testing.assert_frame_equal(frame, expected)
+    assert table.to_frame()["day"].tolist() == [4, 5, 6]
+
+
+@pytest.mark.parametrize("format", ["npy", "parquet"])
+def test_frame_taken_before_flush_keeps_values(tmp_path, format):
+    if format == "parquet":
+        pytest.importorskip("pyarrow")
+    history = HistoryRecorder(chunk_size=8, sink=make_sink(str(tmp_path), format=format), flush_rows=4)
+    for day in range(3):
+        history.record_market(day, 10.0 + day)
+    frame = history.market_frame()
+    expected = frame.copy()
+    # the fourth row flushes the table to the sink
+    for day in range(3, 7):
+        history.record_market(day, 10.0 + day)
+    pd.testing.assert_frame_equal(frame, expected)
+    history.close()
+
+
+def test_large_trade_amounts_are_exact():
+    history = HistoryRecorder()
+    amounts = [123456789.0, 2.0 ** 40 + 1, 0.5]
+    history.record_trades(1, [10.0] * 3, amounts)
+    history.record_trade(2, 10.0, 987654321.0)
+    assert history.trade_frame()["trade_amount"].tolist() == amounts + [987654321.0]
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+from market_clearing import clearing_price, find_intersection, match_orders, clearing_prices, match_orders_rows
+
+
+def cartesian_product(*arrays):
+    '''
+    Returns the cartesian product of the input arrays (the former Environment.cartesian_product()).
+    '''
+    la = len(arrays)
+    dtype = np.result_type(*arrays)
+    arr = np.empty([len(a) for a in arrays] + [la], dtype=dtype)
+    for i, a in enumerate(np.ix_(*arrays)):
+        arr[..., i] = a
+    return arr.reshape(-1, la)
+
+
+def cartesian_clearing_price(offer_prices, offer_quantities, demand_prices, demand_quantities):
+    '''
+    The former clearing rule: the last crossing pair of the cartesian product of the offer and demand curves.
+    '''
+    if len(offer_prices) == 0 or len(demand_prices) == 0:
+        return None
+    prices = cartesian_product(offer_prices, demand_prices)
+    quantities = cartesian_product(offer_quantities, demand_quantities)
+    crossing = np.argwhere((prices[:, 0] <= prices[:, 1]) & (quantities[:, 0] < quantities[:, 1]))
+    if len(crossing) == 0:
+        return None
+    return (prices[crossing[-1], 0] + prices[crossing[-1], 1])[0] / 2
+
+
+def sequential_matching(queue_prices, queue_counts, arrival_prices, arrival_counts, queue_side):
+    '''
+    The former heap matching: every arrival trades with the best queue orders while the prices are compatible,
+    a partially filled queue order stays at the front of the queue.
+    Returns the fills as (arrival, queue, price, amount) tuples.
+    '''
+    compatible = (lambda arrival, queue: arrival <= queue) if queue_side == "buy" else (lambda arrival, queue: arrival >= queue)
+    queue_counts = list(queue_counts)
+    best, fills = 0, []
+    for arrival, (price, count) in enumerate(zip(arrival_prices, arrival_counts)):
+        while best < len(queue_counts) and count > 0 and compatible(price, queue_prices[best]):
+            amount = min(count, queue_counts[best])
+            fills.append((arrival, best, queue_prices[best], amount))
+            count -= amount
+            queue_counts[best] -= amount
+            if queue_counts[best] == 0:
+                best += 1
+    return fills
+
+
+def random_book(rng, max_orders=12, integer_prices=True):
+    '''
+    Returns sorted random supply and demand curves, integer prices produce ties. Either side can be empty.
+    '''
+    offers, demands = rng.integers(0, max_orders, 2)
+    draw = (lambda n: rng.integers(0, 10, n).astype(float)) if integer_prices else (lambda n: rng.uniform(0, 10, n))
+    offer_prices = np.sort(draw(offers))
+    demand_prices = np.sort(draw(demands))[::-1]
+    offer_quantities = np.cumsum(rng.integers(1, 5, offers)).astype(float)
+    demand_quantities = np.cumsum(rng.integers(1, 5, demands)).astype(float)
+    return offer_prices, offer_quantities, demand_prices, demand_quantities
+
+
+@pytest.mark.parametrize("integer_prices", [True, False])
+def test_clearing_price_matches_cartesian_rule(integer_prices):
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        book = random_book(rng, integer_prices=integer_prices)
+        assert clearing_price(*book) == cartesian_clearing_price(*book)
+
+
+def test_empty_sides_do_not_cross():
+    empty = np.empty(0)
+    prices, quantities = np.array([1.0, 2.0]), np.array([1.0, 3.0])
+    assert find_intersection(empty, empty, prices[::-1], quantities) is None
+    assert clearing_price(prices, quantities, empty, empty) is None
+    assert clearing_price(empty, empty, empty, empty) is None
+
+
+def test_clearing_prices_rows_match_clearing_price():
+    rng = np.random.default_rng(1)
+    books = [random_book(rng) for _ in range(50)]
+    width = 12
+    pad = lambda values, fill: np.concatenate([values, np.full(width - len(values), fill)])
+    prices, found = clearing_prices(np.array([pad(book[0], np.inf) for book in books]), np.array([pad(book[1], 0) for book in books]),
+                                    np.array([pad(book[2], -np.inf) for book in books]), np.array([pad(book[3], 0) for book in books]))
+    for book, price, crosses in zip(books, prices, found):
+        expected = cartesian_clearing_price(*book)
+        assert crosses == (expected is not None)
+        assert not crosses or price == expected
+
+
+@pytest.mark.parametrize("queue_side", ["buy", "sell"])
+def test_match_orders_matches_sequential_matching(queue_side):
+    rng = np.random.default_rng(2)
+    sign = -1 if queue_side == "buy" else 1
+    for _ in range(300):
+        queues, arrivals = rng.integers(0, 10, 2)
+        queue_prices = sign * np.sort(sign * rng.integers(0, 10, queues).astype(float))
+        queue_counts = rng.integers(1, 6, queues).astype(float)
+        arrival_prices = rng.integers(0, 10, arrivals).astype(float)
+        arrival_counts = rng.integers(1, 6, arrivals).astype(float)
+
+        fills, arrival_traded, queue_traded = match_orders(queue_prices, queue_counts, arrival_prices, arrival_counts, queue_side)
+        expected = sequential_matching(queue_prices, queue_counts, arrival_prices, arrival_counts, queue_side)
+        assert [tuple(fill) for fill in fills.tolist()] == expected
+        assert arrival_traded.sum() == queue_traded.sum() == sum(fill[3] for fill in expected)
+
+
+def test_match_orders_rows_match_match_orders():
+    rng = np.random.default_rng(3)
+    rows, width = 20, 10
+    sides = rng.choice(["buy", "sell"], rows)
+    books = []
+    for side in sides:
+        sign = -1 if side == "buy" else 1
+        queues, arrivals = rng.integers(0, width, 2)
+        books.append((sign * np.sort(sign * rng.integers(0, 10, queues).astype(float)), rng.integers(1, 6, queues).astype(float),
+                      rng.integers(0, 10, arrivals).astype(float), rng.integers(1, 6, arrivals).astype(float)))
+    pad = lambda values, fill: np.concatenate([values, np.full(width - len(values), fill)])
+    fills, _, _ = match_orders_rows(np.array([pad(book[0], -np.inf if side == "buy" else np.inf) for book, side in zip(books, sides)]),
+                                    np.array([pad(book[1], 0) for book in books]),
+                                    np.array([pad(book[2], 0) for book in books]),
+                                    np.array([pad(book[3], 0) for book in books]), sides)
+    for row, (book, side) in enumerate(zip(books, sides)):
+        expected, _, _ = match_orders(*book, side)
+        row_fills = fills[fills["row"] == row]
+        for name in expected.dtype.names:
+            np.testing.assert_array_equal(row_fills[name], expected[name])
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+from AgentPopulation import BUY, SELL
+from Environment import Environment
+from order_book import BookSide, OrderBook
+from simulation import generate_market
+
+
+def rebuilt_order(ids, prices, sign):
+    # the book order sorted from scratch: best price first, equal prices by agent id
+    return ids[np.lexsort((ids, sign * prices))]
+
+
+def daily_orders(rng, size, days, step):
+    '''Yields the orders of every day: a random subset of the agents with prices that move by up to step per day.'''
+    prices = rng.integers(0, 100, size).astype(float)
+    for _ in range(days):
+        prices = np.clip(prices + rng.integers(-step, step + 1, size), 0, 100)
+        ids = np.flatnonzero(rng.random(size) < 0.7)
+        yield ids, prices[ids], rng.integers(1, 50, len(ids)).astype(float)
+
+
+@pytest.mark.parametrize("step", [0, 1, 20])
+@pytest.mark.parametrize("sign", [1, -1])
+def test_side_matches_rebuilt_order(sign, step):
+    rng = np.random.default_rng(step)
+    side = BookSide(300, sign)
+    for ids, prices, counts in daily_orders(rng, 300, 50, step):
+        side.update(ids, prices, counts)
+        order = rebuilt_order(ids, prices, sign)
+        np.testing.assert_array_equal(side.order, order)
+        curve = side.curve()
+        np.testing.assert_array_equal(curve[:, 0], sign * np.sort(sign * prices))
+        np.testing.assert_array_equal(curve[:, 1], np.cumsum(side.counts[order]))
+
+
+def test_priority_orders_ties_by_tiebreak_and_id():
+    rng = np.random.default_rng(0)
+    side = BookSide(200, -1)
+    for ids, prices, counts in daily_orders(rng, 200, 20, 2):
+        side.update(ids, prices, counts)
+        tiebreaks = rng.integers(0, 3, len(ids)).astype(float)
+        np.testing.assert_array_equal(side.priority(tiebreaks), ids[np.lexsort((ids, tiebreaks, -prices))])
+
+
+def test_only_moved_orders_are_sorted_again():
+    side = BookSide(20, 1)
+    ids = np.arange(16)
+    prices = np.arange(16, dtype=float)
+    side.update(ids, prices, np.ones(16))
+    side.update(ids, prices, np.ones(16))
+    assert side.repaired == 0
+    prices[3] = 20.0
+    side.update(ids, prices, np.ones(16))
+    assert side.repaired == 1
+    np.testing.assert_array_equal(side.order, rebuilt_order(ids, prices, 1))
+    # more than repair_share of the orders moved, the side is sorted from scratch
+    side.update(ids, prices[::-1].copy(), np.ones(16))
+    assert side.repaired == 16
+
+
+def test_book_curves_of_both_sides():
+    book = OrderBook(6)
+    book.update(BUY, [0, 1, 2], [10.0, 30.0, 20.0], [1.0, 2.0, 3.0])
+    book.update(SELL, [3, 4, 5], [25.0, 5.0, 15.0], [4.0, 5.0, 6.0])
+    demands, offers = book.curves()
+    assert demands.tolist() == [[30.0, 2.0], [20.0, 5.0], [10.0, 6.0]]
+    assert offers.tolist() == [[5.0, 5.0], [15.0, 11.0], [25.0, 15.0]]
+    # a one-sided book keeps the curve of its other side
+    book.update(SELL, [], [], [])
+    demands, offers = book.curves()
+    assert demands.tolist() == [[30.0, 2.0], [20.0, 5.0], [10.0, 6.0]]
+    assert offers is None
+
+
+@pytest.mark.parametrize("population", [False, True])
+def test_run_matches_books_sorted_from_scratch(population):
+    def run(repair_share):
+        agents = generate_market(count=50, advanced_trading=True, population=population, rng=np.random.default_rng(0))
+        env = Environment(5, agents, "seller_preferred", rng=np.random.default_rng(1))
+        # with a repair share of 0 every changed side is sorted again
+        env.order_book = OrderBook(len(agents), repair_share)
+        for _ in range(100):
+            env.update()
+        return env.history
+    ref, history = run(0.0), run(0.125)
+    pd.testing.assert_frame_equal(ref.trade_frame(), history.trade_frame())
+    pd.testing.assert_frame_equal(ref.market_frame(), history.market_frame())
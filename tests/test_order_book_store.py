@@ -0,0 +1,36 @@
+import numpy as np
+from Environment import Environment
+from order_book_store import OrderBookStore
+from plotting import CurveRecorder
+from simulation import generate_agents, generate_market
+
+
+def test_books_match_the_recorded_curves(tmp_path):
+    store, curves = OrderBookStore(str(tmp_path)), CurveRecorder(every=1)
+    env = Environment(5, generate_market(count=30, rng=np.random.default_rng(0)), "seller_preferred",
+                      rng=np.random.default_rng(1), order_books=store, curves=curves)
+    for _ in range(30):
+        env.update()
+    env.close()
+    store = OrderBookStore(str(tmp_path), mode="r")
+    assert len(store) == 30
+    for curve in curves.curves:
+        book = store.book(curve["day"])
+        for name in ("demand_prices", "demand_quantities", "offer_prices", "offer_quantities"):
+            np.testing.assert_array_equal(book[name], curve[name])
+        assert book["market_price"] == curve["market_price"]
+
+
+def test_one_sided_books_are_kept(tmp_path):
+    # every agent has a surplus, so there are offers but no demands
+    agents = generate_agents(20, (10000, 11000), (12000, 13000), (0, 100), (0, 100), activate_abatement=False,
+                             rng=np.random.default_rng(0))
+    store = OrderBookStore(str(tmp_path))
+    env = Environment(5, agents, "seller_preferred", rng=np.random.default_rng(1), order_books=store)
+    env.update()
+    env.close()
+    book = store.book(env.day)
+    assert len(book["demand_prices"]) == 0
+    np.testing.assert_array_equal(np.sort(book["offer_prices"]), np.sort([np.float32(agent.trade_price) for agent in agents]))
+    assert book["offer_quantities"][-1] == sum(agent.count for agent in agents)
+    assert book["market_price"] == 5
@@ -0,0 +1,38 @@
+import logging
+import os
+import time
+import pytest
+import plotting
+from plotting import save_figure_in_background, wait_for_figures
+
+pytest.importorskip("matplotlib")
+
+
+def figure():
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(2, 2))
+    fig.add_subplot().plot([0, 1], [1, 0])
+    return fig
+
+
+def test_figures_share_one_worker_and_create_the_directory(tmp_path):
+    paths = [str(tmp_path / "plots" / f"figure_{i}.png") for i in range(3)]
+    futures = [save_figure_in_background(figure(), path, dpi=50) for path in paths]
+    executor = plotting._background_executor
+    futures.append(save_figure_in_background(figure(), str(tmp_path / "plots" / "figure_3.png"), dpi=50))
+    assert plotting._background_executor is executor
+    assert wait_for_figures(futures) == paths + [str(tmp_path / "plots" / "figure_3.png")]
+    assert all(os.path.exists(path) for path in paths)
+
+
+def test_failed_figure_is_logged_and_raised(tmp_path, caplog):
+    with caplog.at_level(logging.ERROR, logger="plotting"):
+        # matplotlib has no writer for the format, so saving fails in the worker
+        future = save_figure_in_background(figure(), str(tmp_path / "figure.unknown"), dpi=50)
+        with pytest.raises(ValueError):
+            wait_for_figures([future])
+        # the failure is logged by a callback that runs after the future is resolved
+        deadline = time.monotonic() + 10
+        while "background rendering failed" not in caplog.text and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert "background rendering failed" in caplog.text
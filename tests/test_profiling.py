@@ -0,0 +1,57 @@
+import json
+import tracemalloc
+import numpy as np
+import pytest
+from benchmark import benchmark_book, phase_results
+from profiling import Profiler
+
+MEGABYTE = 1 << 20
+
+
+@pytest.fixture
+def profiler():
+    was_tracing = tracemalloc.is_tracing()
+    profiler = Profiler(trace_memory=True)
+    yield profiler
+    if not was_tracing:
+        tracemalloc.stop()
+
+
+def peaks(profiler):
+    frame = profiler.phase_frame()
+    return dict(zip(frame["phase"].astype(str), frame["peak_bytes"]))
+
+
+def test_inner_peak_is_part_of_outer_peak(profiler):
+    with profiler.phase("outer", 0):
+        with profiler.phase("inner", 0):
+            data = np.ones(8 * MEGABYTE, dtype=np.uint8)
+            del data
+    result = peaks(profiler)
+    assert result["inner"] >= 8 * MEGABYTE
+    assert result["outer"] >= result["inner"]
+
+
+def test_outer_peak_before_inner_phase_is_kept(profiler):
+    with profiler.phase("outer", 0):
+        data = np.ones(16 * MEGABYTE, dtype=np.uint8)
+        del data
+        with profiler.phase("inner", 0):
+            pass
+    result = peaks(profiler)
+    assert result["outer"] >= 16 * MEGABYTE
+    assert result["inner"] < MEGABYTE
+
+
+def test_benchmark_phases_are_profiler_phases():
+    run = benchmark_book(100, repeat=3, trace_memory=False)
+    assert set(run["phases"]) == {"clearing_price", "match_seller_preferred", "match_buyer_preferred"}
+    assert all(stats["calls"] == 3 for stats in run["phases"].values())
+    json.dumps(run)
+
+    profiler = Profiler()
+    with profiler.phase("phase", 0):
+        pass
+    summary = profiler.summary()
+    assert phase_results(profiler) == {"phase": {"calls": 1, "total_seconds": summary["total_seconds"].iloc[0],
+                                                 "mean_seconds": summary["mean_seconds"].iloc[0], "peak_memory_bytes": 0}}
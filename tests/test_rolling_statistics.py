@@ -0,0 +1,40 @@
+import math
+import numpy as np
+from rolling_statistics import RollingWindow
+
+
+def series(seed, count=2000):
+    # a random walk with occasional large steps, whose values leave large rounding errors in a plain running sum
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(size=count) * rng.choice([0.01, 1.0, 100.0], count)
+    return np.maximum(0, 27.0 + np.cumsum(steps)).tolist()
+
+
+def ulps(value, exact):
+    return abs(value - exact) / np.spacing(exact) if exact else abs(value) / np.spacing(0.0)
+
+
+def test_means_match_exactly_rounded_means():
+    window = RollingWindow(365, recent=10)
+    values = []
+    for value in series(0):
+        window.push(value)
+        values.append(value)
+        full, recent = values[-365:], values[-10:]
+        assert ulps(window.mean(), math.fsum(full) / len(full)) <= 2
+        assert ulps(window.recent_mean(), math.fsum(recent) / len(recent)) <= 2
+        assert window.last() == value
+
+
+def test_array_series_match_scalar_series():
+    columns = [series(seed, 800) for seed in range(4)]
+    scalars = [RollingWindow(100, recent=10) for _ in columns]
+    window = RollingWindow(100, recent=10, shape=(len(columns),))
+    for row in zip(*columns):
+        window.push(np.array(row))
+        for scalar, value in zip(scalars, row):
+            scalar.push(value)
+        assert window.mean().tolist() == [scalar.mean() for scalar in scalars]
+        assert window.recent_mean().tolist() == [scalar.recent_mean() for scalar in scalars]
+    subset = window.subset([1, 3])
+    assert subset.mean().tolist() == [scalars[1].mean(), scalars[3].mean()]
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+from AgentPopulation import BUY, SELL
+from ensemble import parameter_grid
+from market_clearing import clearing_price
+from order_book import OrderBook
+from scenario_batch import ScenarioBatch, generate_scenario_market, simulate_scenarios
+
+GRID = parameter_grid({"mode": ["seller_preferred", "buyer_preferred"], "advanced_trading": [False, True],
+                       "activate_abatement": [False, True], "sell_price": [(0, 100), (20, 100)]})
+
+
+def test_scenario_alone_matches_scenario_in_batch():
+    batch = simulate_scenarios(GRID, steps=150, count=30, rng=np.random.default_rng(0))
+    frame, summary = batch.frame(), batch.summary()
+    for i in (0, 5, 10, 15):
+        alone = simulate_scenarios([GRID[i]], steps=150, count=30, rng=np.random.default_rng(0))
+        in_batch = frame[frame["scenario"] == i].drop(columns="scenario").reset_index(drop=True)
+        pd.testing.assert_frame_equal(alone.frame().drop(columns="scenario"), in_batch)
+        pd.testing.assert_frame_equal(alone.summary().drop(columns="scenario"),
+                                      summary.iloc[[i]].drop(columns="scenario").reset_index(drop=True))
+
+
+def test_batch_prices_match_single_market_clearing():
+    population = generate_scenario_market(GRID, count=30, rng=np.random.default_rng(0))
+    batch = ScenarioBatch(population, GRID, rng=np.random.default_rng(1))
+    calculate_market_price = batch.calculate_market_price
+
+    def checked_market_price(buying, selling):
+        # the market price of every scenario cleared on its own order book, like Environment.calculate_market_price()
+        expected = batch.market_price.copy()
+        for scenario in range(population.scenarios):
+            book = OrderBook(population.size)
+            for side, on_side in ((BUY, buying[scenario]), (SELL, selling[scenario])):
+                ids = np.flatnonzero(on_side)
+                book.update(side, ids, population.trade_price[scenario, ids], population.count[scenario, ids])
+            demands, offers = book.curves()
+            if demands is not None and offers is not None:
+                price = clearing_price(offers[:, 0], offers[:, 1], demands[:, 0], demands[:, 1])
+                expected[scenario] = expected[scenario] if price is None else price
+        calculate_market_price(buying, selling)
+        np.testing.assert_array_equal(batch.market_price, expected)
+
+    batch.calculate_market_price = checked_market_price
+    for _ in range(100):
+        batch.update()
+
+
+def test_batch_needs_one_row_per_scenario():
+    population = generate_scenario_market(GRID[:2], count=10, rng=np.random.default_rng(0))
+    with pytest.raises(ValueError):
+        ScenarioBatch(population, GRID[:3])
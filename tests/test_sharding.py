@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+from AgentPopulation import AGENT_ARRAYS
+from sharding import ShardedPopulation, partition
+from simulation import cap_trajectory, generate_market, simulate, simulate_years
+
+
+def make_population(count=50):
+    return generate_market(count=count, advanced_trading=True, population=True, rng=np.random.default_rng(0))
+
+
+def assert_same_run(ref, env):
+    pd.testing.assert_frame_equal(ref.history.trade_frame(), env.history.trade_frame())
+    pd.testing.assert_frame_equal(ref.history.market_frame(), env.history.market_frame())
+    pd.testing.assert_frame_equal(ref.history.agent_frame(), env.history.agent_frame())
+    pd.testing.assert_frame_equal(ref.history.compliance_frame(), env.history.compliance_frame())
+    for name in AGENT_ARRAYS:
+        np.testing.assert_array_equal(getattr(ref.population, name), getattr(env.population, name))
+
+
+def test_partition_keeps_groups_together():
+    groups = np.random.default_rng(0).choice(list("ABCDEFG"), 500)
+    shards = partition(len(groups), 3, groups)
+    assert sorted(np.concatenate(shards).tolist()) == list(range(500))
+    assert all(set(groups[a]).isdisjoint(groups[b]) for i, a in enumerate(shards) for b in shards[i + 1:])
+
+
+@pytest.mark.parametrize("mode", ["seller_preferred", "buyer_preferred"])
+def test_sharded_run_matches_single_process(mode):
+    ref = simulate(make_population(), steps=100, mode=mode, rng=np.random.default_rng(1))
+    with ShardedPopulation(make_population(), shards=3) as population:
+        env = simulate(population, steps=100, mode=mode, rng=np.random.default_rng(1))
+    assert_same_run(ref, env)
+
+
+def test_grouped_shards_match_single_process_over_years():
+    allocations = cap_trajectory(make_population().allowance, 2)
+    groups = np.random.default_rng(9).choice(list("ABCDEFG"), 100)
+    ref = simulate_years(make_population(), allocations, steps=60, rng=np.random.default_rng(6))
+    with ShardedPopulation(make_population(), shards=2, groups=groups) as population:
+        env = simulate_years(population, allocations, steps=60, rng=np.random.default_rng(6))
+    assert_same_run(ref, env)
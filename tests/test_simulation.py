@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from AgentPopulation import AgentPopulation
+from simulation import generate_agents, simulate_years
+
+
+def deterministic_agents(population):
+    agents = generate_agents(20, (10000, 11000), (10000, 11000), (0, 100), (0, 100), activate_abatement=False,
+                             emission_rate_noise=0, expected_emission_noise=0, rng=np.random.default_rng(0))
+    return AgentPopulation.from_agents(agents, rng=np.random.default_rng(1)) if population else agents
+
+
+@pytest.mark.parametrize("population", [False, True])
+def test_years_shorter_than_365_days(population):
+    agents = deterministic_agents(population)
+    expected_emission = float(np.sum(agents.expected_emission if population else [agent.expected_emission for agent in agents]))
+    env = simulate_years(agents, [10000.0], steps=100, rng=np.random.default_rng(2))
+    compliance = env.history.compliance_frame()
+    # every year of 100 days emits the expected emission of a year, the first year included
+    np.testing.assert_allclose(compliance["emissions"], [expected_emission] * 2, rtol=1e-9)